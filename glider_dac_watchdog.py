@@ -5,25 +5,263 @@ import os.path
 import os
 import argparse
 import glob
+import redis
 import sys
-from rq import Queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from glider_qc import glider_qc
 from datetime import datetime
 from glider_dac import app, db
 from watchdog.events import (FileSystemEventHandler,
-                             DirCreatedEvent, DirDeletedEvent,
+                             DirCreatedEvent, DirDeletedEvent, DirMovedEvent,
                              FileCreatedEvent, FileMovedEvent, FileModifiedEvent)
 from watchdog.observers import Observer
 
+# Redis hash of the deployment directories to the latest modification or
+# change time of their handled files
+HIGH_WATER_MARKS_KEY = 'gliderdac:watchdog:high_water_marks'
+
+
+class EventCoalescer(object):
+    '''
+    Collects the file events of each deployment and hands them over in a
+    single batch once no event arrived for the deployment in quiet_seconds,
+    or at the latest max_delay seconds after its first pending event. An
+    upload of many files, each firing created, modified and moved events, is
+    then handled once instead of once per event.
+    '''
+    def __init__(self, flush, quiet_seconds=2.0, max_delay=30.0):
+        '''
+        :param flush: callable taking the deployment directory and a
+                      dictionary of the file names to the latest path of
+                      each file that had events
+        :param quiet_seconds: seconds without events before a deployment is flushed
+        :param max_delay: most seconds a deployment's events are held back
+        '''
+        self.flush = flush
+        self.quiet_seconds = quiet_seconds
+        self.max_delay = max_delay
+        self.pending = {}
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='event-coalescer', daemon=True)
+        self.thread.start()
+
+    def add(self, deployment_dir, file_name, file_path):
+        now = time.monotonic()
+        with self.condition:
+            batch = self.pending.get(deployment_dir)
+            if batch is None:
+                batch = self.pending[deployment_dir] = {'first': now, 'files': {}}
+            batch['last'] = now
+            batch['files'][file_name] = file_path
+            self.condition.notify()
+
+    def due(self, batch):
+        return min(batch['last'] + self.quiet_seconds, batch['first'] + self.max_delay)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    # everything pending is flushed on stop
+                    ready = [deployment_dir for deployment_dir, batch in self.pending.items()
+                             if self.stopped or self.due(batch) <= now]
+                    if ready or (self.stopped and not self.pending):
+                        break
+                    timeout = None
+                    if self.pending:
+                        timeout = min(self.due(batch) for batch in self.pending.values()) - now
+                    self.condition.wait(timeout)
+                if not ready:
+                    return
+                batches = [(deployment_dir, self.pending.pop(deployment_dir)['files'])
+                           for deployment_dir in ready]
+            for deployment_dir, files in batches:
+                try:
+                    self.flush(deployment_dir, files)
+                except Exception:
+                    app.logger.exception("Could not handle the file events of %s", deployment_dir)
+
+    def stop(self):
+        '''
+        Flushes the pending events and stops the coalescer thread
+        '''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+
+class SerializingExecutor(object):
+    '''
+    Runs tasks on a bounded thread pool. Tasks submitted with the same key,
+    the deployment directory of an event, run one at a time in the order
+    they were submitted while tasks of different keys run concurrently, so
+    one slow deployment doesn't stall the others. Once max_pending tasks are
+    waiting, submit blocks and pushes back on the caller instead of queueing
+    without bound.
+    '''
+    def __init__(self, max_workers=4, max_pending=10000, latency_samples=1000):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # key -> deque of the (function, args, submitted) tasks of the key
+        self.tasks = {}
+        self.pending = 0
+        self.handled = 0
+        # seconds from submission to completion of the latest tasks
+        self.latencies = deque(maxlen=latency_samples)
+
+    def submit(self, key, fn, *args):
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+            tasks = self.tasks.get(key)
+            if tasks is not None:
+                # the running task of the key starts this one when done
+                tasks.append((fn, args, time.monotonic()))
+                return
+            self.tasks[key] = deque([(fn, args, time.monotonic())])
+        self.executor.submit(self.run, key)
+
+    def run(self, key):
+        with self.lock:
+            fn, args, submitted = self.tasks[key][0]
+        try:
+            fn(*args)
+        except Exception:
+            app.logger.exception("Error handling the events of %s", key)
+        with self.lock:
+            tasks = self.tasks[key]
+            tasks.popleft()
+            if not tasks:
+                del self.tasks[key]
+            self.pending -= 1
+            self.handled += 1
+            self.latencies.append(time.monotonic() - submitted)
+            if not self.pending:
+                self.idle.notify_all()
+        self.slots.release()
+        # The next task of the key goes to the back of the pool's queue, so
+        # busy deployments take turns with the others
+        if tasks:
+            self.executor.submit(self.run, key)
+
+    def metrics(self):
+        '''
+        Returns the number of tasks waiting or running, the number of
+        deployments they belong to, the number of tasks handled and the
+        percentiles of the latest task latencies in seconds
+        '''
+        with self.lock:
+            latencies = sorted(self.latencies)
+            metrics = {'pending': self.pending, 'deployments': len(self.tasks), 'handled': self.handled}
+        if latencies:
+            for percentile in (50, 90, 99):
+                index = min(len(latencies) - 1, len(latencies) * percentile // 100)
+                metrics['latency_p{}'.format(percentile)] = round(latencies[index], 3)
+            metrics['latency_max'] = round(latencies[-1], 3)
+        return metrics
+
+    def shutdown(self):
+        '''
+        Waits for the pending tasks and shuts the thread pool down
+        '''
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+        self.executor.shutdown()
+
+
+class DeploymentCache(object):
+    '''
+    In-process cache of the deployment ids by deployment directory, so
+    handling events doesn't look the deployment directory up in Mongo every
+    time. Entries, including directories without a deployment, expire after
+    ttl seconds and are invalidated when their directory is created, deleted
+    or moved. Only the ids are cached: a deployment is fetched by its id
+    before it is changed so saving it doesn't revert changes made elsewhere,
+    such as in the web app.
+    '''
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # deployment_dir -> (expires, deployment _id or None)
+        self.entries = {}
+        # bumped on invalidation so lookups racing with it aren't cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, deployment_dir):
+        '''
+        Returns the _id of the deployment of a directory or None. Must be
+        called within the app context.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(deployment_dir)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+        deployment = db.Deployment.find_one({'deployment_dir': deployment_dir})
+        deployment_id = deployment._id if deployment is not None else None
+        with self.lock:
+            if generation == self.generation:
+                self.entries[deployment_dir] = (now + self.ttl, deployment_id)
+        return deployment_id
+
+    def invalidate(self, deployment_dir):
+        '''
+        Drops the entries of a directory and of the directories under it
+        '''
+        prefix = deployment_dir + os.sep
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if key == deployment_dir or key.startswith(prefix)]:
+                del self.entries[key]
+
+    def metrics(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
 
 class HandleDeploymentDB(FileSystemEventHandler):
-    def __init__(self, base, flagsdir):
+    def __init__(self, base, flagsdir, probe_workers=4, quiet_seconds=2.0, event_workers=4,
+                 cache_ttl=30):
         self.base = base
         self.flagsdir = flagsdir  # path to ERDDAP flags folder
-        # TODO: possibly create multiple priority queues depending on whether
-        # or not delayed mode datasets are used.
-        self.queue = Queue("gliderdac",
-                           connection=glider_qc.get_redis_connection())
+        # Real-time and delayed mode files are QC'd from separate queues,
+        # keyed by deployment.delayed_mode
+        self.queues = {delayed_mode: glider_qc.get_qc_queue(delayed_mode)
+                       for delayed_mode in (False, True)}
+        self.deployments = DeploymentCache(cache_ttl)
+        # Threads inspecting new files for QC
+        self.probe_executor = ThreadPoolExecutor(max_workers=probe_workers)
+        # Events are handled off the observer thread, in order for each
+        # deployment
+        self.event_executor = SerializingExecutor(max_workers=event_workers)
+        # The file events of a deployment are handled in batches
+        self.coalescer = EventCoalescer(
+            lambda deployment_dir, files: self.event_executor.submit(
+                deployment_dir, self.deployment_files_changed, deployment_dir, files),
+            quiet_seconds)
+
+    def dispatch_event(self, handle, event):
+        '''
+        Hands an event over to the event threads, keyed on the deployment
+        directory of the event
+        '''
+        path = event.dest_path if isinstance(event, FileMovedEvent) else event.src_path
+        if not event.is_directory:
+            path = os.path.dirname(path)
+        self.event_executor.submit(os.path.relpath(path, self.base), handle, event)
 
     def file_moved_or_created(self, event):
         app.logger.info('%s %s', self.base, event.src_path)
@@ -31,8 +269,10 @@ class HandleDeploymentDB(FileSystemEventHandler):
             return
 
         rel_path = os.path.relpath(event.src_path, self.base)
+        file_path = event.src_path
         if isinstance(event, FileMovedEvent):
             rel_path = os.path.relpath(event.dest_path, self.base)
+            file_path = event.dest_path
         path_parts = os.path.split(rel_path)
         app.logger.info("%s %s", type(event), path_parts)
 
@@ -40,9 +280,9 @@ class HandleDeploymentDB(FileSystemEventHandler):
         if path_parts[1].startswith('.'):
             return
 
-        with app.app_context():
-            # navoceano unsorted deployments
-            if path_parts[0] == "navoceano/hurricanes-20230601T0000":
+        # navoceano unsorted deployments
+        if path_parts[0] == "navoceano/hurricanes-20230601T0000":
+            with app.app_context():
                 if not path_parts[-1].endswith(".nc"):
                     return
                 deployment_name_raw, extension = os.path.splitext(path_parts[-1])
@@ -78,64 +318,215 @@ class HandleDeploymentDB(FileSystemEventHandler):
                                os.path.join(navo_deployment_directory, f"{glider_callsign}_{date_str}{extension}"))
                 except OSError:
                     app.logger.exception("Could not create new deployment file for NAVOCEANO: ")
-                return
+            self.record_high_water_mark(path_parts[0], [file_path])
+            return
 
-            deployment = db.Deployment.find_one({'deployment_dir' : path_parts[0]})
-            if deployment is None:
-                app.logger.error("Cannot find deployment for %s", path_parts[0])
-                return
+        self.coalescer.add(path_parts[0], path_parts[-1], file_path)
 
-            if path_parts[-1] == "wmoid.txt":
-                rel_path = os.path.relpath(event.src_path, self.base)
-                app.logger.info("New wmoid.txt in %s", rel_path)
-                if deployment.wmo_id:
-                    app.logger.info("Deployment already has wmoid %s.  Updating value with new file.", deployment.wmo_id)
-                with open(event.src_path) as wf:
-                    deployment.wmo_id = str(wf.readline().strip())
-                deployment.save()
-                app.logger.info("Updated deployment %s", path_parts[0])
-            # extra_atts.json will contain metadata modifications to
-            # datasets.xml which should require a reload/regeneration of that
-            # file.
-            elif path_parts[-1] == "extra_atts.json":
-                app.logger.info("extra_atts.json detected in %s", rel_path)
-                deployment.save()
-            else:
+    def deployment_files_changed(self, deployment_dir, files):
+        '''
+        Updates a deployment once for a batch of its file events: the
+        deployment is saved, its ERDDAP flag touched and QC jobs enqueued
+        for the new netCDF files.
+
+        :param deployment_dir: deployment directory relative to the base
+        :param files: dictionary of the file names to their paths
+        '''
+        # the mark is recorded even when there is no deployment so the files
+        # aren't replayed by every reconcile
+        try:
+            with app.app_context():
+                deployment_id = self.deployments.get(deployment_dir)
+                if deployment_id is None:
+                    app.logger.error("Cannot find deployment for %s", deployment_dir)
+                    return
+
+                nc_files = [file_path for file_name, file_path in files.items()
+                            if '.nc' in os.path.splitext(file_name)[1]]
                 # Always save the Deployment when a new dive file is added
                 # so a checksum is calculated and a new deployment.json file
                 # is created
-                fname, ext = os.path.splitext(path_parts[-1])
-                if '.nc' in ext:
-                    deployment.save()
-                    app.logger.info("Updated deployment %s", path_parts[0])
+                save = bool(nc_files) or "wmoid.txt" in files or "extra_atts.json" in files
+                if not save:
+                    return
+                # the document is fetched fresh as saving it sets all of
+                # its fields
+                deployment = db.Deployment.find_one({'_id': deployment_id})
+                if deployment is None:
+                    app.logger.error("Cannot find deployment for %s", deployment_dir)
+                    self.deployments.invalidate(deployment_dir)
+                    return
+
+                if "wmoid.txt" in files:
+                    app.logger.info("New wmoid.txt in %s", deployment_dir)
+                    if deployment.wmo_id:
+                        app.logger.info("Deployment already has wmoid %s.  Updating value with new file.", deployment.wmo_id)
+                    with open(files["wmoid.txt"]) as wf:
+                        deployment.wmo_id = str(wf.readline().strip())
+                # extra_atts.json will contain metadata modifications to
+                # datasets.xml which should require a reload/regeneration of that
+                # file.
+                if "extra_atts.json" in files:
+                    app.logger.info("extra_atts.json detected in %s", deployment_dir)
+                deployment.save()
+                app.logger.info("Updated deployment %s (%d files)", deployment_dir, len(files))
+
+                if nc_files:
                     # touch the ERDDAP flag (realtime data only)
                     if not deployment.delayed_mode:
-                        deployment_name = path_parts[0].split('/')[-1]
-                        self.touch_erddap(deployment_name)
-                    # kick off QARTOD job
-                    if isinstance(event, (FileModifiedEvent, FileCreatedEvent)):
-                        file_path = event.src_path
-                    else:
-                        file_path = event.dest_path
-                    # TODO: DRY/refactor with batch QARTOD job?
-                    try:
-                        if self.queue.connection.exists(f"gliderdac:{file_path}"):
-                            app.logger.info(f"File {file_path} already has lock in Redis")
-                            return
-                        if glider_qc.check_needs_qc(file_path):
-                            app.logger.info("Enqueueing QARTOD job for file %s",
-                                            file_path)
-                            self.queue.enqueue(glider_qc.qc_task, file_path,
-                                               os.path.join(
-                                                 os.path.dirname(
-                                                   os.path.realpath(__file__)
-                                                 ), "data/qc_config.yml"))
-                        else:
-                            app.logger.info(f"File {file_path} already has QC")
-                    except OSError:
-                        app.logger.exception("Exception occurred while "
-                                             "attempting to inspect file %s "
-                                             "for QC variables: ", file_path)
+                        self.touch_erddap(deployment_dir.split('/')[-1])
+                    # kick off QARTOD jobs, inspecting the files is done in the
+                    # probe threads
+                    for file_path in nc_files:
+                        self.probe_executor.submit(self.enqueue_qc, file_path,
+                                                   bool(deployment.delayed_mode))
+        finally:
+            self.record_high_water_mark(deployment_dir, files.values())
+
+    @staticmethod
+    def file_time(stat):
+        '''
+        Returns the time a file was last modified or, for files uploaded with
+        their original modification times, moved into place
+        '''
+        return max(stat.st_mtime, stat.st_ctime)
+
+    def record_high_water_mark(self, deployment_dir, file_paths):
+        '''
+        Records the latest time of the handled files of a deployment
+        directory, files past it are picked up by reconcile on startup
+
+        :param deployment_dir: directory of the files relative to the base
+        :param file_paths: paths of the handled files
+        '''
+        times = []
+        for file_path in file_paths:
+            try:
+                times.append(self.file_time(os.stat(file_path, follow_symlinks=False)))
+            except OSError:
+                pass
+        if not times:
+            return
+        try:
+            # The events of a deployment are handled one at a time
+            rc = glider_qc.get_redis_connection()
+            mark = rc.hget(HIGH_WATER_MARKS_KEY, deployment_dir)
+            if mark is None or float(mark) < max(times):
+                rc.hset(HIGH_WATER_MARKS_KEY, deployment_dir, max(times))
+        except redis.RedisError:
+            app.logger.exception("Could not record the high water mark of %s", deployment_dir)
+
+    def reconcile(self, workers=8):
+        '''
+        Synthesizes created events for the files that were added or changed
+        while the watchdog was not running: files with a later time than the
+        high water mark of their directory, or in directories without one.
+        The user directories are scanned in parallel.
+
+        The first time, when no high water marks were recorded yet, the
+        current times are recorded without handling any file.
+
+        :param workers: number of user directories scanned at once
+        '''
+        start = time.monotonic()
+        try:
+            rc = glider_qc.get_redis_connection()
+            marks = {deployment_dir.decode('utf-8'): float(mark)
+                     for deployment_dir, mark in rc.hgetall(HIGH_WATER_MARKS_KEY).items()}
+        except redis.RedisError:
+            app.logger.exception("Could not read the high water marks, skipping the reconciliation")
+            return
+        with os.scandir(self.base) as entries:
+            user_dirs = [entry.path for entry in entries
+                         if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.')]
+        baseline = not marks
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda user_dir: self.reconcile_dir(user_dir, marks, baseline),
+                                        user_dirs))
+        if baseline:
+            pipe = rc.pipeline()
+            for found in results:
+                for deployment_dir, mark in found.items():
+                    pipe.hset(HIGH_WATER_MARKS_KEY, deployment_dir, mark)
+            pipe.execute()
+            app.logger.info("Recorded the high water marks of %d directories in %.1fs",
+                            sum(map(len, results)), time.monotonic() - start)
+        else:
+            app.logger.info("Reconciled %d files changed while the watchdog was down in %.1fs",
+                            sum(results), time.monotonic() - start)
+
+    def reconcile_dir(self, user_dir, marks, baseline=False):
+        '''
+        Scans a user directory for the reconciliation. Returns the number of
+        files handed over as events or, for the baseline, a dictionary of the
+        directories to their high water mark
+
+        :param user_dir: path of the user directory
+        :param marks: dictionary of the directories to their high water mark
+        :param baseline: only collect the high water marks
+        '''
+        found = {} if baseline else 0
+        stack = [user_dir]
+        while stack:
+            path = stack.pop()
+            rel_dir = os.path.relpath(path, self.base)
+            mark = marks.get(rel_dir)
+            try:
+                with os.scandir(path) as entries:
+                    entries = list(entries)
+            except OSError:
+                app.logger.exception("Could not scan %s", path)
+                continue
+            for entry in entries:
+                # ignore dotfiles
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                try:
+                    file_time = self.file_time(entry.stat(follow_symlinks=False))
+                except OSError:
+                    continue
+                if baseline:
+                    found[rel_dir] = max(found.get(rel_dir, 0), file_time)
+                elif mark is None or file_time > mark:
+                    self.dispatch_event(self.file_moved_or_created, FileCreatedEvent(entry.path))
+                    found += 1
+        return found
+
+    def enqueue_qc(self, file_path, delayed_mode=False):
+        '''
+        Enqueues a QARTOD job for the file if it is not locked and still needs
+        QC. Runs in the probe thread pool.
+
+        :param file_path: path to the netCDF file
+        :param delayed_mode: whether the file is from a delayed mode
+                             deployment, which is QC'd from the lower
+                             priority queue
+        '''
+        # TODO: DRY/refactor with batch QARTOD job?
+        queue = self.queues[delayed_mode]
+        config = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              "data/qc_config.yml")
+        try:
+            if queue.connection.exists(f"gliderdac:{file_path}"):
+                app.logger.info(f"File {file_path} already has lock in Redis")
+                return
+            if glider_qc.check_needs_qc(file_path, config):
+                app.logger.info("Enqueueing QARTOD job for file %s",
+                                file_path)
+                queue.enqueue(glider_qc.qc_task, file_path, config)
+            else:
+                app.logger.info(f"File {file_path} already has QC")
+        except (OSError, ValueError):
+            # ValueError is raised for headers of partially written files
+            app.logger.exception("Exception occurred while "
+                                 "attempting to inspect file %s "
+                                 "for QC variables: ", file_path)
+        except Exception:
+            app.logger.exception("Unexpected error enqueueing QC for %s",
+                                 file_path)
 
     def touch_erddap(self, deployment_name):
         '''
@@ -151,11 +542,15 @@ class HandleDeploymentDB(FileSystemEventHandler):
 
     def on_moved(self, event):
         if isinstance(event, FileMovedEvent):
-            self.file_moved_or_created(event)
+            self.dispatch_event(self.file_moved_or_created, event)
+        elif isinstance(event, DirMovedEvent):
+            # A renamed deployment directory
+            self.deployments.invalidate(os.path.relpath(event.src_path, self.base))
+            self.deployments.invalidate(os.path.relpath(event.dest_path, self.base))
 
     def on_modified(self, event):
         if isinstance(event, FileModifiedEvent):
-            self.file_moved_or_created(event)
+            self.dispatch_event(self.file_moved_or_created, event)
 
     def on_created(self, event):
         if isinstance(event, DirCreatedEvent):
@@ -164,6 +559,8 @@ class HandleDeploymentDB(FileSystemEventHandler):
                 return
 
             rel_path = os.path.relpath(event.src_path, self.base)
+            # The directory may have been looked up before it had a deployment
+            self.deployments.invalidate(rel_path)
 
             # we only care about this path if it's under a user dir
             # user/upload/deployment-name
@@ -175,45 +572,63 @@ class HandleDeploymentDB(FileSystemEventHandler):
             app.logger.info("New deployment directory: %s", rel_path)
 
         elif isinstance(event, FileCreatedEvent):
-            self.file_moved_or_created(event)
+            self.dispatch_event(self.file_moved_or_created, event)
 
 
     def on_deleted(self, event):
         if isinstance(event, DirDeletedEvent):
-            if self.base not in event.src_path:
-                return
+            self.dispatch_event(self.deployment_dir_deleted, event)
 
-            rel_path = os.path.relpath(event.src_path, self.base)
+    def deployment_dir_deleted(self, event):
+        if self.base not in event.src_path:
+            return
 
-            # we only care about this path if it's under a user dir
-            # user/upload/deployment-name
-            path_parts = rel_path.split(os.sep)
+        rel_path = os.path.relpath(event.src_path, self.base)
+        self.deployments.invalidate(rel_path)
 
-            if len(path_parts) != 3:
-                return
+        # we only care about this path if it's under a user dir
+        # user/upload/deployment-name
+        path_parts = rel_path.split(os.sep)
 
-            app.logger.info("Removed deployment directory: %s", rel_path)
+        if len(path_parts) != 3:
+            return
 
-            with app.app_context():
-                deployment = db.Deployment.find_one({'deployment_dir': event.src_path})
-                if deployment:
-                    deployment.delete()
+        app.logger.info("Removed deployment directory: %s", rel_path)
+
+        with app.app_context():
+            deployment = db.Deployment.find_one({'deployment_dir': event.src_path})
+            if deployment:
+                deployment.delete()
 
 
-def main(handler):
+def main(handler, metrics_interval=60, reconcile=True):
     observer = Observer()
     observer.schedule(handler, path=handler.base, recursive=True)
     observer.start()
 
     app.logger.info("Watching user directories in %s", handler.base)
+    if reconcile:
+        # Catch up with the files that arrived while the watchdog was down,
+        # events from the observer in the meantime are coalesced with them
+        threading.Thread(target=handler.reconcile, name='reconcile', daemon=True).start()
 
     try:
+        last_metrics = time.monotonic()
         while True:
             time.sleep(1)
+            if time.monotonic() - last_metrics >= metrics_interval:
+                last_metrics = time.monotonic()
+                # Backpressure: events waiting to be handled and how long
+                # the latest ones took from the observer to handled
+                app.logger.info("Event handling: %s, deployment cache: %s",
+                                handler.event_executor.metrics(), handler.deployments.metrics())
     except KeyboardInterrupt:
         observer.stop()
 
     observer.join()
+    handler.coalescer.stop()
+    handler.event_executor.shutdown()
+    handler.probe_executor.shutdown()
 
 
 if __name__ == "__main__":
@@ -228,12 +643,37 @@ if __name__ == "__main__":
         default=os.environ.get('FLAGS_DIR', '.'),
         nargs='?'
     )
+    parser.add_argument(
+        '--quiet-seconds',
+        type=float,
+        default=2.0,
+        help="Seconds without file events before a deployment's events are handled"
+    )
+    parser.add_argument(
+        '--no-reconcile',
+        action='store_true',
+        help="Don't scan for the files added while the watchdog was not running on startup"
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        type=float,
+        default=30,
+        help="Seconds the deployments looked up by directory are cached for"
+    )
+    parser.add_argument(
+        '--event-workers',
+        type=int,
+        default=4,
+        help="Threads handling the file events, the events of a deployment are handled in order"
+    )
     args = parser.parse_args()
 
     base = os.path.realpath(args.basedir)
     flagsdir = os.path.realpath(args.flagsdir)
     try:
-        main(HandleDeploymentDB(base, flagsdir))
+        main(HandleDeploymentDB(base, flagsdir, quiet_seconds=args.quiet_seconds,
+                                event_workers=args.event_workers, cache_ttl=args.cache_ttl),
+             reconcile=not args.no_reconcile)
     except OSError:
         with app.app_context():
             app.logger.exception("Exception occurred attempting to set up file "
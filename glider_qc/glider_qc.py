@@ -4,12 +4,13 @@ Runs IOOS QARTOD tests on a netCDF file
 glider_qc/glider_qc.py
 '''
 from cf_units import Unit
-from netCDF4 import num2date, Dataset
+from netCDF4 import num2date, Dataset, Variable, default_fillvals
 import datetime
-from ioos_qc.stores import PandasStore
+from ioos_qc.stores import PandasStore, column_from_collected_result
 from ioos_qc.streams import PandasStream
 from ioos_qc.results import collect_results, CollectedResult
 from ioos_qc.config import Config
+from ioos_qc.qartod import aggregate
 import numpy as np
 import pandas as pd
 import json
@@ -19,17 +20,123 @@ import quantities as pq
 import yaml
 import logging
 import redis
+from rq import Queue, get_current_job
+from rq.utils import utcnow
 import os
 import hashlib
-from shapely.geometry import Point, Polygon
+import shutil
+import stat
+import tempfile
+import warnings
+import ioos_qc
+try:
+    # Only used by the polygon location test
+    from shapely.geometry import Point, Polygon
+except ImportError:
+    Point = Polygon = None
+from glider_util import ncheader
+import copy
+import functools
+import time
+from contextlib import contextmanager
 log = logging.getLogger(__name__)
 __RCONN = None
+__QC_CONFIGS = {}
+QC_CACHE_KEY = 'gliderdac:qc_cache:'
+# Cached QC results expire after 30 days
+QC_CACHE_TTL = 30 * 24 * 60 * 60
+DEPLOYMENT_STATS_KEY = 'gliderdac:deployment_stats:'
+# Stream of the per stage QC timings of the most recent files
+QC_TIMINGS_STREAM = 'gliderdac:qc_timings'
+QC_TIMINGS_MAXLEN = 10000
+# RQ queues of the QC jobs. Workers take jobs from the queues in this order so
+# bulk delayed mode uploads don't hold up the real-time files
+QC_QUEUE = 'gliderdac'
+QC_DELAYED_QUEUE = 'gliderdac_delayed'
+QC_QUEUES = [QC_QUEUE, QC_DELAYED_QUEUE]
+# Files with more samples along time are QC'd in windows of this many samples
+QC_CHUNK_SIZE = int(os.environ.get('QC_CHUNK_SIZE', 500000))
+# Hash of what a failed QC run depended on, the file is retried when it changes
+QC_ERROR_KEY_XATTR = 'user.qc_error_key'
 
 
 class ProcessError(ValueError):
     pass
 
+class StageTimings(object):
+    '''
+    Records the time spent in each stage of the QC of a file and the size of
+    the arrays processed. Stages entered several times, such as the per
+    variable stages, are accumulated.
+
+    Example::
+
+        timings = StageTimings()
+        with timings.stage('normalize_variable', len(values)):
+            ...
+    '''
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, size=None):
+        '''
+        Context manager timing a stage
+
+        :param name: string defining the stage name
+        :param size: number of values processed (optional)
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'size': 0})
+            stage['seconds'] += time.perf_counter() - start
+            stage['calls'] += 1
+            if size is not None:
+                stage['size'] += int(size)
+
+    def total(self):
+        return sum(stage['seconds'] for stage in self.stages.values())
+
+    def publish(self, nc_path, connection=None, queue=None, queue_wait=None):
+        '''
+        Adds the timings of a file to the QC timings redis stream, which is
+        capped to the most recent QC_TIMINGS_MAXLEN files
+
+        :param nc_path: string defining path to the netCDF file
+        :param connection: redis connection (optional)
+        :param queue: name of the RQ queue the QC job came from (optional)
+        :param queue_wait: seconds the QC job waited in the queue (optional)
+        '''
+        fields = {
+            'path': nc_path,
+            'stages': json.dumps(self.stages),
+        }
+        if queue is not None:
+            fields['queue'] = queue
+            fields['queue_wait'] = queue_wait
+        try:
+            connection = connection or get_redis_connection()
+            connection.xadd(QC_TIMINGS_STREAM, fields, maxlen=QC_TIMINGS_MAXLEN, approximate=True)
+        except redis.RedisError:
+            log.exception("Could not publish the QC timings of %s", nc_path)
+
 class GliderQC(object):
+    # Units the geophysical variables are converted to before running QC
+    STANDARD_UNITS = {
+        'sea_water_temperature': 'deg_C',
+        'sea_water_electrical_conductivity': 'S m-1',
+        'sea_water_salinity': '1',
+        'sea_water_practical_salinity': '1',
+        'sea_water_pressure': 'dbar',
+        'sea_water_density': 'kg m-3'
+    }
+    # 1 degree latitude ≈ 69.172 miles
+    MILES_PER_DEG_LAT = 69.172
+    # Radius of the watch circle of the location test
+    LOCATION_RADIUS_MILES = 2.0
+
     def __init__(self, ncfile, config_file=None):
         '''
         Initializes an instance of the class with a netCDF file and an optional config file.
@@ -38,6 +145,10 @@ class GliderQC(object):
         :param config_file: The path to a configuration file (optional).
         '''
         self.ncfile = ncfile
+        # Decoded coordinate axes, populated on first access (see axes)
+        self._axes = None
+        # Time spent in each stage of the QC of the file
+        self.timings = StageTimings()
 
         if config_file is not None:
             try:
@@ -45,6 +156,33 @@ class GliderQC(object):
             except Exception as e:
                 log.error("Error loading config file %s: %s", config_file, str(e))
 
+    @property
+    def axes(self):
+        '''
+        Returns a dictionary of the decoded time, lat and lon axes of the file.
+        The axes are read and converted only once per file and are shared by
+        all of the checks.
+        '''
+        if self._axes is None:
+            self._axes = self.load_axes()
+        return self._axes
+
+    def load_axes(self):
+        '''
+        Reads the time, lat and lon coordinate variables from the file.
+
+        time is returned as a datetime64[s] masked array, lat and lon as float64
+        arrays with masked values replaced by NaN.
+        '''
+        axes = {}
+        variables = self.ncfile.variables
+        if 'time' in variables:
+            axes['time'] = variables['time'][:].astype('datetime64[s]')
+        for name in ('lat', 'lon'):
+            if name in variables:
+                axes[name] = self.masked_to_nan(variables[name][:])
+        return axes
+
     def needs_qc(self, ncvariable):
         '''
         Returns True if the variable has no associated QC variables
@@ -96,6 +234,25 @@ class GliderQC(object):
 
         :param ncvariable: netCDF4.Variable
         '''
+        specs = self.qc_variable_specs(ncvariable)
+        apply_qc_results(self.ncfile, {
+            'variables': specs,
+            'ancillary_variables': {
+                ncvariable.name: self.extend_ancillary_variables(ncvariable, list(specs))
+            },
+        })
+        return list(specs)
+
+    def qc_variable_specs(self, ncvariable, with_data=True):
+        '''
+        Returns a dictionary of the QC flag variable names of a variable to
+        their definitions (datatype, dimensions, fill_value, attributes and
+        data, NOT_EVALUATED until the tests run), as used by apply_qc_results
+
+        :param ncvariable: netCDF4.Variable
+        :param with_data: bool, include the data of the flags, chunked QC
+                          writes it window by window instead
+        '''
         name_value = ncvariable.name
         standard_name_value = ncvariable.standard_name
         dims = ncvariable.dimensions
@@ -128,34 +285,35 @@ class GliderQC(object):
             }
         }
 
-        qcvariables = []
+        specs = {}
 
         for tname, template in list(templates.items()):
 
             variable_name = template['name'].format(name=name_value)
 
-            if variable_name not in self.ncfile.variables:
-                ncvar = self.ncfile.createVariable(variable_name, np.int8, dims, fill_value=np.int16(-999))
-            else:
-                ncvar = self.ncfile.variables[variable_name]
-
-            ncvar[:] = np.full(len(ncvariable[:]), 2)
-            ncvar.units = '1'
-            ncvar.standard_name = template['standard_name']
-            ncvar.long_name = template['long_name'].format(standard_name=standard_name_value)
-            ncvar.flag_values = np.array([1, 2, 3, 4, 9], dtype=np.int8)
-            ncvar.valid_min = np.int8(1)
-            ncvar.valid_max = np.int8(9)
-            ncvar.flag_meanings = 'PASS NOT_EVALUATED SUSPECT FAIL MISSING'
-            ncvar.references = 'https://gliders.ioos.us/files/Manual-for-QC-of-Glider-Data_05_09_16.pdf '
-            ncvar.qartod_package = 'https://github.com/ioos/ioos_qc/blob/main/ioos_qc/qartod.py'
-            ncvar.dac_comment = 'QARTOD TEST RUN'
-            ncvar.ioos_category = 'Quality'
-
-            qcvariables.append(variable_name)
-            self.append_ancillary_variable(ncvariable, ncvar)
-
-        return qcvariables
+            specs[variable_name] = spec = {
+                'datatype': 'i1',
+                'dimensions': list(dims),
+                'fill_value': np.int16(-999),
+                'attributes': {
+                    'units': '1',
+                    'standard_name': template['standard_name'],
+                    'long_name': template['long_name'].format(standard_name=standard_name_value),
+                    'flag_values': np.array([1, 2, 3, 4, 9], dtype=np.int8),
+                    'valid_min': np.int8(1),
+                    'valid_max': np.int8(9),
+                    'flag_meanings': 'PASS NOT_EVALUATED SUSPECT FAIL MISSING',
+                    'references': 'https://gliders.ioos.us/files/Manual-for-QC-of-Glider-Data_05_09_16.pdf ',
+                    'qartod_package': 'https://github.com/ioos/ioos_qc/blob/main/ioos_qc/qartod.py',
+                    'dac_comment': 'QARTOD TEST RUN',
+                    'ioos_category': 'Quality',
+                },
+            }
+            if with_data:
+                # the shape comes from the header, the parent data is not read
+                spec['data'] = np.full(ncvariable.shape, 2, dtype=np.int8)
+
+        return specs
 
     def load_config(self, path=None):
         '''
@@ -169,8 +327,7 @@ class GliderQC(object):
         path = path or '/data/qc_config.yml'
         log.info("Loading config from %s", path)
         try:
-            with open(path, 'r') as f:
-                self.config = yaml.safe_load(f.read())
+            self.config = load_qc_config(path)
         except FileNotFoundError:
             log.error("Config file not found at %s", path)
         except yaml.YAMLError as e:
@@ -225,24 +382,28 @@ class GliderQC(object):
         :return: string of report_list of encountered issues
         '''
         report_list = []
+        values = np.asarray(values)
+        # masked array arithmetic is slow, only keep the mask if it is used
+        times = np.asanyarray(times)
+        if not ma.is_masked(times):
+            times = ma.getdata(times)
         if len(values) < 2 or len(times) < 2:
             log.info("Insufficient data: both 'values' and 'times' must have at least two elements.")
             report_list.append("Insufficient data: both 'values' and 'times' must have at least two elements.")
             return None, ' '.join(report_list)
 
-        if np.sum(~np.isnan(values)) > 1:  # Check if there are at least 2 valid values
+        if np.count_nonzero(~np.isnan(values)) > 1:  # Check if there are at least 2 valid values
             std = np.nanstd(values)
             mean = np.nanmean(values)
         else:
             report_list.append("Not enough valid data points for std and mean calculations.")
             return None, ' '.join(report_list)
 
-        list_values = []
-        list_times = []
-        for nn, xx in enumerate(values):
-            if (xx > (mean - std)) and (xx < (mean+std)):
-                list_values.append(values[nn])
-                list_times.append(times[nn])
+        # Keep the values (and their times) within one standard deviation of
+        # the mean, NaNs compare as False and are dropped by the mask
+        in_band = (values > (mean - std)) & (values < (mean + std))
+        list_values = values[in_band]
+        list_times = times[:len(values)][in_band]
 
         # Ensure there are enough data points to compute the rate of change
         if len(list_values) < 2:
@@ -274,7 +435,7 @@ class GliderQC(object):
 
         # Check if there are at least 2 valid values
         # remove nan
-        valid_values = [x for x in values if not np.isnan(x)]
+        valid_values = values[~np.isnan(values)]
 
         if len(valid_values) < 2:
             log.info("Not enough valid data for variance calculation.")
@@ -290,7 +451,7 @@ class GliderQC(object):
         return suspect_threshold, fail_threshold, ' '.join(report_list)
 
     @classmethod
-    def normalize_variable(cls, values, units, standard_name):
+    def normalize_variable(cls, values, units, standard_name, inplace=False):
         '''
         Returns an array of values that are converted into a standard set of
         units. The motivation behind this is so that we compare values of the
@@ -299,19 +460,13 @@ class GliderQC(object):
         :param values: numpy array of values
         :param units: string defining units
         :param standard_name: string defining the variable's CF compliant name
+        :param inplace: bool, convert a float64 values array in place
 
         :return report_list: a string logging issues encountered
         :return converted: numpy array of converted values
         '''
         report_list = []
-        mapping = {
-            'sea_water_temperature': 'deg_C',
-            'sea_water_electrical_conductivity': 'S m-1',
-            'sea_water_salinity': '1',
-            'sea_water_practical_salinity': '1',
-            'sea_water_pressure': 'dbar',
-            'sea_water_density': 'kg m-3'
-        }
+        mapping = cls.STANDARD_UNITS
 
         # Handle conversion of 'psu' to '1' for salinity
         if units == 'psu':
@@ -326,8 +481,21 @@ class GliderQC(object):
         # Get the target unit for conversion
         target_unit = mapping[standard_name]
         try:
-            # Perform the unit conversion (make sure the `Unit` class and its method are correct)
-            converted = Unit(units).convert(values, target_unit)
+            # Perform the unit conversion with the cached scale and offset,
+            # through cf_units if the conversion isn't linear
+            conversion = get_unit_conversion(units, target_unit)
+            if conversion is None:
+                converted = get_unit(units).convert(values, target_unit)
+            else:
+                scale, offset = conversion
+                if scale == 1 and offset == 0:
+                    converted = values
+                elif inplace and isinstance(values, np.ndarray) and values.dtype == np.float64:
+                    converted = values
+                    converted *= scale
+                    converted += offset
+                else:
+                    converted = values * scale + offset
         except Exception as e:
             # log in error if conversion fails
             log.info(f"Failed to convert units from '{units}' to '{target_unit}' for standard name '{standard_name}': {str(e)}")
@@ -336,6 +504,18 @@ class GliderQC(object):
 
         return converted, ' '.join(report_list)
 
+    @staticmethod
+    def masked_to_nan(data):
+        '''
+        Returns a float64 numpy array of the data where masked and fill values
+        are replaced by NaN. The conversion happens in a single vectorized pass
+        over the (masked) array read from the netCDF variable.
+
+        :param data: numpy array or numpy.ma.MaskedArray
+        :return: numpy array of float64 values
+        '''
+        return ma.filled(ma.asarray(data, dtype=np.float64), np.nan)
+
     def append_ancillary_variable(self, parent, child):
         '''
         Links two variables through the ancillary_variables attribute.
@@ -343,6 +523,17 @@ class GliderQC(object):
         :param parent: netCDF.Variable (Parent Variable)
         :param child: netCDF.Variable (Status Flag Variable)
         '''
+        parent.ancillary_variables = self.extend_ancillary_variables(parent, [child.name])
+
+    @staticmethod
+    def extend_ancillary_variables(parent, names):
+        '''
+        Returns the ancillary_variables attribute of a variable with the
+        names appended
+
+        :param parent: netCDF.Variable (Parent Variable)
+        :param names: list of variable names
+        '''
         # Retrieve the current ancillary_variables, defaulting to an empty list if not set
         ancillary_variables = getattr(parent, 'ancillary_variables', None)
 
@@ -352,13 +543,14 @@ class GliderQC(object):
         elif ancillary_variables is None:
             ancillary_variables = []
 
-        # Add the child's name to the list of ancillary variables
-        ancillary_variables.append(child.name)
+        # Add the names to the list of ancillary variables
+        ancillary_variables.extend(names)
 
-        # Save the updated list back as a space-separated string
-        parent.ancillary_variables = ' '.join(ancillary_variables)
+        # Return the updated list as a space-separated string
+        return ' '.join(ancillary_variables)
 
-    def update_config(self, varspec, varname, times, values, time_units):
+    def update_config(self, varspec, varname, times, values, time_units, deployment_stats=None,
+                      file_stats=None):
         '''
          Update the input config file with specs values for the spike
          and the gross range test methods
@@ -368,15 +560,39 @@ class GliderQC(object):
         :param times: numpy array of times
         :param values: numpy array of values
         :param time_units: string defining time units
+        :param deployment_stats: dictionary of the variable's DeploymentStats
+                                 (optional). Once other files of the
+                                 deployment contributed to them, the
+                                 thresholds are derived from the deployment
+                                 instead of this file alone.
+        :param file_stats: dictionary of the statistics of the file's values,
+                           like DeploymentStats.file_statistics (optional),
+                           used instead of times and values when the file is
+                           processed in chunks
 
         :return dictionary with configuration specs for qc
         :return string report_list with encountered issues
         '''
         report_list = []
+        if deployment_stats is not None and deployment_stats['files'] < 2:
+            deployment_stats = None
         # Calculate the spike test threshold
         # do not use the 1st and last data values in calculation
-        values = values[1:-1]
-        (suspect_threshold, fail_threshold, inote) = self.get_spike_thresholds(values)
+        if values is not None:
+            values = values[1:-1]
+        spike_thresholds = None
+        if deployment_stats is not None:
+            spike_thresholds = DeploymentStats.spike_thresholds(deployment_stats)
+        if spike_thresholds is not None:
+            suspect_threshold, fail_threshold = spike_thresholds
+        elif file_stats is not None:
+            suspect_threshold = fail_threshold = None
+            inote = "Not enough valid data for std calculation."
+            spike_thresholds = DeploymentStats.spike_thresholds(file_stats)
+            if spike_thresholds is not None:
+                suspect_threshold, fail_threshold = spike_thresholds
+        else:
+            (suspect_threshold, fail_threshold, inote) = self.get_spike_thresholds(values)
         if suspect_threshold == None or fail_threshold == None:
             report_list.append(f"spike_test dropped for {varname}: {inote}")
             del varspec['spike_test']
@@ -389,7 +605,13 @@ class GliderQC(object):
             varspec['spike_test']['fail_threshold'] = np.float64(fail_threshold)
 
         # Calculate the rate of change test threshold
-        threshold, inote = self.get_rate_of_change_threshold(values, times)
+        if deployment_stats is not None and deployment_stats['roc'] is not None:
+            threshold = deployment_stats['roc']
+        elif file_stats is not None:
+            threshold = file_stats['roc']
+            inote = "Not enough valid data points for the rate of change threshold."
+        else:
+            threshold, inote = self.get_rate_of_change_threshold(values, times)
         if threshold is None:
             report_list.append(f"rate_of_change_test dropped for {varname}: {inote}")
             del varspec['rate_of_change_test']
@@ -451,17 +673,65 @@ class GliderQC(object):
 
         return results_store
 
-    def check_geophysical_variables(self, var_name):
+    def apply_qc_batch(self, df, configset):
+        '''
+        Pass the configuration of all the variables to ioos_qc in a single
+        stream run and split the QC test results back per variable.
+
+        If the combined run fails, each variable is run on its own through
+        apply_qc so a single bad variable does not drop the flags of the others.
+
+        :param df: DataFrame with a time column and one column per variable
+        :param configset: dictionary with the config specs of all variables
+        :return: dictionary of variable name to a DataFrame of QC results laid
+                 out like the one returned by apply_qc
+        '''
+        streams = configset['contexts'][0]['streams']
+        try:
+            store = PandasStore(PandasStream(df).run(Config(configset)))
+        except Exception as e:
+            log.error(f"Error running batched QC tests, running variables one at a time: {e}")
+            return {
+                varname: self.apply_qc(df[['time', varname]], varname,
+                                       {'contexts': [{'streams': {varname: varspec}}]})
+                for varname, varspec in streams.items()
+            }
+
+        # Group the collected results by variable
+        collected = {}
+        for cr in store.collected_results:
+            collected.setdefault(cr.stream_id, []).append(cr)
+
+        results = {}
+        for varname in streams:
+            var_results = collected.get(varname, [])
+            results_store = pd.DataFrame()
+            try:
+                for cr in var_results:
+                    results_store[column_from_collected_result(cr)] = cr.results
+                # Compute the aggregate flag of this variable only
+                results_store['qartod_rollup_qc'] = aggregate(var_results)
+            except Exception as e:
+                log.error(f"Error collecting QC results for {varname}: {e}")
+                results_store = []
+            results[varname] = results_store
+
+        return results
+
+    def check_geophysical_variables(self, var_name, data=None):
         '''
         Check the data array for the specified geophysical variable.
 
         :param var_name: variable name (str)
+        :param data: masked array already read from the variable (optional)
         :return: report_list (str) containing encountered issues
         '''
         report_list = []
 
         # Access the variable
         inp = self.ncfile.variables[var_name]
+        if data is None:
+            data = inp[:]
 
         # Check if valid_min and valid_max are correctly ordered
         if inp.valid_min > inp.valid_max:
@@ -470,7 +740,7 @@ class GliderQC(object):
             return ' '.join(report_list)
 
         # Get unique values once
-        unique_vals = np.unique(inp[:])
+        unique_vals = np.unique(data)
 
         # Check if all values in the array are the same
         if len(unique_vals) == 1:
@@ -498,37 +768,50 @@ class GliderQC(object):
         :returns: netCDF variable, the created location test flag variable.
         '''
         ncvar_name = 'qartod_location_test_flag'
+        apply_qc_results(self.ncfile, {'variables': {
+            ncvar_name: self.location_flag_spec(ndim, flag)
+        }})
+        return self.ncfile.variables[ncvar_name]
+
+    def location_flag_spec(self, ndim, flag):
+        '''
+        Returns the definition of the location test variable, as used by
+        apply_qc_results
 
-        # Create the variable with int8 type and given dimensions
-        ncvar = self.ncfile.createVariable(ncvar_name , np.int8, ndim, fill_value=np.int8(2))
-
-        # Assign flag value to the whole array (assuming flag is a scalar)
-        ncvar[:] = flag
-
-        # Set additional attributes
-        ncvar.units = '1'
-        ncvar.standard_name = 'location_test_quality_flag'
-        ncvar.long_name = 'QARTOD Location Flag for the profile_(lat, lon) variables'
-        ncvar.flag_values = np.array([1, 2, 3, 4, 9], dtype=np.int8)
-        ncvar.valid_min = np.int8(1)
-        ncvar.valid_max = np.int8(9)
-        ncvar.flag_meanings = 'PASS NOT_EVALUATED SUSPECT FAIL MISSING'
-        ncvar.references = (
-            'The GDAC uses a modified version of the location test described in '
-            'https://gliders.ioos.us/files/Manual-for-QC-of-Glider-Data_05_09_16.pdf'
-        )
-        ncvar.qartod_module = (
-            'The GDAC location test does not use the algorithm from '
-            'https://github.com/ioos/ioos_qc/blob/main/ioos_qc/qartod.py (location_test) '
-            'but instead relies on the statistical median of the lat/lon arrays'
-        )
-        ncvar.dac_comment = (
-            'The FAIL flag is applied if the profile_(lat, lon) value exceeds 3 '
-            'standard deviations above the mean of the average lat/lon arrays'
-        )
-        ncvar.ioos_category = 'Quality'
-
-        return ncvar
+        :param ndim: tuple or list, the dimensions of the netCDF variable (e.g., (time, lat, lon)).
+        :param flag: integer, the flag value to assign to the location test variable.
+        '''
+        shape = tuple(len(self.ncfile.dimensions[dim]) for dim in ndim)
+        return {
+            'datatype': 'i1',
+            'dimensions': list(ndim),
+            'fill_value': np.int8(2),
+            'attributes': {
+                'units': '1',
+                'standard_name': 'location_test_quality_flag',
+                'long_name': 'QARTOD Location Flag for the profile_(lat, lon) variables',
+                'flag_values': np.array([1, 2, 3, 4, 9], dtype=np.int8),
+                'valid_min': np.int8(1),
+                'valid_max': np.int8(9),
+                'flag_meanings': 'PASS NOT_EVALUATED SUSPECT FAIL MISSING',
+                'references': (
+                    'The GDAC uses a modified version of the location test described in '
+                    'https://gliders.ioos.us/files/Manual-for-QC-of-Glider-Data_05_09_16.pdf'
+                ),
+                'qartod_module': (
+                    'The GDAC location test does not use the algorithm from '
+                    'https://github.com/ioos/ioos_qc/blob/main/ioos_qc/qartod.py (location_test) '
+                    'but instead relies on the distance to the mean of the lat/lon arrays'
+                ),
+                'dac_comment': (
+                    'The FAIL flag is applied if the profile_(lat, lon) position is more than '
+                    '{} miles from the mean of the lat/lon arrays'.format(self.LOCATION_RADIUS_MILES)
+                ),
+                'ioos_category': 'Quality',
+            },
+            # Assign flag value to the whole array
+            'data': np.full(shape, flag, dtype=np.int8),
+        }
 
     def check_location(self):
         '''
@@ -539,37 +822,103 @@ class GliderQC(object):
 
         :return: report_list: string statement reporting on issues
         '''
+        flag, report = self.location_test()
+
+        # Create location test variable to store the test flag
+        ndim = self.ncfile.variables["profile_lat"].dimensions
+        location_flag_variable = self.create_location_flag_variable(ndim, flag)
+
+        # Store location test variable under the ancillary_variables attribute
+        self.ncfile.variables['profile_lat'].ancillary_variables = location_flag_variable.name
+        self.ncfile.variables['profile_lon'].ancillary_variables = location_flag_variable.name
+
+        return report
+
+    def location_test(self, polygon=False, center=None):
+        '''
+        Returns the location test flag of the profile_lat/lon coordinates and
+        a string statement reporting on issues, without modifying the file
+
+        :param polygon: bool, test the profile location against a shapely
+                        watch circle polygon instead of its distance to the
+                        center of the track
+        :param center: tuple of the (lat, lon) center of the track (optional),
+                       the mean of the lat and lon axes by default
+        '''
         report_list = []
         profile_lat = self.ncfile.variables['profile_lat'][0]
         profile_lon = self.ncfile.variables['profile_lon'][0]
-        lat = self.ncfile.variables['lat'][:]
-        lon = self.ncfile.variables['lon'][:]
+        if center is None:
+            center = np.nanmean(self.axes['lat']), np.nanmean(self.axes['lon'])
+        center_lat, center_lon = center
 
         # Check if lat/lon are not NaN or masked
         if not (np.isnan(profile_lat) or np.ma.is_masked(profile_lat) or np.isnan(profile_lon) or np.ma.is_masked(profile_lon)):
-            poly = self.watch_circle(np.nanmean(lat), np.nanmean(lon), 2.0, num_points=72)
-            set_flag = self.is_point_outside_polygon(profile_lat, profile_lon, poly)
+            if polygon:
+                poly = self.watch_circle(center_lat, center_lon, self.LOCATION_RADIUS_MILES, num_points=72)
+                set_flag = self.is_point_outside_polygon(profile_lat, profile_lon, poly)
+            else:
+                set_flag = self.location_flags(profile_lat, profile_lon, center_lat, center_lon) == 4
 
             if set_flag:
                 flag = 4  # FAIL
-                log.info(f"profile_lat={profile_lat}, profile_lon={profile_lon} are outside the polygon")
+                log.info(f"profile_lat={profile_lat}, profile_lon={profile_lon} are more than "
+                         f"{self.LOCATION_RADIUS_MILES} miles from the track center")
                 report_list.append("error in glider track lat/lon")
             else:
                 flag = 1  # PASS
-                report_list.append(f"profile_lat={profile_lat}, profile_lon={profile_lon} are inside the polygon")
+                report_list.append(f"profile_lat={profile_lat}, profile_lon={profile_lon} are within "
+                                   f"{self.LOCATION_RADIUS_MILES} miles of the track center")
         else:
             flag = 9  # MISSING
             report_list.append(f"profile_lat={profile_lat}, profile_lon={profile_lon} are missing")
 
-        # Create location test variable to store the test flag
-        ndim = self.ncfile.variables["profile_lat"].dimensions
-        location_flag_variable = self.create_location_flag_variable(ndim, flag)
+        return flag, ' '.join(report_list)
 
-        # Store location test variable under the ancillary_variables attribute
-        self.ncfile.variables['profile_lat'].ancillary_variables = location_flag_variable.name
-        self.ncfile.variables['profile_lon'].ancillary_variables = location_flag_variable.name
+    @classmethod
+    def location_distance(cls, lat, lon, center_lat, center_lon):
+        '''
+        Returns the equirectangular distance in miles between the points and
+        the centers, using the same scale as watch_circle. All of the
+        arguments can be numpy arrays.
+
+        :param lat: latitude of the points in degrees
+        :param lon: longitude of the points in degrees
+        :param center_lat: latitude of the centers in degrees
+        :param center_lon: longitude of the centers in degrees
+        '''
+        dlat = np.subtract(lat, center_lat)
+        # wrap the longitude difference across the antimeridian
+        dlon = (np.subtract(lon, center_lon) + 180) % 360 - 180
+        miles_per_deg_lon = cls.MILES_PER_DEG_LAT * np.maximum(np.abs(np.cos(np.radians(center_lat))), 1e-12)
+        return np.hypot(dlat * cls.MILES_PER_DEG_LAT, dlon * miles_per_deg_lon)
 
-        return ' '.join(report_list)
+    @classmethod
+    def location_flags(cls, lat, lon, center_lat, center_lon, radius_miles=None):
+        '''
+        Returns the location test flags of profile positions: FAIL (4) if the
+        position is farther than the radius from the center of its track,
+        PASS (1) if it is within and MISSING (9) if any coordinate is missing.
+        The positions of many profiles or files are tested at once when the
+        arguments are arrays.
+
+        :param lat: profile latitudes in degrees
+        :param lon: profile longitudes in degrees
+        :param center_lat: track center latitudes in degrees
+        :param center_lon: track center longitudes in degrees
+        :param radius_miles: radius of the watch circle, LOCATION_RADIUS_MILES by default
+        '''
+        if radius_miles is None:
+            radius_miles = cls.LOCATION_RADIUS_MILES
+        coords = [np.asarray(ma.filled(c, np.nan), dtype=np.float64)
+                  for c in (lat, lon, center_lat, center_lon)]
+        with np.errstate(invalid='ignore'):
+            distance = cls.location_distance(*coords)
+            outside = distance >= radius_miles
+        # NaN coordinates give NaN distances
+        missing = np.isnan(distance)
+        flags = np.where(missing, 9, np.where(outside, 4, 1)).astype(np.int8)
+        return flags if flags.ndim else flags[()]
 
     def watch_circle(self, center_lat, center_lon, radius_miles, num_points=128):
         """
@@ -578,7 +927,7 @@ class GliderQC(object):
         Suitable for small radii like 2 miles.
         """
         # 1 degree latitude ≈ 69.172 miles
-        miles_per_deg_lat = 69.172
+        miles_per_deg_lat = self.MILES_PER_DEG_LAT
         delta_lat_deg = radius_miles / miles_per_deg_lat
 
         lat_rad = math.radians(center_lat)
@@ -606,6 +955,8 @@ class GliderQC(object):
         polygon_points: list of (lat, lon) tuples (closed: first==last or not)
         shapely expects (lon, lat) ordering
         '''
+        if Polygon is None:
+            raise ImportError("shapely is required for the polygon location test")
         poly = Polygon([(lon, lat) for lat, lon in polygon_points])
         pt = Point(point_lon, point_lat)
         return not poly.contains(pt)
@@ -674,161 +1025,1503 @@ class GliderQC(object):
 
         return ' '.join(report_list)
 
+class DeploymentStats(object):
+    '''
+    Running statistics of the geophysical variables of a deployment, used to
+    derive the spike and rate of change thresholds from all of the files of
+    the deployment instead of only the file being processed.
+
+    The statistics are stored in redis per deployment directory. Each file
+    contributes a partial (sample count, mean and sum of squared deviations,
+    combined with Chan's parallel form of Welford's algorithm, and its rate
+    of change threshold) which is merged into the deployment totals as the
+    file is processed, so earlier files never have to be read again.
+    '''
+    def __init__(self, deployment_dir, connection=None):
+        '''
+        :param deployment_dir: string defining path to the deployment directory
+        :param connection: redis connection (optional)
+        '''
+        self.key = DEPLOYMENT_STATS_KEY + deployment_dir
+        self._connection = connection
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = get_redis_connection()
+        return self._connection
+
+    @staticmethod
+    def file_statistics(values, times):
+        '''
+        Returns the partial statistics of a variable for a single file
+
+        :param values: numpy array of values (NaN for missing values)
+        :param times: numpy array of times
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        valid_values = values[~np.isnan(values)]
+        n = len(valid_values)
+        mean = float(np.mean(valid_values)) if n else 0.0
+        m2 = float(np.sum((valid_values - mean) ** 2)) if n else 0.0
+        roc, _ = GliderQC(None).get_rate_of_change_threshold(values, times)
+        return {
+            'files': 1,
+            'n': n,
+            'mean': mean,
+            'm2': m2,
+            'roc': None if roc is None else float(roc),
+        }
+
+    @staticmethod
+    def merge_statistics(a, b):
+        '''
+        Returns the statistics of the union of the samples of a and b. The
+        rate of change threshold is the largest threshold of any file.
+        '''
+        if a is None:
+            return dict(b)
+        n = a['n'] + b['n']
+        if n:
+            delta = b['mean'] - a['mean']
+            mean = a['mean'] + delta * b['n'] / n
+            m2 = a['m2'] + b['m2'] + delta ** 2 * a['n'] * b['n'] / n
+        else:
+            mean = m2 = 0.0
+        rocs = [roc for roc in (a['roc'], b['roc']) if roc is not None]
+        return {
+            'files': a['files'] + b['files'],
+            'n': n,
+            'mean': mean,
+            'm2': m2,
+            'roc': max(rocs) if rocs else None,
+        }
+
+    @staticmethod
+    def spike_thresholds(stats):
+        '''
+        Returns the spike test (suspect_threshold, fail_threshold) of the
+        statistics, like GliderQC.get_spike_thresholds, or None
+        '''
+        if stats['n'] < 2:
+            return None
+        std = math.sqrt(stats['m2'] / stats['n'])
+        return np.float64(1.0 * std), np.float64(2.0 * std)
+
+    def totals(self):
+        '''
+        Returns a dictionary of the deployment statistics of each variable or
+        None if they can't be read
+        '''
+        try:
+            totals = self.connection.hgetall(self.key)
+        except redis.RedisError:
+            log.exception("Could not read the deployment statistics %s", self.key)
+            return None
+        return {name.decode('utf-8'): json.loads(value) for name, value in totals.items()}
+
+    def totals_excluding(self, file_name):
+        '''
+        Returns a dictionary of the deployment statistics of each variable
+        without the contribution of a file, merged from the partials of the
+        other files in file name order, or None if they can't be read.
+        Unlike totals, they don't change when the file itself is merged, so
+        they can be part of the QC cache key of the file.
+
+        :param file_name: string defining the netCDF file name
+        '''
+        try:
+            partials = self.connection.hgetall(self.key + ':files')
+        except redis.RedisError:
+            log.exception("Could not read the deployment statistics %s", self.key)
+            return None
+        totals = {}
+        excluded = file_name.encode('utf-8')
+        for name in sorted(partials):
+            if name == excluded:
+                continue
+            for var_name, stats in json.loads(partials[name]).items():
+                totals[var_name] = self.merge_statistics(totals.get(var_name), stats)
+        return totals
+
+    def merge(self, file_name, file_stats):
+        '''
+        Merges the statistics of a file into the deployment and returns the
+        updated deployment statistics, or None if they can't be updated.
+        A file which was already merged is only merged again if its
+        statistics changed, in which case the totals are rebuilt from the
+        partials of every file.
+
+        :param file_name: string defining the netCDF file name
+        :param file_stats: dictionary of variable name to file_statistics
+        '''
+        files_key = self.key + ':files'
+        try:
+            with self.connection.lock(self.key + ':lock', timeout=60, blocking_timeout=30):
+                previous = self.connection.hget(files_key, file_name)
+                previous = json.loads(previous) if previous is not None else None
+                if previous == file_stats:
+                    return self.totals()
+
+                if previous is None:
+                    totals = self.totals() or {}
+                    for var_name, stats in file_stats.items():
+                        totals[var_name] = self.merge_statistics(totals.get(var_name), stats)
+                else:
+                    # The file was replaced, rebuild the totals from the
+                    # partials of all of the files
+                    log.info("Statistics of %s changed, rebuilding %s", file_name, self.key)
+                    partials = self.connection.hgetall(files_key)
+                    partials[file_name.encode('utf-8')] = json.dumps(file_stats)
+                    totals = {}
+                    for partial in partials.values():
+                        for var_name, stats in json.loads(partial).items():
+                            totals[var_name] = self.merge_statistics(totals.get(var_name), stats)
+
+                pipeline = self.connection.pipeline()
+                pipeline.hset(files_key, file_name, json.dumps(file_stats))
+                pipeline.delete(self.key)
+                if totals:
+                    pipeline.hset(self.key, mapping={name: json.dumps(stats) for name, stats in totals.items()})
+                pipeline.execute()
+                return totals
+        except redis.RedisError:
+            log.exception("Could not update the deployment statistics %s", self.key)
+            return None
+
 # the main function
-def run_qc(config, ncfile, ncfile_path):
+class ClassicFileWriter(object):
+    '''
+    Writes a copy of a classic netCDF file with QC results applied.
+
+    Everything is defined in a single pass before any data is written. The
+    records of a classic file interleave the record variables, so writing
+    them through netCDF a variable at a time rewrites every block of the
+    file once per variable. netCDF instead lays out the records a block at a
+    time in memory and each block is appended to the file, after the header
+    and the fixed size variables written by netCDF.
+    '''
+    # Size of the blocks of records laid out in memory
+    BLOCK_BYTES = 8 * 1024 * 1024
+
+    def __init__(self, src, path, results):
+        '''
+        :param src: netCDF4._netCDF4.Dataset
+        :param path: string defining path to the new netCDF file
+        :param results: dictionary returned by compute_qc or
+                        snapshot_qc_results, the records of the QC variables
+                        without data are written with write_records
+        '''
+        self.src = src
+        self.path = path
+        self.data_model = src.data_model
+        self.record_dim = next((name for name, dim in src.dimensions.items() if dim.isunlimited()), None)
+        self.size = len(src.dimensions[self.record_dim]) if self.record_dim is not None else 0
+        self.numrecs = 0
+        self.attributes = {attr: src.getncattr(attr) for attr in src.ncattrs()}
+        if 'dac_qc_comment' in results:
+            self.attributes['dac_qc_comment'] = results['dac_qc_comment']
+
+        qc_variables = results['variables']
+        ancillary_variables = results.get('ancillary_variables', {})
+        # The data of each variable is its QC results, the source variable
+        # or None when it is written by the caller
+        self.definitions = []
+        for name, ncvar in src.variables.items():
+            attributes = {attr: ncvar.getncattr(attr) for attr in ncvar.ncattrs()}
+            fill_value = attributes.pop('_FillValue', None)
+            data = ncvar
+            if name in qc_variables:
+                spec = qc_variables[name]
+                attributes.update({attr: _decode_nc_value(value) for attr, value in spec['attributes'].items()})
+                data = _decode_nc_value(spec['data']) if 'data' in spec else None
+            if name in ancillary_variables:
+                attributes['ancillary_variables'] = ancillary_variables[name]
+            self.definitions.append((name, ncvar.dtype, ncvar.dimensions, fill_value, attributes, data))
+        for name, spec in qc_variables.items():
+            if name in src.variables:
+                continue
+            fill_value = spec['fill_value']
+            self.definitions.append((name, np.dtype(spec['datatype']), tuple(spec['dimensions']),
+                                     None if fill_value is None else _decode_nc_value(fill_value),
+                                     {attr: _decode_nc_value(value) for attr, value in spec['attributes'].items()},
+                                     _decode_nc_value(spec['data']) if 'data' in spec else None))
+
+        # The size of a record: the size of a record of each variable,
+        # padded to 4 bytes unless there is a single record variable
+        record_sizes = [
+            np.dtype(datatype).itemsize * int(np.prod([len(src.dimensions[dim]) for dim in dimensions[1:]]))
+            for name, datatype, dimensions, fill_value, attributes, data in self.definitions
+            if self.is_record_variable(dimensions)
+        ]
+        if len(record_sizes) == 1:
+            self.recsize = record_sizes[0]
+        else:
+            self.recsize = sum(size + -size % 4 for size in record_sizes)
+        if not record_sizes:
+            # written through netCDF like any fixed size variables
+            self.record_dim = None
+
+        self.dataset = self.create(path)
+        try:
+            self.dataset.set_fill_off()
+            with self.as_stored():
+                for name, datatype, dimensions, fill_value, attributes, data in self.definitions:
+                    if data is None or self.is_record_variable(dimensions):
+                        continue
+                    if isinstance(data, Variable):
+                        data = data.getValue() if not dimensions else data[:]
+                    if not dimensions:
+                        self.dataset.variables[name].assignValue(data)
+                    elif np.size(data):
+                        self.dataset.variables[name][:] = data
+        except BaseException:
+            self.dataset.close()
+            raise
+        if self.record_dim is not None:
+            self.dataset.close()
+            self.dataset = None
+            self.file = open(path, 'r+b')
+            self.begin = classic_records_offset(self.file.read())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def create(self, path, **kwargs):
+        '''
+        Creates a netCDF file with the definitions of the copy
+        '''
+        dst = Dataset(path, 'w', format=self.data_model, **kwargs)
+        dst.set_auto_maskandscale(False)
+        dst.set_auto_chartostring(False)
+        for name, dim in self.src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        dst.setncatts(self.attributes)
+        for name, datatype, dimensions, fill_value, attributes, data in self.definitions:
+            ncvar = dst.createVariable(name, datatype, dimensions, fill_value=fill_value)
+            ncvar.setncatts(attributes)
+        return dst
+
+    @contextmanager
+    def as_stored(self):
+        '''
+        Reads the data of the source file as it is stored
+        '''
+        self.src.set_auto_maskandscale(False)
+        self.src.set_auto_chartostring(False)
+        try:
+            yield
+        finally:
+            self.src.set_auto_maskandscale(True)
+            self.src.set_auto_chartostring(True)
+
+    def is_record_variable(self, dimensions):
+        return bool(dimensions) and dimensions[0] == self.record_dim
+
+    def write_records(self, start=0, stop=None, data=None):
+        '''
+        Writes the records from start to stop, after the records written
+        before. The records of the variables not in data are those of their
+        QC results or of the source file.
+
+        :param start: index of the first record
+        :param stop: index after the last record, the number of records of
+                     the source file by default
+        :param data: dictionary of QC variable names to their records (optional)
+        '''
+        if stop is None:
+            stop = self.size
+        data = data or {}
+        if self.record_dim is None:
+            for name, values in data.items():
+                self.dataset.variables[name][start:stop] = values
+            return
+        record_variables = {name: dimensions for name, datatype, dimensions, fill_value, attributes, values
+                            in self.definitions if self.is_record_variable(dimensions)}
+        for name in data:
+            if name not in record_variables:
+                raise ValueError(f"{name} is not along the record dimension of {self.path}")
+        block_records = max(1, self.BLOCK_BYTES // max(self.recsize, 1))
+        for block_start, block_stop in chunk_slices(stop - start, block_records):
+            self.write_block(start + block_start, start + block_stop,
+                             {name: values[block_start:block_stop] for name, values in data.items()})
+
+    def write_block(self, start, stop, data):
+        '''
+        Lays out a block of records in memory and writes it to the file
+        '''
+        n = stop - start
+        block = self.create('records.nc', memory=self.begin + n * self.recsize)
+        # every record variable is written, filling them first would double
+        # the time spent laying them out
+        block.set_fill_off()
+        try:
+            with self.as_stored():
+                for name, datatype, dimensions, fill_value, attributes, values in self.definitions:
+                    if not self.is_record_variable(dimensions):
+                        continue
+                    if name in data:
+                        values = data[name]
+                    elif values is None:
+                        shape = (n,) + tuple(len(self.src.dimensions[dim]) for dim in dimensions[1:])
+                        if fill_value is None:
+                            fill_value = default_fillvals[np.dtype(datatype).str[1:]]
+                        values = np.full(shape, fill_value, dtype=datatype)
+                    else:
+                        values = values[start:stop]
+                    block.variables[name][:n] = values
+        except BaseException:
+            block.close()
+            raise
+        records = block.close()
+        # The memory can be larger than the file
+        if len(records) < self.begin + n * self.recsize:
+            raise ValueError(f"Unexpected layout of the records of {self.path}")
+        self.file.seek(self.begin + start * self.recsize)
+        self.file.write(records[self.begin:self.begin + n * self.recsize])
+        self.numrecs = max(self.numrecs, stop)
+
+    def close(self):
+        '''
+        Closes the file, updating the number of records of its header
+        '''
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+        elif not self.file.closed:
+            self.file.seek(4)
+            numrecs_type = '>i8' if self.data_model == 'NETCDF3_64BIT_DATA' else '>i4'
+            self.file.write(np.array(self.numrecs, dtype=numrecs_type).tobytes())
+            # netCDF can leave data past the records when defining the file
+            self.file.truncate(self.begin + self.numrecs * self.recsize)
+            self.file.close()
+
+
+def classic_records_offset(header):
+    '''
+    Returns the offset of the records of a classic netCDF file, read from
+    the begin of its first record variable in its header, as described in
+    https://docs.unidata.ucar.edu/netcdf-c/current/file_format_specifications.html
+
+    :param header: bytes of the start of the file, including the header
+    '''
+    # sizes of the values of the attribute types
+    type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+    version = header[3]
+    # counts and lengths are 64-bit in CDF-5, offsets in CDF-2 and CDF-5
+    size = 8 if version == 5 else 4
+    offset_size = 4 if version == 1 else 8
+    pos = 4 + size
+
+    def read(n):
+        nonlocal pos
+        pos += n
+        return int.from_bytes(header[pos - n:pos], 'big')
+
+    def skip_name():
+        nonlocal pos
+        length = read(size)
+        pos += length + -length % 4
+
+    def skip_attributes():
+        nonlocal pos
+        read(4)
+        for _ in range(read(size)):
+            skip_name()
+            nc_type = read(4)
+            length = read(size) * type_sizes[nc_type]
+            pos += length + -length % 4
+
+    record_dim = None
+    read(4)
+    for dimid in range(read(size)):
+        skip_name()
+        if read(size) == 0:
+            record_dim = dimid
+    skip_attributes()
+    read(4)
+    for _ in range(read(size)):
+        skip_name()
+        dimids = [read(size) for _ in range(read(size))]
+        skip_attributes()
+        read(4)
+        read(size)
+        begin = read(offset_size)
+        if dimids and dimids[0] == record_dim:
+            return begin
+    raise ValueError("The file has no record variables")
+
+def run_qc(config, ncfile, ncfile_path, deployment_stats=None):
     '''
     Runs IOOS QARTOD tests on a netCDF file
 
     :param config: string defining path to the configuration file
     :param ncfile_path: string defining path to the netCDF file
     :param ncfile: netCDF4._netCDF4.Dataset
+    :param deployment_stats: DeploymentStats of the file's deployment
+                             (optional), the file is merged into them and the
+                             thresholds are derived from the deployment
+    '''
+    results = compute_qc(config, ncfile, ncfile_path, deployment_stats)
+    apply_qc_results(ncfile, results)
+
+def compute_qc(config, ncfile, ncfile_path, deployment_stats=None, timings=None):
+    '''
+    Runs IOOS QARTOD tests on a netCDF file and returns the QC results
+    without modifying the file: the definitions and data of the qartod flag
+    variables, the updated ancillary_variables of their parent variables and
+    the dac_qc_comment, as used by apply_qc_results and write_qc_results
+
+    :param config: string defining path to the configuration file
+    :param ncfile_path: string defining path to the netCDF file
+    :param ncfile: netCDF4._netCDF4.Dataset
+    :param deployment_stats: DeploymentStats of the file's deployment (optional)
+    :param timings: StageTimings recording the time spent in each stage (optional)
     '''
     report_list = []
+    results = {'variables': {}, 'ancillary_variables': {}}
     xyz = GliderQC(ncfile, config)
-    deployment_name = ncfile_path.split('/')[-2]
+    if timings is not None:
+        xyz.timings = timings
+    stage = xyz.timings.stage
     file_name = ncfile_path.split('/')[-1]
 
-    times = ncfile.variables['time']
+    time_units = ncfile.variables['time'].units
     # Check Time
     try:
-        inote = xyz.check_time(times[:].astype('datetime64[s]'), ncfile_path)
+        with stage('read'):
+            times = xyz.axes['time']
+        with stage('check_time', len(times)):
+            inote = xyz.check_time(times, ncfile_path)
         report_list.append(inote)
     except Exception as e:
-        time_err = "Could not check time."
-        log.exception(f"{time_err}: {str(e)}")
-        report_list.append(f"{time_err}: {str(e)}")
+        report_error(report_list, "Could not check time.", e)
 
     # log time array issues
     report = ' '.join(report_list).strip()
-    if len(report.strip()) != 0:
-        ncfile.dac_qc_comment = str(deployment_name) + ' (' + str(file_name) + ': ' + report + ')'
-    else:
+    if len(report.strip()) == 0:
         log.info(" Running IOOS QARTOD tests on %s", file_name)
 
         # Check Location (lat/lon)
-        if 'qartod_location_test_flag' not in ncfile.variables:
-            try:
-                report_list.append(xyz.check_location())
-            except Exception as e:
-                location_err = "Could not check location."
-                log.exception(f"{location_err}: {str(e)}")
-                report_list.append(f"{location_err}: {str(e)}")
-
-        # Find geophysical variables
-        legacy_variables, note = xyz.find_geophysical_variables()
-        if not legacy_variables:
-            log.info("No variables found.")
-            report_list.append("No variables found.")
+        check_location_flag(xyz, results, report_list)
+
+        # Loop through the legacy variables and prepare them for QARTOD,
+        # the tests are then run for all of them in a single ioos_qc pass
+        prepared = {}
+        for var_name in find_qc_variables(xyz, report_list):
+            var_data = ncfile.variables[var_name]
+            # Read the variable once, the masked array is kept for the
+            # data array checks and the NaN filled buffer is used for QC
+            with stage('read', var_data.size):
+                raw_data = var_data[:]
+                values = xyz.masked_to_nan(raw_data)
+
+            # Define the QARTOD variables
+            define_qc_variables(xyz, var_data, results)
+
+            # Check the Data Array
+            with stage('check_data', len(values)):
+                note = xyz.check_geophysical_variables(var_name, raw_data)
+            if note:
+                report_list.append(note)
+                continue
+
+            # Check the mapping of standard names with units, values is a
+            # buffer of its own and is converted in place
+            with stage('normalize_variable', len(values)):
+                values = normalize_qc_values(xyz, var_data, values, report_list)
+            if values is not None:
+                prepared[var_name] = values
+
+        # Merge the statistics of this file into the deployment's
+        if deployment_stats is not None and prepared:
+            with stage('deployment_stats'):
+                deployment_totals = deployment_stats.merge(file_name, {
+                    var_name: DeploymentStats.file_statistics(values[1:-1], times)
+                    for var_name, values in prepared.items()
+                })
         else:
-            log.info("Found %s variables for QARTOD tests: %s", str(len(legacy_variables)), legacy_variables)
-            # Report legacy variables issues
-            report_list.append(note)
+            deployment_totals = None
+
+        # Update the variable config sets
+        streams = qartod_streams(xyz, prepared, time_units, deployment_totals, report_list, times)
+        describe_qartod_flags(results, streams)
+
+        if streams:
+            # create a single dataframe keyed on time for the QARTOD process
+            data = {'time': times}
+            data.update((var_name, prepared[var_name]) for var_name in streams)
+            df = pd.DataFrame(data)
+            with stage('apply_qc', len(df) * len(streams)):
+                all_results = xyz.apply_qc_batch(df, {'contexts': [{'streams': streams}]})
+            for qartodname, flags in qartod_flags(all_results, streams, report_list).items():
+                results['variables'][qartodname]['data'] = flags
+
+    results['dac_qc_comment'] = dac_qc_comment(ncfile_path, report_list)
+    return results
+
+def report_error(report_list, message, error):
+    '''
+    Logs an error of the QC of a file and adds it to the report
 
-            # Loop through the legacy variables and apply QARTOD
-            for var_name in legacy_variables:
-                var_data = ncfile.variables[var_name]
-                values = [x if x != '--' else np.nan for x in var_data[:]]
+    :param report_list: list of the notes of the QC report
+    :param message: string describing the failed step
+    :param error: the exception raised, or a string describing it
+    '''
+    log.exception(f"{message}: {str(error)}")
+    report_list.append(f"{message}: {str(error)}")
 
-                # Create the QARTOD variables
-                qcvarname = xyz.create_qc_variables(var_data)
-                log.info("Created %s QC Variables for %s", str(len(qcvarname)), var_name)
+def dac_qc_comment(nc_path, report_list):
+    '''
+    Returns the dac_qc_comment attribute of a file from the notes of its QC
+    report
 
-                # Check the Data Array
-                if xyz.check_geophysical_variables(var_name): #cfile,
-                    report_list.append(xyz.check_geophysical_variables(var_name))
-                    continue
+    :param nc_path: string defining path to the netCDF file
+    :param report_list: list of the notes of the QC report
+    '''
+    deployment_name = nc_path.split('/')[-2]
+    file_name = nc_path.split('/')[-1]
+    report = ' '.join(report_list).strip()
+    return str(deployment_name) + ' (' + str(file_name) + ': ' + str(report) + ')'
+
+def check_location_flag(qc, results, report_list, center=None):
+    '''
+    Runs the location test of a file which doesn't have a location flag yet
+    and adds the flag variable to the QC results
+
+    :param qc: GliderQC of the file
+    :param results: dictionary of the QC results, as returned by compute_qc
+    :param report_list: list of the notes of the QC report
+    :param center: function returning the (lat, lon) center of the track
+                   (optional), the mean of the lat and lon axes by default
+    '''
+    if 'qartod_location_test_flag' in qc.ncfile.variables:
+        return
+    try:
+        with qc.timings.stage('check_location'):
+            flag, note = qc.location_test(center=center() if center is not None else None)
+        report_list.append(note)
+        # Create location test variable to store the test flag
+        ndim = qc.ncfile.variables['profile_lat'].dimensions
+        results['variables']['qartod_location_test_flag'] = qc.location_flag_spec(ndim, flag)
+        # Store location test variable under the ancillary_variables attribute
+        results['ancillary_variables']['profile_lat'] = 'qartod_location_test_flag'
+        results['ancillary_variables']['profile_lon'] = 'qartod_location_test_flag'
+    except Exception as e:
+        report_error(report_list, "Could not check location.", e)
 
-                # Check the mapping of standard names with units
-                try:
-                    values, note = xyz.normalize_variable(np.array(values[:]), var_data.units, var_data.standard_name)
-                    report_list.append(note)
-                    if values is None:
+def find_qc_variables(qc, report_list):
+    '''
+    Returns the names of the geophysical variables of a file to run the
+    QARTOD tests on and reports on them
+
+    :param qc: GliderQC of the file
+    :param report_list: list of the notes of the QC report
+    '''
+    legacy_variables, note = qc.find_geophysical_variables()
+    if not legacy_variables:
+        log.info("No variables found.")
+        report_list.append("No variables found.")
+        return []
+    log.info("Found %s variables for QARTOD tests: %s", str(len(legacy_variables)), legacy_variables)
+    # Report legacy variables issues
+    report_list.append(note)
+    return legacy_variables
+
+def define_qc_variables(qc, ncvariable, results, with_data=True):
+    '''
+    Adds the QC flag variables of a variable to the QC results and lists
+    them under its ancillary_variables
+
+    :param qc: GliderQC of the file
+    :param ncvariable: netCDF4.Variable
+    :param results: dictionary of the QC results, as returned by compute_qc
+    :param with_data: bool, include the data of the flags
+    '''
+    var_specs = qc.qc_variable_specs(ncvariable, with_data)
+    results['variables'].update(var_specs)
+    results['ancillary_variables'][ncvariable.name] = qc.extend_ancillary_variables(ncvariable, list(var_specs))
+    log.info("Created %s QC Variables for %s", str(len(var_specs)), ncvariable.name)
+
+def normalize_qc_values(qc, ncvariable, values, report_list):
+    '''
+    Returns the values of a variable converted in place to the units of the
+    QARTOD tests, or None if they can't be, and reports on the conversion
+
+    :param qc: GliderQC of the file
+    :param ncvariable: netCDF4.Variable the values were read from
+    :param values: float64 numpy array of the values
+    :param report_list: list of the notes of the QC report
+    '''
+    try:
+        values, note = qc.normalize_variable(values, ncvariable.units, ncvariable.standard_name, inplace=True)
+    except Exception as e:
+        report_error(report_list, "Could not normalize data: unit conversion failed.", e)
+        return None
+    report_list.append(note)
+    return values
+
+def qartod_streams(qc, prepared, time_units, deployment_totals, report_list, times=None):
+    '''
+    Returns the ioos_qc streams of the prepared variables, with the spike
+    and rate of change thresholds updated by GliderQC.update_config
+
+    :param qc: GliderQC of the file
+    :param prepared: dictionary of the variable names to their normalized
+                     values or, when times is None, to their running
+                     statistics (see DeploymentStats.file_statistics)
+    :param time_units: string defining the units of the time axis
+    :param deployment_totals: dictionary of the deployment statistics of
+                              the variables (optional)
+    :param report_list: list of the notes of the QC report
+    :param times: time axis of the values (optional)
+    '''
+    streams = {}
+    for var_name, prepared_var in prepared.items():
+        var_spec = qc.config['contexts'][0]['streams'][var_name]['qartod']
+        var_totals = (deployment_totals or {}).get(var_name)
+        if times is None:
+            with qc.timings.stage('update_config'):
+                config_set, note = qc.update_config(var_spec, var_name, None, None, time_units, var_totals,
+                                                    file_stats=prepared_var)
+        else:
+            with qc.timings.stage('update_config', len(prepared_var)):
+                config_set, note = qc.update_config(var_spec, var_name, times, prepared_var, time_units,
+                                                    var_totals)
+        report_list.append(note)
+        streams.update(config_set['contexts'][0]['streams'])
+    return streams
+
+def describe_qartod_flags(results, streams):
+    '''
+    Sets the qartod_test and qartod_config attributes of the QC flag
+    variables of the tests of the streams
+
+    :param results: dictionary of the QC results, as returned by compute_qc
+    :param streams: dictionary of the ioos_qc streams returned by qartod_streams
+    '''
+    for var_name, var_stream in streams.items():
+        varspec = var_stream['qartod']
+        for testname in ['qartod_' + test for test in varspec] + ['qartod_rollup_qc']:
+            qartodname, testconfig = qartod_flag_variable(var_name, testname, varspec)
+            if qartodname not in results['variables']:
+                continue
+            attributes = results['variables'][qartodname]['attributes']
+            attributes['qartod_test'] = testname.split('qartod_')[-1]
+            # Set the dictionary as a string attribute to the variable
+            attributes['qartod_config'] = json.dumps(testconfig)
+
+def qartod_flags(all_results, streams, report_list, window=None):
+    '''
+    Returns a dictionary of the QC flag variable names to their flags from
+    the results of GliderQC.apply_qc_batch, reporting the variables whose
+    flags could not be calculated
+
+    :param all_results: dictionary returned by GliderQC.apply_qc_batch
+    :param streams: dictionary of the ioos_qc streams the tests were run with
+    :param report_list: list of the notes of the QC report
+    :param window: tuple of the (start, stop) samples the results are for
+                   (optional), added to the report of errors
+    '''
+    flags = {}
+    for var_name, var_stream in streams.items():
+        try:
+            var_results = all_results[var_name]
+            log.info("Generated QC test results for %s", var_name)
+            for testname in var_results.columns:
+                qartodname, _ = qartod_flag_variable(var_name, testname, var_stream['qartod'])
+                flags[qartodname] = np.array(var_results[testname].values)
+        except Exception as e:
+            apply_qc_err = "apply_qc failed: could not calculate QC flags."
+            log.exception(f"{apply_qc_err}: ")
+            report_list.append(f"{apply_qc_err}: {str(e)}" + ('' if window is None else ' ({}:{})'.format(*window)))
+    return flags
+
+def chunk_slices(size, chunk_size):
+    '''
+    Yields the (start, stop) indices of consecutive chunks of an axis
+
+    :param size: length of the axis
+    :param chunk_size: number of samples per chunk
+    '''
+    for start in range(0, size, chunk_size):
+        yield start, min(start + chunk_size, size)
+
+def check_time_chunked(qc, time_var, nc_path, chunk_size):
+    '''
+    Runs GliderQC.check_time over the time variable one chunk at a time,
+    each chunk prefixed by the last time of the previous one so that
+    duplicates and out of order times are caught across chunks. If a chunk
+    fails, the whole time axis is checked to report the issue as
+    GliderQC.check_time does.
+
+    :param qc: GliderQC of the file
+    :param time_var: netCDF4.Variable of the time axis
+    :param nc_path: string defining path to the netCDF file
+    :param chunk_size: number of samples per chunk
+    '''
+    previous = None
+    for start, stop in chunk_slices(len(time_var), chunk_size):
+        times = time_var[start:stop].astype('datetime64[s]')
+        if previous is not None:
+            times = ma.concatenate([previous, times])
+        if qc.check_time(times, nc_path):
+            return qc.check_time(time_var[:].astype('datetime64[s]'), nc_path)
+        previous = times[-1:]
+    return ''
+
+def run_qc_chunked(config, nc_path, chunk_size=None, deployment_stats=None, timings=None):
+    '''
+    Runs IOOS QARTOD tests on a netCDF file and writes the QC results to it
+    one window of the time axis at a time, for files too large to be QC'd at
+    once. Memory use depends on the chunk size instead of the file length.
+
+    The spike and rate of change thresholds are computed from running
+    statistics of the whole file, accumulated chunk by chunk. The tests then
+    run on windows of chunk_size samples extended with the preceding samples
+    the flat line test looks back on and a sample on either side for the
+    spike and rate of change tests, and the flags of the window are written
+    to the file. The flat line test converts its thresholds to a number of
+    samples with the median sampling interval of each window instead of the
+    whole file. The checks and the QC variables are otherwise the same as
+    compute_qc's.
+
+    Like write_qc_results, classic files are rebuilt by ClassicFileWriter
+    into a temporary file which then replaces the original (see
+    replace_file), the flags and the original records written window by
+    window. netCDF-4 files are updated in place.
+
+    :param config: string defining path to the configuration file
+    :param nc_path: string defining path to the netCDF file
+    :param chunk_size: number of samples per window, QC_CHUNK_SIZE by default
+    :param deployment_stats: DeploymentStats of the file's deployment (optional)
+    :param timings: StageTimings recording the time spent in each stage (optional)
+    '''
+    if chunk_size is None:
+        chunk_size = QC_CHUNK_SIZE
+    report_list = []
+    file_name = nc_path.split('/')[-1]
+    with Dataset(nc_path, 'r') as nc:
+        classic = nc.data_model.startswith('NETCDF3')
+    with Dataset(nc_path, 'r' if classic else 'r+') as ncfile:
+        xyz = GliderQC(ncfile, config)
+        if timings is not None:
+            xyz.timings = timings
+        stage = xyz.timings.stage
+        time_var = ncfile.variables['time']
+        size = len(time_var)
+        time_units = time_var.units
+
+        try:
+            with stage('check_time', size):
+                inote = check_time_chunked(xyz, time_var, nc_path, chunk_size)
+            report_list.append(inote)
+        except Exception as e:
+            report_error(report_list, "Could not check time.", e)
+
+        def read_values(var_name, start, stop):
+            var_data = ncfile.variables[var_name]
+            with stage('read', stop - start):
+                raw_data = var_data[start:stop]
+                values = xyz.masked_to_nan(raw_data)
+            with stage('normalize_variable', stop - start):
+                values, _ = xyz.normalize_variable(values, var_data.units, var_data.standard_name,
+                                                   inplace=True)
+            return raw_data, values
+
+        results = {'variables': {}, 'ancillary_variables': {}}
+        streams = {}
+        report = ' '.join(report_list).strip()
+        if len(report) == 0:
+            log.info(" Running chunked IOOS QARTOD tests on %s", file_name)
+
+            def track_center():
+                # Center of the track from running sums of the axes
+                sums = np.zeros(2)
+                counts = np.zeros(2)
+                for start, stop in chunk_slices(size, chunk_size):
+                    for i, name in enumerate(('lat', 'lon')):
+                        values = xyz.masked_to_nan(ncfile.variables[name][start:stop])
+                        sums[i] += np.nansum(values)
+                        counts[i] += np.count_nonzero(~np.isnan(values))
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    return tuple(sums / counts)
+
+            check_location_flag(xyz, results, report_list, track_center)
+            legacy_variables = find_qc_variables(xyz, report_list)
+
+            # First pass: check the data arrays and accumulate the mean and
+            # variance of the values, dropping the first and last values
+            # like update_config
+            prepared = {}
+            for var_name in legacy_variables:
+                var_data = ncfile.variables[var_name]
+                define_qc_variables(xyz, var_data, results, with_data=False)
+                # The unit conversion is reported after the data array
+                # checks, as by compute_qc
+                notes = []
+                convertible = normalize_qc_values(xyz, var_data, np.empty(0), notes) is not None
+
+                # Keep the distinct values seen so far, up to two, for the
+                # data array checks
+                distinct = None
+                stats = None
+                for start, stop in chunk_slices(size, chunk_size):
+                    if not convertible:
+                        with stage('read', stop - start):
+                            raw_data = var_data[start:stop]
+                    else:
+                        raw_data, values = read_values(var_name, start, stop)
+                    with stage('check_data', stop - start):
+                        unique_vals = np.unique(raw_data)
+                        if distinct is not None:
+                            unique_vals = np.unique(ma.concatenate([distinct, unique_vals]))
+                        distinct = unique_vals[:2]
+                    if not convertible:
                         continue
-                except Exception as e:
-                    unit_conversion_err = "Could not normalize data: unit conversion failed."
-                    log.exception(f"{unit_conversion_err}: {str(e)}")
-                    report_list.append(f"{unit_conversion_err}: {str(e)}")
+                    with stage('update_config', stop - start):
+                        values = values[max(1 - start, 0):min(size - 1 - start, stop - start)]
+                        values = values[~np.isnan(values)]
+                        n = len(values)
+                        mean = float(np.mean(values)) if n else 0.0
+                        stats = DeploymentStats.merge_statistics(stats, {
+                            'files': 1, 'n': n, 'mean': mean, 'roc': None,
+                            'm2': float(np.sum((values - mean) ** 2)) if n else 0.0,
+                        })
+
+                with stage('check_data'):
+                    check_note = xyz.check_geophysical_variables(var_name, distinct)
+                if check_note:
+                    report_list.append(check_note)
+                    continue
+                report_list.extend(notes)
+                if not convertible:
                     continue
+                stats['files'] = 1
+                prepared[var_name] = stats
+
+            # Second pass: the rate of change threshold is the largest rate
+            # of change between consecutive values within a standard
+            # deviation of the mean, paired with the times like update_config
+            for var_name, stats in prepared.items():
+                with stage('update_config'):
+                    if stats['n'] < 2:
+                        continue
+                    std = math.sqrt(stats['m2'] / stats['n'])
+                    low, high = stats['mean'] - std, stats['mean'] + std
+                last = None
+                for start, stop in chunk_slices(size, chunk_size):
+                    _, values = read_values(var_name, start, stop)
+                    with stage('update_config', stop - start):
+                        # values[i] is paired with times[i - 1]
+                        first = max(1 - start, 0)
+                        last_index = min(size - 1 - start, stop - start)
+                        values = values[first:last_index]
+                        times = time_var[start + first - 1:start + last_index - 1].astype('datetime64[s]')
+                        times = ma.getdata(times)
+                        in_band = (values > low) & (values < high)
+                        values = values[in_band]
+                        times = times[in_band]
+                        if last is not None:
+                            values = np.concatenate([[last[0]], values])
+                            times = np.concatenate([[last[1]], times])
+                        if len(values) > 1:
+                            roc = np.max(np.abs(np.diff(values) / np.diff(times).astype(float)))
+                            if stats['roc'] is None or roc > stats['roc']:
+                                stats['roc'] = float(roc)
+                        if len(values):
+                            last = values[-1], times[-1]
+
+            if deployment_stats is not None and prepared:
+                with stage('deployment_stats'):
+                    deployment_totals = deployment_stats.merge(file_name, prepared)
+            else:
+                deployment_totals = None
+
+            streams = qartod_streams(xyz, prepared, time_units, deployment_totals, report_list)
+            describe_qartod_flags(results, streams)
+
+        # Look back on the flat line test window
+        flat_line_seconds = max([
+            int(var_stream['qartod'].get('flat_line_test', {}).get('fail_threshold') or 0)
+            for var_stream in streams.values()
+        ] + [0])
+        config_set = {'contexts': [{'streams': streams}]}
+
+        def write_flags(write):
+            for start, stop in chunk_slices(size, chunk_size):
+                # Third pass: run the tests on the window and write the flags
+                context = 0
+                if flat_line_seconds and size > 1:
+                    # Sampling interval of the chunk_size samples up to stop,
+                    # the last chunk can be shorter
+                    times = time_var[max(stop - chunk_size, 0):stop].astype('datetime64[s]')
+                    interval = np.median(np.diff(ma.getdata(times)).astype(float))
+                    if interval > 0:
+                        context = min(int(math.ceil(flat_line_seconds / interval)) + 1, chunk_size)
+                window_start = max(start - context, 0)
+                window_stop = min(stop + 1, size)
+                core = slice(start - window_start, stop - window_start)
+
+                # The flags of the variables which weren't tested stay
+                # NOT_EVALUATED
+                flags = {name: np.full(stop - start, 2, dtype=np.int8)
+                         for name, spec in results['variables'].items() if 'data' not in spec}
+                if streams:
+                    with stage('read', window_stop - window_start):
+                        data = {'time': time_var[window_start:window_stop].astype('datetime64[s]')}
+                    for var_name in streams:
+                        data[var_name] = read_values(var_name, window_start, window_stop)[1]
+                    df = pd.DataFrame(data)
+                    with stage('apply_qc', len(df) * len(streams)):
+                        all_results = xyz.apply_qc_batch(df, config_set)
+                    window_flags = qartod_flags(all_results, streams, report_list, (start, stop))
+                    for qartodname, values in window_flags.items():
+                        flags[qartodname] = values[core]
+                with stage('write_back', stop - start):
+                    write(start, stop, flags)
+
+        # The errors of the windows are only known once their flags are
+        # written, the comment is then updated
+        results['dac_qc_comment'] = dac_qc_comment(nc_path, report_list)
+        if classic:
+            def rebuild(tmp_path):
+                with stage('write_back'):
+                    dst = ClassicFileWriter(ncfile, tmp_path, results)
+                with dst:
+                    # the other variables are copied with the records of
+                    # the flags
+                    write_flags(dst.write_records)
+                comment = dac_qc_comment(nc_path, report_list)
+                if comment != results['dac_qc_comment']:
+                    # rewrites the file once, only when a window failed
+                    with stage('write_back'), Dataset(tmp_path, 'r+') as nc:
+                        nc.dac_qc_comment = comment
+            replace_file(nc_path, rebuild)
+        else:
+            def write(start, stop, flags):
+                for qartodname, values in flags.items():
+                    ncfile.variables[qartodname][start:stop] = values
+            with stage('write_back'):
+                apply_qc_results(ncfile, results)
+            write_flags(write)
+            with stage('write_back'):
+                ncfile.dac_qc_comment = dac_qc_comment(nc_path, report_list)
+
+def qartod_flag_variable(var_name, testname, varspec):
+    '''
+    Returns the name of the QC flag variable storing the results of a test
+    column returned by GliderQC.apply_qc_batch and the config specs of the test
 
-                # Update variable config set
-                var_spec = xyz.config['contexts'][0]['streams'][var_name]['qartod']
-                config_set, note = xyz.update_config(var_spec, var_name, times[:].astype('datetime64[s]'), values, times.units)
-                report_list.append(note)
+    :param var_name: string defining the variable name
+    :param testname: string defining the test column, e.g. qartod_spike_test
+    :param varspec: dictionary with variable config specs for QARTOD tests
+    '''
+    if testname == 'qartod_rollup_qc':
+        return 'qartod_' + var_name + '_primary_flag', varspec
+    test = testname.split('qartod_')[-1]
+    return 'qartod_' + var_name + '_' + test.split('_test')[0] + '_flag', varspec[test]
 
-                # create a datafarame for the QARTOD process
-                df = pd.DataFrame(
-                {
-                    "time": times[:].astype('datetime64[s]'),
-                    var_name: values,
-                },
-                )
-
-                # Get the QARTOD results
-                try:
-                    results = xyz.apply_qc(df,var_name, config_set)
-                    log.info("Generated QC test results for %s", var_name)
-
-                    for testname in results.columns:
-
-                        # create the qartod variable name and get the config specs
-                        if testname == 'qartod_rollup_qc':
-                            qartodname = 'qartod_'+ var_name + '_primary_flag'
-                            # Pass the config specs to a variable
-                            testconfig = config_set['contexts'][0]['streams'][var_name]['qartod']
-                        else:
-                            qartodname = 'qartod_'+ var_name + '_'+ testname.split('qartod_')[-1].split('_test')[0]+'_flag'
-                            # Pass the config specs to a variable
-                            testconfig = config_set['contexts'][0]['streams'][var_name]['qartod'][testname.split('qartod_')[-1]]
-
-                        # Update the qartod variable
-                        log.info("Updating %s", qartodname)
-                        qartod_var = ncfile.variables[qartodname]
-                        qartod_var[:] = np.array(results[testname].values)
-                        qartod_var.qartod_test = f"{testname.split('qartod_')[-1]}"
-
-                        # Set the dictionary as a string attribute to the variable
-                        qartod_var.setncattr('qartod_config', json.dumps(testconfig))
-
-                except Exception as e:
-                        apply_qc_err = "apply_qc failed: could not calculate QC flags."
-                        log.exception(f"{apply_qc_err}: ")
-                        report_list.append(f"{apply_qc_err}: {str(e)}")
-                        continue
-    # log issues qc
-    report = ' '.join(report_list).strip()
-    ncfile.dac_qc_comment = str(deployment_name) + ' (' + str(file_name) + ': ' + str(report) + ')'
+def timing_percentiles(file_timings, percentiles=(50, 90, 99)):
+    '''
+    Returns the count and percentiles of the seconds spent in each QC stage,
+    and in total, by a list of files
+
+    :param file_timings: list of StageTimings.stages dictionaries
+    :param percentiles: sequence of percentiles to compute
+    '''
+    seconds = {}
+    for stages in file_timings:
+        for name, stage in stages.items():
+            seconds.setdefault(name, []).append(stage['seconds'])
+        seconds.setdefault('total', []).append(sum(stage['seconds'] for stage in stages.values()))
+    summary = {}
+    for name, values in seconds.items():
+        summary[name] = {'count': len(values)}
+        for percentile, value in zip(percentiles, np.percentile(values, percentiles)):
+            summary[name]['p{}'.format(percentile)] = float(value)
+    return summary
+
+def get_qc_timing_percentiles(count=1000, percentiles=(50, 90, 99)):
+    '''
+    Returns the timing_percentiles of the most recent files in the QC timings
+    redis stream, for monitoring the QC workers
+
+    :param count: number of most recent files to include
+    :param percentiles: sequence of percentiles to compute
+    '''
+    entries = get_redis_connection().xrevrange(QC_TIMINGS_STREAM, count=count)
+    return timing_percentiles([json.loads(fields[b'stages']) for _, fields in entries], percentiles)
 
-def qc_task(nc_path, config):
+def get_qc_queue(delayed_mode=False, connection=None):
+    '''
+    Returns the RQ queue for the QC jobs of real-time or delayed mode files
+
+    :param delayed_mode: bool, whether the files are from a delayed mode deployment
+    :param connection: redis connection (optional)
+    '''
+    return Queue(QC_DELAYED_QUEUE if delayed_mode else QC_QUEUE,
+                 connection=connection or get_redis_connection())
+
+def get_qc_queue_stats(count=1000, percentiles=(50, 90, 99)):
+    '''
+    Returns the ingest lag of each QC queue: the number of jobs waiting, the
+    age in seconds of the oldest waiting job and the percentiles of the
+    seconds the most recent files waited in the queue before their QC started
+
+    :param count: number of most recent files of the QC timings stream to include
+    :param percentiles: sequence of percentiles to compute
+    '''
+    connection = get_redis_connection()
+    now = utcnow()
+    stats = {}
+    for name in QC_QUEUES:
+        queue = Queue(name, connection=connection)
+        oldest = None
+        job_ids = queue.get_job_ids(0, 1)
+        if job_ids:
+            job = queue.fetch_job(job_ids[0])
+            if job is not None and job.enqueued_at is not None:
+                oldest = (now - job.enqueued_at).total_seconds()
+        stats[name] = {'depth': queue.count, 'oldest_job_age': oldest}
+
+    waits = {}
+    for _, fields in connection.xrevrange(QC_TIMINGS_STREAM, count=count):
+        if b'queue' in fields:
+            waits.setdefault(fields[b'queue'].decode('utf-8'), []).append(float(fields[b'queue_wait']))
+    for name, values in waits.items():
+        wait = stats.setdefault(name, {}).setdefault('wait', {'count': len(values)})
+        for percentile, value in zip(percentiles, np.percentile(values, percentiles)):
+            wait['p{}'.format(percentile)] = float(value)
+    return stats
+
+def file_location_flags(nc_paths):
+    '''
+    Returns a dictionary of the location test flag of each netCDF file. The
+    positions of all of the files, such as the files of a deployment being
+    backfilled, are tested in a single vectorized pass of
+    GliderQC.location_flags.
+
+    :param nc_paths: list of paths to netCDF files
+    '''
+    profile_lat = np.full(len(nc_paths), np.nan)
+    profile_lon = np.full(len(nc_paths), np.nan)
+    center_lat = np.full(len(nc_paths), np.nan)
+    center_lon = np.full(len(nc_paths), np.nan)
+    for i, nc_path in enumerate(nc_paths):
+        try:
+            with Dataset(nc_path, 'r') as nc:
+                qc = GliderQC(nc)
+                profile_lat[i] = ma.filled(nc.variables['profile_lat'][0], np.nan)
+                profile_lon[i] = ma.filled(nc.variables['profile_lon'][0], np.nan)
+                with warnings.catch_warnings():
+                    # all NaN tracks are flagged as missing
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    center_lat[i] = np.nanmean(qc.axes['lat'])
+                    center_lon[i] = np.nanmean(qc.axes['lon'])
+        except Exception:
+            log.exception("Could not read the location of %s", nc_path)
+    flags = GliderQC.location_flags(profile_lat, profile_lon, center_lat, center_lon)
+    return dict(zip(nc_paths, flags.tolist()))
+
+def qc_task(nc_path, config, chunk_size=None):
     '''
     Job wrapper around performing QC
     :param nc_path: string defining path to the netcdf file
     :param config: string defining path to the configuration file
+    :param chunk_size: files with more samples along time are QC'd in windows
+                       of this many samples by run_qc_chunked, QC_CHUNK_SIZE
+                       by default
+
+    Returns True if QC was applied to the file, False if it had already been
+    applied or failed.
     '''
+    # Time spent waiting in the queue when running as an RQ job
+    job = get_current_job()
+    queue_name = queue_wait = None
+    if job is not None and job.enqueued_at is not None:
+        queue_name = job.origin
+        queue_wait = (utcnow() - job.enqueued_at).total_seconds()
     lock = lock_file(nc_path)
     if not lock.acquire():
         raise ProcessError("File lock already acquired by another process")
-    # Repeat xattr check.  Consider removing when inotify loop conditions
-    # where file is repeatedly picked are addressed.
     try:
-        if os.getxattr(nc_path, "user.qc_run"):
+        # Repeat xattr check.  Consider removing when inotify loop conditions
+        # where file is repeatedly picked are addressed.
+        if qc_already_run(nc_path, config):
             return False
-    except OSError:
-        pass
-    try:
-        with Dataset(nc_path, 'r+') as nc:
-            run_qc(config, nc, nc_path)
+        timings = StageTimings()
+        deployment_stats = DeploymentStats(os.path.dirname(nc_path))
+        if chunk_size is None:
+            chunk_size = QC_CHUNK_SIZE
+        with Dataset(nc_path, 'r') as nc:
+            chunked = 'time' in nc.variables and nc.variables['time'].size > chunk_size
+            if not chunked:
+                # The thresholds depend on the statistics of the deployment,
+                # which are merged with this file's own statistics by
+                # compute_qc, so the key only includes the other files'
+                with timings.stage('cache'):
+                    other_totals = deployment_stats.totals_excluding(os.path.basename(nc_path))
+                    cache_key = (qc_cache_key(nc, nc_path, config, other_totals)
+                                 if other_totals is not None else None)
+                    results = get_cached_qc_results(cache_key)
+                if results is not None:
+                    log.info("Applying cached QC results to %s", nc_path)
+                else:
+                    results = compute_qc(config, nc, nc_path, deployment_stats, timings)
+                    with timings.stage('cache'):
+                        cache_qc_results(cache_key, encode_qc_results(results))
+        if chunked:
+            # The results of large files are written as they are computed
+            # and aren't cached
+            log.info("Running QC on %s in chunks of %d samples", nc_path, chunk_size)
+            run_qc_chunked(config, nc_path, chunk_size, deployment_stats, timings)
+        else:
+            with timings.stage('write_back'):
+                write_qc_results(nc_path, results)
         os.setxattr(nc_path, "user.qc_run", b"true")
+        log.info("QC of %s took %.3fs: %s", nc_path, timings.total(),
+                 ', '.join('{} {:.3f}s'.format(name, stage['seconds'])
+                           for name, stage in timings.stages.items()))
+        timings.publish(nc_path, queue=queue_name, queue_wait=queue_wait)
+        return True
     # set user_qc xattr to error to prevent continuous inotify looping on
     # partially modified netCDF files
     except OSError:
         log.exception(f"Exception occurred trying to save QC to file on {nc_path}:")
-        os.setxattr(nc_path, "user.qc_run", b"error")
+        mark_qc_error(nc_path, config)
+        return False
     except:
         log.exception("Other unhandled error occurred during QC:")
-        os.setxattr(nc_path, "user.qc_run", b"error")
+        mark_qc_error(nc_path, config)
+        return False
     finally:
         lock.release()
 
+def qc_cache_key(ncfile, ncfile_path, config, deployment_totals=None):
+    '''
+    Returns a hash of everything the QC results of a file depend on: the
+    contents of the QC configuration, the deployment directory and file
+    names used by check_time and the QC comment, the statistics of the
+    other files of the deployment and the data and relevant attributes of
+    the coordinate and geophysical variables. Returns None if the hash can't
+    be computed.
+
+    :param ncfile: netCDF4._netCDF4.Dataset
+    :param ncfile_path: string defining path to the netCDF file
+    :param config: string defining path to the configuration file
+    :param deployment_totals: dictionary returned by
+                              DeploymentStats.totals_excluding for the file
+                              (optional)
+    '''
+    try:
+        sha = hashlib.sha256()
+        with open(config, 'rb') as f:
+            sha.update(f.read())
+        if deployment_totals:
+            sha.update(json.dumps(deployment_totals, sort_keys=True).encode('utf-8'))
+        sha.update('/'.join(ncfile_path.split('/')[-2:]).encode('utf-8'))
+
+        geophysical_variables, _ = GliderQC(ncfile).find_geophysical_variables()
+        for name in ['time', 'lat', 'lon', 'profile_lat', 'profile_lon'] + geophysical_variables:
+            if name not in ncfile.variables:
+                continue
+            ncvar = ncfile.variables[name]
+            sha.update(name.encode('utf-8'))
+            for attr in ('units', 'standard_name', 'valid_min', 'valid_max', '_FillValue'):
+                sha.update(str(getattr(ncvar, attr, None)).encode('utf-8'))
+            # the qartod flags QC links to the variable are not an input
+            ancillary_variables = str(getattr(ncvar, 'ancillary_variables', '')).split()
+            sha.update(' '.join(v for v in ancillary_variables
+                                if not v.startswith('qartod')).encode('utf-8'))
+            data = ncvar[:]
+            sha.update(ma.getdata(data).tobytes())
+            sha.update(ma.getmaskarray(data).tobytes())
+        return sha.hexdigest()
+    except Exception:
+        log.exception("Could not compute the QC cache key of %s", ncfile_path)
+        return None
+
+def _encode_nc_value(value):
+    '''
+    Returns a JSON serializable representation of a netCDF attribute or array
+    '''
+    if isinstance(value, str):
+        return value
+    value = np.asarray(value)
+    return {'dtype': value.dtype.str, 'value': value.tolist()}
+
+def _decode_nc_value(value):
+    '''
+    Inverse of _encode_nc_value, values which are not encoded are returned
+    as they are
+    '''
+    if isinstance(value, dict):
+        return np.array(value['value'], dtype=value['dtype'])
+    return value
+
+def encode_qc_results(results):
+    '''
+    Returns a JSON serializable copy of the QC results returned by compute_qc
+
+    :param results: dictionary returned by compute_qc
+    '''
+    variables = {}
+    for name, spec in results['variables'].items():
+        fill_value = spec['fill_value']
+        variables[name] = {
+            'datatype': np.dtype(spec['datatype']).str,
+            'dimensions': list(spec['dimensions']),
+            'fill_value': None if fill_value is None else _encode_nc_value(fill_value),
+            'attributes': {attr: _encode_nc_value(value) for attr, value in spec['attributes'].items()},
+            'data': _encode_nc_value(spec['data']),
+        }
+    return dict(results, variables=variables)
+
+def snapshot_qc_results(ncfile):
+    '''
+    Returns a JSON serializable snapshot of the QC results of a file: the
+    qartod flag variables, the ancillary_variables linking them to their
+    parent variables and the dac_qc_comment.
+
+    :param ncfile: netCDF4._netCDF4.Dataset
+    '''
+    variables = {}
+    ancillary_variables = {}
+    for name, ncvar in ncfile.variables.items():
+        attributes = {attr: ncvar.getncattr(attr) for attr in ncvar.ncattrs()}
+        if not name.startswith('qartod'):
+            if 'qartod' in str(attributes.get('ancillary_variables', '')):
+                ancillary_variables[name] = attributes['ancillary_variables']
+            continue
+        fill_value = attributes.pop('_FillValue', None)
+        variables[name] = {
+            'datatype': ncvar.dtype.str,
+            'dimensions': list(ncvar.dimensions),
+            'fill_value': None if fill_value is None else _encode_nc_value(fill_value),
+            'attributes': {attr: _encode_nc_value(value) for attr, value in attributes.items()},
+            'data': _encode_nc_value(ma.filled(ncvar[:], fill_value)),
+        }
+    return {
+        'variables': variables,
+        'ancillary_variables': ancillary_variables,
+        'dac_qc_comment': getattr(ncfile, 'dac_qc_comment', ''),
+    }
+
+def apply_qc_results(ncfile, results):
+    '''
+    Writes QC results, as returned by compute_qc or snapshot_qc_results, to
+    an open file. Each variable is defined with its attributes at once and
+    its data is written once.
+
+    :param ncfile: netCDF4._netCDF4.Dataset
+    :param results: dictionary returned by compute_qc or snapshot_qc_results
+    '''
+    for name, spec in results['variables'].items():
+        if name in ncfile.variables:
+            ncvar = ncfile.variables[name]
+        else:
+            fill_value = spec['fill_value']
+            ncvar = ncfile.createVariable(name, np.dtype(spec['datatype']), tuple(spec['dimensions']),
+                                          fill_value=None if fill_value is None else _decode_nc_value(fill_value))
+        ncvar.setncatts({attr: _decode_nc_value(value) for attr, value in spec['attributes'].items()})
+        if 'data' in spec:
+            ncvar[:] = _decode_nc_value(spec['data'])
+    for name, ancillary_variables in results.get('ancillary_variables', {}).items():
+        if name in ncfile.variables:
+            ncfile.variables[name].ancillary_variables = ancillary_variables
+    if 'dac_qc_comment' in results:
+        ncfile.dac_qc_comment = results['dac_qc_comment']
+
+def write_qc_results(nc_path, results):
+    '''
+    Writes QC results to a netCDF file.
+
+    Leaving define mode in a classic netCDF file rewrites its header and,
+    when variables are added along the record dimension, every record after
+    it. netCDF4 leaves define mode after each variable or attribute, so
+    classic files are instead rebuilt with the original and the QC
+    definitions in a single pass by ClassicFileWriter, into a temporary file
+    which replaces the original (see replace_file) so a failed write never
+    leaves a partial file. netCDF-4 files are updated in place.
+
+    :param nc_path: string defining path to the netCDF file
+    :param results: dictionary returned by compute_qc or snapshot_qc_results
+    '''
+    with Dataset(nc_path, 'r') as src:
+        classic = src.data_model.startswith('NETCDF3')
+    if not classic:
+        with Dataset(nc_path, 'r+') as nc:
+            apply_qc_results(nc, results)
+        return
+
+    def rebuild(tmp_path):
+        with Dataset(nc_path, 'r') as src, ClassicFileWriter(src, tmp_path, results) as dst:
+            dst.write_records()
+    replace_file(nc_path, rebuild)
+
+def replace_file(path, write):
+    '''
+    Replaces a file with new contents, keeping its permissions, ownership
+    and extended attributes. The contents are written and synced to a
+    temporary dotfile in the same directory, which the watchdog ignores, and
+    renamed over the file, which gets a new inode.
+
+    The QC workers don't run as root, so they can't give the new file the
+    ownership of a file uploaded by someone else. Such files are instead
+    overwritten in place from the synced temporary file, keeping their
+    inode, owner and group: the file is only partial while it is copied
+    and the complete copy is on disk until then.
+
+    :param path: string defining path to the file
+    :param write: function writing the new contents to the temporary path
+                  it is given
+    '''
+    st = os.stat(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.{}.'.format(os.path.basename(path)),
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        try:
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        except PermissionError:
+            log.info("Cannot give a new file the ownership of %s, overwriting it in place", path)
+            with open(tmp_path, 'rb') as src, open(path, 'r+b') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+                dst.truncate()
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.unlink(tmp_path)
+            return
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        # check_needs_qc and qc_task rely on the user.qc_run xattr
+        try:
+            attrs = os.listxattr(path)
+        except OSError:
+            attrs = []
+        for attr in attrs:
+            try:
+                os.setxattr(tmp_path, attr, os.getxattr(path, attr))
+            except OSError:
+                log.warning("Could not copy the %s xattr of %s", attr, path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def get_cached_qc_results(cache_key):
+    '''
+    Returns the cached QC results for the cache key or None
+
+    :param cache_key: string returned by qc_cache_key
+    '''
+    if cache_key is None:
+        return None
+    try:
+        cached = get_redis_connection().get(QC_CACHE_KEY + cache_key)
+    except redis.RedisError:
+        log.exception("Could not read the QC results cache")
+        return None
+    if cached is None:
+        return None
+    return json.loads(cached)
+
+def cache_qc_results(cache_key, results):
+    '''
+    Stores the QC results of a file in the cache
+
+    :param cache_key: string returned by qc_cache_key
+    :param results: dictionary returned by snapshot_qc_results
+    '''
+    if cache_key is None:
+        return
+    try:
+        get_redis_connection().set(QC_CACHE_KEY + cache_key, json.dumps(results), ex=QC_CACHE_TTL)
+    except redis.RedisError:
+        log.exception("Could not write to the QC results cache")
+
+@functools.lru_cache(maxsize=128)
+def get_unit(units):
+    '''
+    Returns the parsed cf_units.Unit of a units string
+
+    :param units: string defining units
+    '''
+    return Unit(units)
+
+# Values the linear conversions are checked against cf_units with
+UNIT_CONVERSION_PROBE = np.array([0.0, 1.0, -1.0, 0.1, 12.345, -273.15, 1.0e3, 1.0e6])
+
+@functools.lru_cache(maxsize=256)
+def get_unit_conversion(units, target_unit):
+    '''
+    Returns the (scale, offset) converting values from units to target_unit
+    as values * scale + offset, or None if the conversion can't be done
+    that way with the same results as cf_units. Raises the cf_units error
+    if the units aren't convertible.
+
+    :param units: string defining units
+    :param target_unit: string defining the units to convert to
+    '''
+    expected = get_unit(units).convert(UNIT_CONVERSION_PROBE, target_unit)
+    offset, scale = get_unit(units).convert(np.array([0.0, 1.0]), target_unit)
+    scale -= offset
+    if not np.array_equal(UNIT_CONVERSION_PROBE * scale + offset, expected):
+        return None
+    return float(scale), float(offset)
+
+def load_qc_config(path):
+    '''
+    Returns a copy of the parsed YAML QC configuration. The parsed
+    configuration is kept for the life of the process and is only read from
+    disk again when the file's modification time changes. A copy is returned
+    since update_config modifies the configuration of each file.
+
+    :param path: string defining path to the configuration file
+    '''
+    mtime = os.path.getmtime(path)
+    cached = __QC_CONFIGS.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r') as f:
+            cached = (mtime, yaml.safe_load(f.read()))
+        __QC_CONFIGS[path] = cached
+    return copy.deepcopy(cached[1])
+
+def warm_up(config=None):
+    '''
+    Preloads everything a long running QC worker needs before taking jobs:
+    the QC configuration, the UDUNITS unit system used by normalize_variable
+    and the ioos_qc stream machinery, which is run once on a tiny stream.
+
+    :param config: string defining path to the configuration file (optional)
+    '''
+    if config is not None:
+        load_qc_config(config)
+    for target_unit in set(GliderQC.STANDARD_UNITS.values()):
+        get_unit(target_unit)
+    df = pd.DataFrame({
+        "time": np.array([0, 60, 120], dtype='datetime64[s]'),
+        "warm_up": np.array([0.5, 0.6, np.nan]),
+    })
+    configset = {'contexts': [{'streams': {'warm_up': {'qartod': {
+        'gross_range_test': {'fail_span': [0, 1]}
+    }}}}]}
+    GliderQC(None).apply_qc_batch(df, configset)
+    log.info("QC worker warmed up")
+
 def lock_file(path):
     '''
     Acquires a file lock or raises an exception
@@ -856,24 +2549,104 @@ def get_redis_connection():
     __RCONN = redis.Redis(connection_pool=redis_pool)
     return __RCONN
 
-def check_needs_qc(nc_path):
+@functools.lru_cache(maxsize=1)
+def qc_code_version():
+    '''
+    Returns a hash of the QC code: the source of this module and the ioos_qc
+    version
+    '''
+    sha = hashlib.sha256()
+    with open(__file__, 'rb') as f:
+        sha.update(f.read())
+    sha.update(str(getattr(ioos_qc, '__version__', None)).encode('utf-8'))
+    return sha.hexdigest()
+
+def qc_error_key(nc_path, config):
+    '''
+    Returns a hash of what a failed QC run of a file depended on: the size
+    and mtime of the file, the contents of the QC configuration and the QC
+    code.
+
+    :param nc_path: string defining path to the netcdf file
+    :param config: string defining path to the configuration file
+    '''
+    st = os.stat(nc_path)
+    sha = hashlib.sha256()
+    sha.update('{}:{}:'.format(st.st_size, st.st_mtime_ns).encode('utf-8'))
+    with open(config, 'rb') as f:
+        sha.update(f.read())
+    sha.update(qc_code_version().encode('utf-8'))
+    return sha.hexdigest()
+
+def mark_qc_error(nc_path, config):
+    '''
+    Sets the user.qc_run xattr of a file to error, to prevent continuous
+    inotify looping on partially modified netCDF files, along with the error
+    key so QC is retried once the file, configuration or code changes.
+
+    :param nc_path: string defining path to the netcdf file
+    :param config: string defining path to the configuration file
+    '''
+    try:
+        os.setxattr(nc_path, "user.qc_run", b"error")
+        os.setxattr(nc_path, QC_ERROR_KEY_XATTR, qc_error_key(nc_path, config).encode('utf-8'))
+    except OSError:
+        log.exception("Could not mark the QC of %s as failed", nc_path)
+
+def qc_already_run(nc_path, config=None):
+    '''
+    Returns True if the user.qc_run xattr marks the file as QC'd, or as
+    failed with the current error key. A failure recorded for a different
+    version of the file, configuration or QC code is cleared so the file is
+    QC'd again. Without a configuration, failures are not retried.
+
+    :param nc_path: string defining path to the netcdf file
+    :param config: string defining path to the configuration file (optional)
+    '''
+    try:
+        qc_run = os.getxattr(nc_path, "user.qc_run")
+    except OSError:
+        return False
+    if qc_run != b"error" or config is None:
+        return bool(qc_run)
+
+    try:
+        error_key = os.getxattr(nc_path, QC_ERROR_KEY_XATTR)
+    except OSError:
+        error_key = None
+    try:
+        if error_key == qc_error_key(nc_path, config).encode('utf-8'):
+            return True
+    except OSError:
+        log.exception("Could not compute the QC error key of %s", nc_path)
+        return True
+
+    log.info("Retrying QC of %s, it failed with a different file, configuration or code", nc_path)
+    for attr in ("user.qc_run", QC_ERROR_KEY_XATTR):
+        try:
+            os.removexattr(nc_path, attr)
+        except OSError:
+            pass
+    return False
+
+def check_needs_qc(nc_path, config=None):
     '''
     Returns True if the netCDF file needs GliderQC
     param nc_path: string defining path to the netcdf file
+    param config: string defining path to the configuration file, files which
+                  failed QC are only retried when it is given (optional)
     '''
     # quick check to see if QC has already been run on these files
-    try:
-        if os.getxattr(nc_path, "user.qc_run"):
-            return False
-    except OSError:
-        pass
-    with Dataset(nc_path, 'r') as nc:
-        qc = GliderQC(nc, None)
-        legacy_var, note = qc.find_geophysical_variables()
-        for varname in legacy_var:
-            ncvar = nc.variables[varname]
-            if qc.needs_qc(ncvar):
-                return True
+    if qc_already_run(nc_path, config):
+        return False
+    # Only the header is needed to find the ancillary_variables, avoid
+    # opening the whole dataset
+    header = ncheader.read_header(nc_path)
+    qc = GliderQC(header, None)
+    legacy_var, note = qc.find_geophysical_variables()
+    for varname in legacy_var:
+        if qc.needs_qc(header.variables[varname]):
+            return True
     # if this section was reached, QC has been run, but xattr remains unset
     try:
         os.setxattr(nc_path, "user.qc_run", b"true")
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+'''
+glider_util/ncheader.py
+
+Reads the header (dimensions, attributes and variable definitions) of a
+netCDF file without reading any of its data.
+
+Classic and 64-bit offset netCDF files are parsed directly from the first
+bytes of the file. netCDF-4 (HDF5) files fall back to netCDF4, which only
+reads metadata when a dataset is opened.
+
+The returned objects mimic the parts of the netCDF4 Dataset and Variable
+interfaces used to inspect metadata: `variables`, `dimensions`, `ncattrs()`,
+`getncattr()`, attribute access and `get_variables_by_attributes()`.
+
+read_header_cached keeps the headers of recently read files, keyed on the
+path, mtime and size of the file, so the scripts inspecting the same files
+repeatedly only parse them when they change.
+'''
+from netCDF4 import Dataset
+import functools
+import numpy as np
+import os
+import struct
+
+# Header tags
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+
+# netCDF external types to their big-endian numpy types
+NC_TYPES = {
+    1: np.dtype('i1'),
+    2: np.dtype('S1'),
+    3: np.dtype('>i2'),
+    4: np.dtype('>i4'),
+    5: np.dtype('>f4'),
+    6: np.dtype('>f8'),
+    7: np.dtype('u1'),
+    8: np.dtype('>u2'),
+    9: np.dtype('>u4'),
+    10: np.dtype('>i8'),
+    11: np.dtype('>u8'),
+}
+
+# Bytes read from the file at a time while parsing the header
+READ_SIZE = 65536
+
+
+class NcVariableHeader(object):
+    '''
+    The definition of a netCDF variable: name, dtype, dimensions and attributes
+    '''
+    def __init__(self, name, dtype, dimensions, attributes):
+        self.name = name
+        self.dtype = dtype
+        self.dimensions = tuple(dimensions)
+        self._attributes = attributes
+
+    def ncattrs(self):
+        return list(self._attributes)
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def __getattr__(self, name):
+        # Only called when the regular attribute lookup fails
+        try:
+            return self.__dict__['_attributes'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return '<NcVariableHeader {} {} {}>'.format(self.name, self.dtype, self.dimensions)
+
+
+class NcHeader(object):
+    '''
+    The header of a netCDF file
+    '''
+    def __init__(self, dimensions, attributes, variables, data_model):
+        self.dimensions = dimensions
+        self.variables = variables
+        self.data_model = data_model
+        self._attributes = attributes
+
+    def ncattrs(self):
+        return list(self._attributes)
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_attributes'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get_variables_by_attributes(self, **kwargs):
+        '''
+        Returns the variables matching all of the attribute values (or
+        callables) given as keyword arguments, like
+        netCDF4.Dataset.get_variables_by_attributes
+        '''
+        matches = []
+        for variable in self.variables.values():
+            for attr, value in kwargs.items():
+                if attr == 'name':
+                    attr_value = variable.name
+                else:
+                    attr_value = variable._attributes.get(attr)
+                if callable(value):
+                    if not value(attr_value):
+                        break
+                elif attr_value is None or attr_value != value:
+                    break
+            else:
+                matches.append(variable)
+        return matches
+
+
+_INT = struct.Struct('>i')
+_INT64 = struct.Struct('>q')
+
+
+# Single valued attributes are unpacked with struct, much cheaper than numpy
+_STRUCT_FORMATS = {'i1': '>b', 'i2': '>h', 'i4': '>i', 'i8': '>q',
+                   'u1': '>B', 'u2': '>H', 'u4': '>I', 'u8': '>Q',
+                   'f4': '>f', 'f8': '>d'}
+_SCALAR_TYPES = {dtype: dtype.newbyteorder('=').type
+                 for dtype in NC_TYPES.values() if dtype.kind != 'S'}
+_SCALAR_UNPACK = {dtype: struct.Struct(_STRUCT_FORMATS[dtype.str[1:]]).unpack_from
+                  for dtype in NC_TYPES.values() if dtype.kind != 'S'}
+
+
+class _Truncated(Exception):
+    pass
+
+
+def _parse_classic_header(buf):
+    '''
+    Parses a classic netCDF header from buf, raises _Truncated if buf does not
+    hold the whole header.
+
+    The parsing is kept in a single function with local lookups, headers of
+    glider files carry hundreds of attributes and the per-call overhead of
+    a reader object dominates otherwise.
+    '''
+    version = buf[3]
+    unpack_int = _INT.unpack_from
+    # CDF-5 files use 64 bit counts, CDF-2 and CDF-5 64 bit offsets
+    count_struct = _INT64 if version == 5 else _INT
+    unpack_count = count_struct.unpack_from
+    count_size = count_struct.size
+    offset_size = 8 if version in (2, 5) else 4
+    nc_types = NC_TYPES
+    scalar_types = _SCALAR_TYPES
+    unpack_scalar = _SCALAR_UNPACK
+    size = len(buf)
+
+    try:
+        pos = 4
+        numrecs = unpack_count(buf, pos)[0]
+        pos += count_size
+
+        def list_header(pos, tag):
+            list_tag = unpack_int(buf, pos)[0]
+            nelems = unpack_count(buf, pos + 4)[0]
+            if list_tag not in (0, tag) or (list_tag == 0 and nelems != 0):
+                raise ValueError("Invalid netCDF header")
+            return pos + 4 + count_size, nelems
+
+        def name_at(pos):
+            length = unpack_count(buf, pos)[0]
+            pos += count_size
+            name = buf[pos:pos + length].decode('utf-8')
+            return pos + length + (-length % 4), name
+
+        def attributes_at(pos):
+            attributes = {}
+            pos, nattrs = list_header(pos, NC_ATTRIBUTE)
+            for _ in range(nattrs):
+                pos, name = name_at(pos)
+                nc_type = nc_types[unpack_int(buf, pos)[0]]
+                nelems = unpack_count(buf, pos + 4)[0]
+                pos += 4 + count_size
+                nbytes = nelems * nc_type.itemsize
+                if pos + nbytes > size:
+                    raise _Truncated()
+                if nc_type.kind == 'S':
+                    # Matches how netCDF4 decodes text attributes
+                    attributes[name] = buf[pos:pos + nbytes].decode('utf-8', 'replace').replace('\x00', '')
+                elif nelems == 1:
+                    attributes[name] = scalar_types[nc_type](unpack_scalar[nc_type](buf, pos)[0])
+                else:
+                    values = np.frombuffer(buf, dtype=nc_type, count=nelems, offset=pos)
+                    attributes[name] = values.astype(nc_type.newbyteorder('='))
+                pos += nbytes + (-nbytes % 4)
+            return pos, attributes
+
+        dim_names = []
+        dimensions = {}
+        pos, ndims = list_header(pos, NC_DIMENSION)
+        for _ in range(ndims):
+            pos, name = name_at(pos)
+            dim_names.append(name)
+            # The record (unlimited) dimension has a length of 0 in the header
+            dimensions[name] = unpack_count(buf, pos)[0] or numrecs
+            pos += count_size
+
+        pos, attributes = attributes_at(pos)
+
+        variables = {}
+        pos, nvars = list_header(pos, NC_VARIABLE)
+        for _ in range(nvars):
+            pos, name = name_at(pos)
+            ndims = unpack_count(buf, pos)[0]
+            pos += count_size
+            dimids = struct.unpack_from('>%d%s' % (ndims, count_struct.format[-1]), buf, pos)
+            pos += ndims * count_size
+            pos, var_attributes = attributes_at(pos)
+            nc_type = nc_types[unpack_int(buf, pos)[0]]
+            # Skip vsize and begin
+            pos += 4 + count_size + offset_size
+            variables[name] = NcVariableHeader(name, nc_type.newbyteorder('='),
+                                               [dim_names[i] for i in dimids],
+                                               var_attributes)
+    except struct.error:
+        # Unpacking past the end of the buffer
+        raise _Truncated()
+    if pos > size:
+        raise _Truncated()
+
+    data_model = {1: 'NETCDF3_CLASSIC', 2: 'NETCDF3_64BIT_OFFSET', 5: 'NETCDF3_64BIT_DATA'}[version]
+    return NcHeader(dimensions, attributes, variables, data_model)
+
+
+def read_classic_header(f):
+    '''
+    Parses the header of a classic, 64-bit offset or CDF-5 netCDF file
+
+    :param f: binary file object positioned at the start of the file
+    '''
+    buf = f.read(READ_SIZE)
+    if len(buf) < 4 or buf[:3] != b'CDF' or buf[3] not in (1, 2, 5):
+        raise ValueError("Not a classic netCDF file")
+    while True:
+        try:
+            return _parse_classic_header(buf)
+        except _Truncated:
+            # The header is larger than what was read so far
+            more = f.read(len(buf))
+            if not more:
+                raise ValueError("Truncated netCDF header")
+            buf += more
+
+
+def read_dataset_header(nc):
+    '''
+    Copies the header of an open netCDF4 Dataset
+
+    :param netCDF4.Dataset nc: An open netCDF4 Dataset
+    '''
+    variables = {
+        name: NcVariableHeader(name, ncvar.dtype, ncvar.dimensions,
+                               {attr: ncvar.getncattr(attr) for attr in ncvar.ncattrs()})
+        for name, ncvar in nc.variables.items()
+    }
+    return NcHeader({name: len(dim) for name, dim in nc.dimensions.items()},
+                    {attr: nc.getncattr(attr) for attr in nc.ncattrs()},
+                    variables, nc.data_model)
+
+
+def read_header(path):
+    '''
+    Returns the NcHeader of a netCDF file without reading the variables data
+
+    :param str path: Path to the netCDF file
+    '''
+    with open(path, 'rb') as f:
+        if f.read(3) == b'CDF':
+            f.seek(0)
+            return read_classic_header(f)
+    with Dataset(path, 'r') as nc:
+        return read_dataset_header(nc)
+
+
+def read_header_cached(path):
+    '''
+    Returns the NcHeader of a netCDF file, reusing the header read last time
+    if the file has the same mtime and size. The returned header is shared
+    between callers and must not be modified.
+
+    :param str path: Path to the netCDF file
+    '''
+    st = os.stat(path)
+    return _read_header_cached(path, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _read_header_cached(path, mtime_ns, size):
+    return read_header(path)
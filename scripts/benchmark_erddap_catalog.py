@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+scripts/benchmark_erddap_catalog.py
+
+Benchmarks building the ERDDAP dataset chunks of a synthetic catalog.
+
+A copy of the Murphy test file is placed in each of the synthetic deployment
+directories, real-time and delayed mode deployments alternate and every
+tenth deployment has an extra_atts.json. The chunks are built with
+build_erddap_catalog_chunk, as build_datasets_xml does, and the total and
+per chunk times are printed as JSON so runs can be compared.
+
+Example::
+
+    python scripts/benchmark_erddap_catalog.py -n 2000
+    python scripts/benchmark_erddap_catalog.py -n 2000 -j 4
+'''
+from argparse import ArgumentParser
+from scripts.build_erddap_catalog import ChunkDeployment, build_chunks
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+MURPHY = 'tests/data/Murphy-20150809T135508Z/Murphy-20150809T135508Z_rt.nc'
+
+
+def make_synthetic_catalog(data_root, deployments, template=MURPHY):
+    '''
+    Creates the deployment directories of a synthetic catalog and returns
+    their deployments
+
+    :param str data_root: Directory to create the deployment directories in
+    :param int deployments: Number of deployments
+    :param str template: Path to the netCDF file copied into each deployment
+    '''
+    latest_file = os.path.basename(template)
+    catalog = []
+    for i in range(deployments):
+        name = 'synthetic{:05d}-20150809T135508Z'.format(i)
+        deployment_dir = os.path.join('benchmark', name)
+        os.makedirs(os.path.join(data_root, deployment_dir))
+        shutil.copy(template, os.path.join(data_root, deployment_dir, latest_file))
+        if i % 10 == 0:
+            with open(os.path.join(data_root, deployment_dir, 'extra_atts.json'), 'w') as f:
+                json.dump({'_global_attrs': {'history': 'benchmark'},
+                           'depth': {'units': 'm'}}, f)
+        catalog.append(ChunkDeployment(name=name, deployment_dir=deployment_dir,
+                                       checksum='0' * 32, completed=i % 3 == 0,
+                                       delayed_mode=i % 2 == 1, latest_file=latest_file))
+    return catalog
+
+
+def bench_chunks(data_root, deployments, jobs):
+    '''
+    Builds the chunks of the deployments and returns the total time and the
+    time taken by each chunk, as seen by the caller
+    '''
+    times = []
+    start = last = time.perf_counter()
+    for deployment, chunk_result in build_chunks(data_root, deployments, jobs):
+        chunk_result()
+        now = time.perf_counter()
+        times.append(now - last)
+        last = now
+    return time.perf_counter() - start, times
+
+
+def main():
+    '''
+    Benchmark building the ERDDAP dataset chunks of a synthetic catalog
+    '''
+    args = get_args()
+    # only the errors of the chunk builder are of interest
+    logging.getLogger('scripts.build_erddap_catalog').setLevel(logging.WARNING)
+
+    data_root = tempfile.mkdtemp()
+    try:
+        deployments = make_synthetic_catalog(data_root, args.deployments, args.template)
+        runs = [bench_chunks(data_root, deployments, args.jobs) for _ in range(args.repeat)]
+    finally:
+        shutil.rmtree(data_root)
+
+    total, times = min(runs, key=lambda run: run[0])
+    report = {
+        'deployments': args.deployments,
+        'jobs': args.jobs,
+        'repeat': args.repeat,
+        'total_seconds': total,
+        'chunks_per_second': len(times) / total,
+        'chunk_seconds': {
+            'median': float(np.median(times)),
+            'p95': float(np.percentile(times, 95)),
+            'max': float(np.max(times)),
+        },
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+def get_args():
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-n', '--deployments', type=int, default=2000,
+                        help='Number of deployments of the synthetic catalog')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to build the chunks with')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs, the fastest is reported')
+    parser.add_argument('-t', '--template', default=MURPHY, help='netCDF file copied into each deployment')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
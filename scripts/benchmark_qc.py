@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+'''
+scripts/benchmark_qc.py
+
+Micro-benchmarks for the GliderQC threshold calculations.
+
+The Murphy test file variables are tiled up to the requested number of
+samples and the vectorized GliderQC implementations are timed against the
+previous list based implementations, which are kept here as a reference.
+
+With --writes, the bytes written to disk while storing the QC results of a
+file are compared between updating the file in place (run_qc) and rebuilding
+it with the QC results (write_qc_results, used by qc_task). Bytes are read
+from /proc/self/io, so this is only available on Linux.
+
+Example::
+
+    python scripts/benchmark_qc.py -n 100000
+    python scripts/benchmark_qc.py --writes
+'''
+from argparse import ArgumentParser
+from netCDF4 import Dataset
+from glider_qc.glider_qc import GliderQC, run_qc, compute_qc, write_qc_results
+import numpy as np
+import os
+import shutil
+import tempfile
+import timeit
+
+MURPHY = 'tests/data/Murphy-20150809T135508Z/Murphy-20150809T135508Z_rt.nc'
+
+
+def legacy_rate_of_change_threshold(values, times):
+    '''
+    List based rate of change threshold, as implemented before vectorization
+    '''
+    std = np.nanstd(values)
+    mean = np.nanmean(values)
+    list_values = []
+    list_times = []
+    for nn, xx in enumerate(values):
+        if (xx > (mean - std)) and (xx < (mean + std)):
+            list_values.append(values[nn])
+            list_times.append(times[nn])
+    roc = np.abs(np.diff(list_values) / np.diff(list_times).astype(float))
+    return np.max(roc)
+
+
+def legacy_spike_thresholds(values):
+    '''
+    List based spike thresholds, as implemented before vectorization
+    '''
+    valid_values = [x for x in values if not np.isnan(x)]
+    std = np.nanstd(valid_values)
+    return np.float64(1.0 * std), np.float64(2.0 * std)
+
+
+def load_samples(nc_path, var_name, size):
+    '''
+    Returns the time and values arrays of a variable tiled to size samples.
+    The time axis keeps increasing across the tiles.
+    '''
+    with Dataset(nc_path, 'r') as nc:
+        values = GliderQC.masked_to_nan(nc.variables[var_name][:])
+        times = nc.variables['time'][:].astype(np.float64)
+
+    reps = max(1, int(np.ceil(size / len(values))))
+    span = times[-1] - times[0] + 1
+    offsets = np.repeat(np.arange(reps) * span, len(times))
+    times = (np.tile(times, reps) + offsets)[:size].astype('datetime64[s]')
+    values = np.tile(values, reps)[:size]
+    return np.ma.masked_array(times), values
+
+
+def bench(func, number):
+    '''
+    Returns the best time per call of func in seconds
+    '''
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def bytes_written():
+    '''
+    Returns the number of bytes written by this process so far
+    '''
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('wchar:'):
+                return int(line.split()[1])
+
+
+def bench_writes(nc_path, config):
+    '''
+    Prints the bytes written to store the QC results of a file in place and
+    by rebuilding the file
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # check_time takes the deployment start time from the directory name
+        deployment_dir = os.path.join(tmpdir, 'benchmark-19700101T000000')
+        os.mkdir(deployment_dir)
+        path = os.path.join(deployment_dir, os.path.basename(nc_path))
+
+        shutil.copy(nc_path, path)
+        before = bytes_written()
+        with Dataset(path, 'r+') as nc:
+            run_qc(config, nc, path)
+        in_place = bytes_written() - before
+
+        shutil.copy(nc_path, path)
+        with Dataset(path, 'r') as nc:
+            results = compute_qc(config, nc, path)
+        before = bytes_written()
+        write_qc_results(path, results)
+        rebuilt = bytes_written() - before
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("{} size={} in_place={} bytes rebuilt={} bytes ratio={:.1f}x".format(
+        os.path.basename(nc_path), os.path.getsize(nc_path), in_place, rebuilt, in_place / rebuilt))
+
+
+def main():
+    '''
+    Benchmark the vectorized QC thresholds against the list based versions
+    '''
+    args = get_args()
+    if args.writes:
+        bench_writes(args.file, args.config)
+        return
+    qc = GliderQC(None)
+
+    for var_name in args.variables:
+        times, values = load_samples(args.file, var_name, args.samples)
+        # update_config drops the first and last values
+        values = values[1:-1]
+
+        new_roc = qc.get_rate_of_change_threshold(values, times)[0]
+        old_roc = legacy_rate_of_change_threshold(values, times)
+        new_spike = qc.get_spike_thresholds(values)[:2]
+        old_spike = legacy_spike_thresholds(values)
+        if new_roc != old_roc or new_spike != old_spike:
+            raise ValueError("Vectorized thresholds differ for %s" % var_name)
+
+        timings = [
+            ('rate_of_change',
+             bench(lambda: legacy_rate_of_change_threshold(values, times), args.number),
+             bench(lambda: qc.get_rate_of_change_threshold(values, times), args.number)),
+            ('spike',
+             bench(lambda: legacy_spike_thresholds(values), args.number),
+             bench(lambda: qc.get_spike_thresholds(values), args.number)),
+        ]
+        for name, legacy, vectorized in timings:
+            print("{:<12} {:<15} n={:<8} legacy={:.6f}s vectorized={:.6f}s speedup={:.1f}x".format(
+                var_name, name, len(values), legacy, vectorized, legacy / vectorized))
+
+
+def get_args():
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-f', '--file', default=MURPHY, help='netCDF file to take the samples from')
+    parser.add_argument('-n', '--samples', type=int, default=100000,
+                        help='Number of samples to tile the variables to')
+    parser.add_argument('--number', type=int, default=5, help='Number of calls per timing')
+    parser.add_argument('--writes', action='store_true',
+                        help='Compare the bytes written to store the QC results instead')
+    parser.add_argument('-c', '--config', default='data/qc_config.yml', help='QC configuration')
+    parser.add_argument('variables', nargs='*',
+                        default=['temperature', 'conductivity', 'salinity', 'density', 'pressure'],
+                        help='Variables to benchmark')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+'''
+scripts/benchmark_run_qc.py
+
+Benchmarks the QC of synthetic glider files.
+
+Synthetic files are generated from the Murphy test file, which provides the
+global attributes, the scalar variables and the variable attributes, with a
+configurable number of samples, number of geophysical variables, fraction of
+fill values and fractions of duplicate and out of order timestamps. Each
+stage of QC is timed with the GliderQC stage timings and the results are
+written as JSON, so runs can be compared to find regressions.
+
+Example::
+
+    python scripts/benchmark_run_qc.py -n 1000 10000 100000 -o results.json
+'''
+from argparse import ArgumentParser
+from netCDF4 import Dataset
+from glider_qc import glider_qc
+from glider_qc.glider_qc import StageTimings
+import ioos_qc
+import itertools
+import json
+import netCDF4
+import numpy as np
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+MURPHY = 'tests/data/Murphy-20150809T135508Z/Murphy-20150809T135508Z_rt.nc'
+
+# Geophysical variables of the template, in the order they are included
+GEOPHYSICAL_VARIABLES = ['temperature', 'conductivity', 'salinity', 'density', 'pressure']
+
+
+def synthetic_values(name, pressure, rng):
+    '''
+    Returns plausible values of a template variable given the pressure
+    '''
+    noise = rng.normal(scale=0.01, size=len(pressure))
+    if name == 'pressure':
+        return pressure
+    if name == 'depth':
+        return pressure * 0.993
+    if name == 'temperature':
+        return 30.0 - 0.08 * pressure + noise
+    if name == 'conductivity':
+        return 6.05 - 0.005 * pressure + noise / 10
+    if name == 'salinity':
+        return 36.3 + 0.002 * pressure + noise
+    if name == 'density':
+        return 1022.7 + 0.005 * pressure + noise
+    return np.zeros(len(pressure))
+
+
+def make_synthetic_file(path, samples, variables=len(GEOPHYSICAL_VARIABLES), fill_fraction=0.0,
+                        duplicate_fraction=0.0, out_of_order_fraction=0.0, seed=0, template=MURPHY):
+    '''
+    Writes a synthetic glider file shaped like the template file
+
+    :param str path: Path of the file to create
+    :param int samples: Number of samples along the time dimension
+    :param int variables: Number of geophysical variables to include
+    :param float fill_fraction: Fraction of the geophysical values set to the fill value
+    :param float duplicate_fraction: Fraction of timestamps duplicating the previous one
+    :param float out_of_order_fraction: Fraction of timestamps swapped with the previous one
+    :param int seed: Seed of the random number generator
+    :param str template: Path to the template glider file
+    '''
+    rng = np.random.default_rng(seed)
+    excluded = GEOPHYSICAL_VARIABLES[variables:]
+    excluded = set(excluded + ['{}_qc'.format(name) for name in excluded])
+
+    with Dataset(template, 'r') as src, Dataset(path, 'w', format=src.data_model) as dst:
+        src.set_auto_maskandscale(False)
+        src.set_auto_chartostring(False)
+        dst.set_auto_chartostring(False)
+        dst.setncatts({attr: src.getncattr(attr) for attr in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        src_time = src.variables['time'][:]
+        times = src_time[0] + np.arange(samples) * 10.0
+        dupes = rng.random(samples) < duplicate_fraction
+        dupes[0] = False
+        times[dupes] = times[np.flatnonzero(dupes) - 1]
+        for i in np.flatnonzero(rng.random(samples) < out_of_order_fraction):
+            if i > 0:
+                times[i - 1], times[i] = times[i], times[i - 1]
+        # triangle wave dives between the surface and 200 dbar
+        pressure = 200.0 * np.abs(((np.arange(samples) / 100.0) % 2) - 1)
+        lat = src.variables['lat'][0] + np.cumsum(rng.normal(scale=1e-6, size=samples))
+        lon = src.variables['lon'][0] + np.cumsum(rng.normal(scale=1e-6, size=samples))
+
+        for name, ncvar in src.variables.items():
+            if name in excluded:
+                continue
+            attributes = {attr: ncvar.getncattr(attr) for attr in ncvar.ncattrs()}
+            fill_value = attributes.pop('_FillValue', None)
+            dstvar = dst.createVariable(name, ncvar.dtype, ncvar.dimensions, fill_value=fill_value)
+            dstvar.setncatts(attributes)
+            dstvar.set_auto_maskandscale(False)
+
+            if ncvar.dimensions != ('time',):
+                if not ncvar.dimensions:
+                    value = ncvar.getValue()
+                    if name == 'profile_lat':
+                        value = np.mean(lat)
+                    elif name == 'profile_lon':
+                        value = np.mean(lon)
+                    elif name == 'profile_time':
+                        value = np.mean(times)
+                    dstvar.assignValue(value)
+                else:
+                    dstvar[:] = ncvar[:]
+                continue
+
+            if name == 'time':
+                values = times
+            elif name == 'lat':
+                values = lat
+            elif name == 'lon':
+                values = lon
+            else:
+                values = synthetic_values(name, pressure, rng)
+            values = values.astype(ncvar.dtype)
+            if name in GEOPHYSICAL_VARIABLES and fill_value is not None:
+                values[rng.random(samples) < fill_fraction] = fill_value
+            dstvar[:] = values
+
+
+def bench_file(path, config):
+    '''
+    Runs QC on a file once and returns the time spent in each stage
+    '''
+    timings = StageTimings()
+    with timings.stage('compute_qc'):
+        with Dataset(path, 'r') as nc:
+            results = glider_qc.compute_qc(config, nc, path, timings=timings)
+    with timings.stage('write_back'):
+        glider_qc.write_qc_results(path, results)
+    stages = dict(timings.stages)
+    stages['total'] = {
+        'seconds': stages['compute_qc']['seconds'] + stages['write_back']['seconds'],
+        'calls': 1,
+        'size': 0,
+    }
+    return stages
+
+
+def run_case(case, config, repeat, template):
+    '''
+    Benchmarks one combination of synthetic file parameters and returns the
+    median time of each stage across the repeats
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # check_time takes the deployment start time from the directory name
+        deployment_dir = os.path.join(tmpdir, 'synthetic-19700101T000000')
+        os.mkdir(deployment_dir)
+        path = os.path.join(deployment_dir, 'synthetic.nc')
+        runs = []
+        for i in range(repeat):
+            make_synthetic_file(path, seed=i, template=template, **case)
+            size = os.path.getsize(path)
+            runs.append(bench_file(path, config))
+            with Dataset(path, 'r') as nc:
+                comment = nc.dac_qc_comment
+    finally:
+        shutil.rmtree(tmpdir)
+
+    stages = {}
+    for stage in runs[0]:
+        stages[stage] = {
+            'seconds': float(np.median([run[stage]['seconds'] for run in runs if stage in run])),
+            'calls': runs[0][stage]['calls'],
+            'size': runs[0][stage]['size'],
+        }
+    return dict(case, file_size=size, repeat=repeat, stages=stages, dac_qc_comment=comment)
+
+
+def main():
+    '''
+    Benchmark QC stages on synthetic glider files
+    '''
+    args = get_args()
+    cases = [
+        {
+            'samples': samples,
+            'variables': variables,
+            'fill_fraction': fill_fraction,
+            'duplicate_fraction': duplicate_fraction,
+            'out_of_order_fraction': out_of_order_fraction,
+        }
+        for samples, variables, fill_fraction, duplicate_fraction, out_of_order_fraction in itertools.product(
+            args.samples, args.variables, args.fill_fraction, args.duplicate_fraction,
+            args.out_of_order_fraction)
+    ]
+
+    results = []
+    for case in cases:
+        result = run_case(case, args.config, args.repeat, args.template)
+        results.append(result)
+        print("samples={samples} variables={variables} fill={fill_fraction} "
+              "duplicates={duplicate_fraction} out_of_order={out_of_order_fraction} "
+              "total={total:.4f}s".format(total=result['stages']['total']['seconds'], **case),
+              file=sys.stderr)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'netCDF4': netCDF4.__version__,
+            'ioos_qc': getattr(ioos_qc, '__version__', None),
+            'platform': platform.platform(),
+        },
+        'config': args.config,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def get_args():
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-n', '--samples', type=int, nargs='+', default=[1000, 10000],
+                        help='Numbers of samples of the synthetic files')
+    parser.add_argument('-v', '--variables', type=int, nargs='+', default=[len(GEOPHYSICAL_VARIABLES)],
+                        choices=range(1, len(GEOPHYSICAL_VARIABLES) + 1),
+                        help='Numbers of geophysical variables of the synthetic files')
+    parser.add_argument('--fill-fraction', type=float, nargs='+', default=[0.0],
+                        help='Fractions of geophysical values set to the fill value')
+    parser.add_argument('--duplicate-fraction', type=float, nargs='+', default=[0.0],
+                        help='Fractions of duplicated timestamps')
+    parser.add_argument('--out-of-order-fraction', type=float, nargs='+', default=[0.0],
+                        help='Fractions of out of order timestamps')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of each case, the median is reported')
+    parser.add_argument('-c', '--config', default='data/qc_config.yml', help='QC configuration')
+    parser.add_argument('-t', '--template', default=MURPHY, help='Glider file the synthetic files are based on')
+    parser.add_argument('-o', '--output', help='File to write the JSON results to, stdout by default')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -31,22 +31,26 @@ attribute and the depth variable's units attribute is below
 """
 
 import argparse
-import fileinput
+import errno
 import glob
+import hashlib
 import json
 import logging
 import numpy as np
 import os
-import shutil
 import redis
+import stat
 import sys
-from io import StringIO
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import deepcopy
+from functools import lru_cache, partial
 from collections import defaultdict
 from datetime import datetime, timezone
 from glider_dac import app, db
+from glider_util import ncheader
 from jinja2 import Template
 from lxml import etree
-from netCDF4 import Dataset
 from pathlib import Path
 import requests
 from scripts.sync_erddap_datasets import sync_deployment
@@ -80,6 +84,10 @@ erddap_mapping_dict = defaultdict(lambda: "String",
 # The directory where the XML templates exist
 template_dir = Path(__file__).parent.parent / "glider_dac" / "erddap" / "templates"
 
+# Sizes, mtimes and hashes of the files datasets.xml was last assembled from,
+# kept next to datasets.xml to only rewrite it when its contents change
+manifest_name = 'datasets.manifest.json'
+
 # Connect to redis to keep track of the last time this script ran
 redis_key = 'build_erddap_catalog_last_run_deployment'
 redis_host = app.config.get('REDIS_HOST', 'redis')
@@ -104,161 +112,334 @@ def inactive_datasets(deployments_set):
 
     return erddap_contents_set - deployments_set
 
-def build_datasets_xml(data_root, catalog_root, force):
+class ChunkDeployment(dict):
     """
-    Cats together the head, all fragments, and foot of a datasets.xml
+    The deployment fields a dataset chunk is built from, as a plain dict with
+    attribute access like the Mongo models, so it can be sent to worker
+    processes.
     """
-    head_path = os.path.join(template_dir, 'datasets.head.xml')
-    tail_path = os.path.join(template_dir, 'datasets.tail.xml')
+    fields = ('name', 'deployment_dir', 'checksum', 'completed', 'delayed_mode',
+              'latest_file')
 
-    # First update the chunks of datasets.xml that need updating
-    # TODO: Can we use glider_dac_watchdog to trigger the chunk creation?
-    deployment_names = ((dep["name"], dep["deployment_dir"]) for dep in
-                         db.Deployment.find({}, {'name': True,
-                                                 'deployment_dir': True}))
-    for deployment_name, deployment_dir in deployment_names:
-        dataset_chunk_path = os.path.join(data_root, deployment_dir, 'dataset.xml')
-        # base query to which we may add filtering to see if previously run
-        query = ({"name": deployment_name})
+    __getattr__ = dict.get
+
+    @classmethod
+    def from_deployment(cls, deployment):
+        return cls((field, deployment.get(field)) for field in cls.fields)
+
+
+def build_chunks(data_root, deployments, jobs=1):
+    """
+    Builds the dataset chunks of the deployments, across a pool of processes
+    when jobs is more than 1. Yields each deployment with a callable that
+    returns its chunk contents or raises the error that occurred building it,
+    in the order the chunks finish.
+
+    :param str data_root: The root directory where netCDF files are read from
+    :param list deployments: ChunkDeployment of each chunk to build
+    :param int jobs: Number of processes to build the chunks with
+    """
+    if jobs > 1 and len(deployments) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(build_erddap_catalog_chunk, data_root, deployment): deployment
+                       for deployment in deployments}
+            for future in as_completed(futures):
+                yield futures[future], future.result
+    else:
+        for deployment in deployments:
+            yield deployment, partial(build_erddap_catalog_chunk, data_root, deployment)
+
+
+def write_atomic(path, contents, in_place_fallback=False):
+    """
+    Writes contents to path through a temporary file in the same directory,
+    so readers never see a partially written file.
+
+    :param str path: Path of the file to write
+    :param str contents: Contents of the file
+    :param bool in_place_fallback: Write the file in place when it can't be
+                                   replaced, such as when it is bind mounted
+                                   on its own into a container
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        # mkstemp creates the file readable by the owner only
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+        try:
+            os.replace(tmp_path, path)
+        except OSError as e:
+            if not in_place_fallback or e.errno not in (errno.EBUSY, errno.EXDEV):
+                raise
+            logger.warning("Could not replace {} ({}), writing it in place".format(path, e))
+            os.unlink(tmp_path)
+            write_in_place(path, contents)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_in_place(path, contents):
+    """
+    Truncates and rewrites a file, keeping its inode. The contents are fully
+    assembled beforehand so the file is only partially written for as long
+    as the write takes.
+
+    :param str path: Path of the file to write
+    :param str contents: Contents of the file
+    """
+    with open(path, 'w') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def deployments_to_build(data_root, deployments, force):
+    """
+    Returns a ChunkDeployment for each deployment whose chunk needs building:
+    the deployments updated since their chunk was last built, and all the
+    deployments with a chunk when forced. The last build times are read from
+    redis in a single request.
+
+    :param str data_root: The root directory where netCDF files are read from
+    :param list deployments: Deployments of the catalog
+    :param bool force: Build the chunks of all the deployments
+    """
+    try:
+        last_runs = _redis.hgetall(redis_key)
+    except Exception:
+        logger.exception("Error: Reading the last runs from redis. Processing all datasets.")
+        last_runs = None
+
+    updated_deployments = []
+    for deployment in deployments:
+        dataset_chunk_path = os.path.join(data_root, deployment.deployment_dir, 'dataset.xml')
 
         # from De Morgan's Laws - not cond1 or not cond2 = not (cond1 and cond2)
         # we want to run the "caching" logic only if force flag isn't set and
         # we are aren't missing the dataset.xml snippet file for this deployment
-        if not (force and os.path.exists(dataset_chunk_path)):
+        if not (force and os.path.exists(dataset_chunk_path)) and last_runs is not None:
             # Get datasets that have been updated since the last time this script ran
             try:
-                last_run_ts = _redis.hget(redis_key, deployment_name) or 0
+                last_run_ts = last_runs.get(deployment.name.encode('utf-8')) or 0
                 last_run = datetime.utcfromtimestamp(int(last_run_ts))
             except Exception:
-                logger.error("Error: Parsing last run for {}. ".format(deployment.name),
-                             "Processing dataset anyway.")
+                logger.error("Error: Parsing last run for {}. "
+                             "Processing dataset anyway.".format(deployment.name))
             else:
                 # there is a chance that the updated field won't be set if
                 # model.save() has no files
-                query['updated'] = {'$gte': last_run}
-        deployment = db.Deployment.find_one(query)
-        # if we couldn't find the deployment, usually due to update time not
-        # being recent, skip this deployment
-        if not deployment:
-            continue
+                if deployment.updated is None or deployment.updated < last_run:
+                    continue
+        updated_deployments.append(ChunkDeployment.from_deployment(deployment))
+    return updated_deployments
 
 
+def build_datasets_xml(data_root, catalog_root, force, jobs=1):
+    """
+    Cats together the head, all fragments, and foot of a datasets.xml
+
+    :param str data_root: The root directory where netCDF files are read from
+    :param str catalog_root: The directory datasets.xml is written to
+    :param bool force: Build the chunks of all the deployments
+    :param int jobs: Number of processes to build the chunks with
+    """
+    head_path = os.path.join(template_dir, 'datasets.head.xml')
+    tail_path = os.path.join(template_dir, 'datasets.tail.xml')
+
+    # All the deployments, fetched once for both the chunk updates and the
+    # datasets.xml assembly
+    deployments = list(db.Deployment.find({}, {field: True for field in
+                                               ChunkDeployment.fields + ('updated',)}))
+
+    # First update the chunks of datasets.xml that need updating
+    # TODO: Can we use glider_dac_watchdog to trigger the chunk creation?
+    updated_deployments = deployments_to_build(data_root, deployments, force)
+    for deployment, chunk_result in build_chunks(data_root, updated_deployments, jobs):
+        dataset_chunk_path = os.path.join(data_root, deployment.deployment_dir, 'dataset.xml')
         try:
-            chunk_contents = build_erddap_catalog_chunk(data_root, deployment)
+            chunk_contents = chunk_result()
         except Exception:
-            logger.exception("Error: creating dataset chunk for {}".format(deployment_dir))
+            logger.exception("Error: creating dataset chunk for {}".format(deployment.deployment_dir))
         # only attempt to write file if we were able to generate an XML snippet
         # successfully
         else:
             try:
-                with open(dataset_chunk_path, 'w') as f:
-                    f.write(chunk_contents)
-                    # Set the timestamp of this deployment run in redis
+                write_atomic(dataset_chunk_path, chunk_contents)
+                # Set the timestamp of this deployment run in redis
                 dt_now = datetime.now(tz=timezone.utc)
-                _redis.hset(redis_key, deployment_name, int(dt_now.timestamp()))
+                _redis.hset(redis_key, deployment.name, int(dt_now.timestamp()))
             except:
                 logger.exception("Could not write ERDDAP dataset snippet XML file {}".format(dataset_chunk_path))
 
 
     # Now loop through all the deployments and construct datasets.xml
-    # store in buffer first to avoid writing unfinished XML to datasets.xml
     ds_path = os.path.join(catalog_root, 'datasets.xml')
+    manifest_path = os.path.join(catalog_root, manifest_name)
     deployments_name_set = set()
-    deployments = db.Deployment.find()  # All deployments now
-    buf = StringIO()
-    for line in fileinput.input([head_path]):
-        buf.write(line)
     # for each deployment, get the dataset chunk
+    chunk_paths = []
     for deployment in deployments:
         deployments_name_set.add(deployment.name)
         # First check that a chunk exists
         dataset_chunk_path = os.path.join(data_root, deployment.deployment_dir,
                                           'dataset.xml')
         if os.path.isfile(dataset_chunk_path):
-            for line in fileinput.input([dataset_chunk_path]):
-                buf.write(line)
+            chunk_paths.append(dataset_chunk_path)
 
-    inactive_deployment_names = inactive_datasets(deployments_name_set)
+    # sorted so the same inactive datasets always produce the same catalog
+    inactive_deployment_names = sorted(inactive_datasets(deployments_name_set))
 
-    for inactive_deployment in inactive_deployment_names:
-        buf.write('\n<dataset type="EDDTableFromNcFiles" datasetID="{}" active="false"></dataset>'.format(
-                    inactive_deployment))
+    manifest = load_manifest(manifest_path)
+    previous_files = manifest.get('files', {})
+    files = {}
+    for path in [head_path] + chunk_paths + [tail_path]:
+        try:
+            files[path] = file_manifest_entry(path, previous_files.get(path))
+        except OSError:
+            # the chunk was removed since it was listed
+            logger.exception("Could not read {}".format(path))
+    chunk_paths = [path for path in chunk_paths if path in files]
+    digest = catalog_digest([head_path] + chunk_paths + [tail_path], files,
+                            inactive_deployment_names)
+
+    if digest == manifest.get('digest') and same_stat(ds_path, manifest.get('datasets')):
+        logger.info("{} is up to date with {} deployments".format(ds_path, len(deployments)))
+    else:
+        # assemble in memory first to avoid writing unfinished XML to datasets.xml
+        parts = [read_text(head_path)]
+        parts.extend(read_text(path) for path in chunk_paths)
+        for inactive_deployment in inactive_deployment_names:
+            parts.append('\n<dataset type="EDDTableFromNcFiles" datasetID="{}" active="false"></dataset>'.format(
+                         inactive_deployment))
+        parts.append(read_text(tail_path))
+        try:
+            # datasets.xml is bind mounted on its own in docker-compose.yml
+            write_atomic(ds_path, ''.join(parts), in_place_fallback=True)
+        except OSError:
+            logger.exception("Could not write to datasets.xml")
+            digest = None
+        else:
+            logger.info("Wrote {} from {} deployments".format(ds_path, len(deployments)))
+        finally:
+            del parts
 
-    for line in fileinput.input([tail_path]):
-        buf.write(line)
-    # now try moving the file to update datasets.xml
-    #shutil.move(ds_tmp_path, ds_path)
     try:
-        with open(ds_path, 'w') as fd:
-          buf.seek(0)
-          fd.truncate(0)
-          shutil.copyfileobj(buf, fd)
+        ds_stat = os.stat(ds_path)
+        new_manifest = {
+            'digest': digest,
+            'datasets': {'size': ds_stat.st_size, 'mtime': ds_stat.st_mtime_ns},
+            'files': files,
+        }
+        if new_manifest != manifest:
+            write_atomic(manifest_path, json.dumps(new_manifest))
     except OSError:
-        logger.exception("Could not write to datasets.xml")
-    finally:
-         del buf
+        logger.exception("Could not write the datasets.xml manifest {}".format(manifest_path))
 
-    logger.info("Wrote {} from {} deployments".format(ds_path, deployments.count()))
     # issue flag refresh to remove inactive deployments after datasets.xml written
     for inactive_deployment_name in inactive_deployment_names:
         sync_deployment(inactive_deployment_name)
 
-def variable_sort_function(element):
+
+def load_manifest(path):
     """
-    Sorts by ERDDAP variable destinationName, or by
-    sourceName if the former is not available.
+    Returns the manifest of the files the last datasets.xml was assembled
+    from, or an empty manifest if there is none.
+
+    :param str path: Path to the manifest
     """
-    elem_list = (element.xpath("destinationName/text()") or
-                 element.xpath("sourceName/text()"))
-    # sort case insensitive
     try:
-        return elem_list[0].lower()
-    # If there's no source or destination name, or type is not a string,
-    # assume a blank string.
-    # This is probably not valid in datasets.xml, but we have to do something.
-    except (IndexError, AttributeError):
-        return ""
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        logger.exception("Could not read the datasets.xml manifest {}".format(path))
+        return {}
 
-def build_erddap_catalog_chunk(data_root, deployment):
+
+def file_manifest_entry(path, previous=None):
     """
-    Builds an ERDDAP dataset xml chunk.
+    Returns the size, mtime and hash of a file. The hash of the previous
+    entry is kept without reading the file if its size and mtime match.
 
-    :param str data_root: The root directory where netCDF files are read from
-    :param mongo.Deployment deployment: Mongo deployment model
+    :param str path: Path to the file
+    :param dict previous: Entry of the file in the previous manifest
     """
-    deployment_dir = deployment.deployment_dir
-    logger.info("Building ERDDAP catalog chunk for {}".format(deployment_dir))
+    st = os.stat(path)
+    if (previous and previous.get('size') == st.st_size and
+            previous.get('mtime') == st.st_mtime_ns):
+        return previous
+    with open(path, 'rb') as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha1': sha1}
 
-    dir_path = os.path.join(data_root, deployment_dir)
 
-    checksum = (deployment.checksum or '').strip()
-    completed = deployment.completed
-    delayed_mode = deployment.delayed_mode
+def catalog_digest(paths, files, inactive_deployment_names):
+    """
+    Returns a digest of the contents of a datasets.xml assembled from the
+    files, in order, and the inactive datasets.
 
-    # look for a file named extra_atts.json that provides
-    # variable and/or global attributes to add and/or modify
-    # An example of extra_atts.json file is in the module docstring
-    extra_atts = {"_global_attrs": {}}
-    extra_atts_file = os.path.join(dir_path, "extra_atts.json")
-    if os.path.isfile(extra_atts_file):
-        logger.info("extra_atts.json file found in {}".format(deployment_dir))
-        try:
-            with open(extra_atts_file) as f:
-                extra_atts = json.load(f)
-        except Exception:
-            logger.exception("Error loading file: {}".format(extra_atts_file))
+    :param list paths: Paths of the files datasets.xml is assembled from
+    :param dict files: Manifest entry of each file
+    :param list inactive_deployment_names: Names of the inactive datasets
+    """
+    content = [(path, files[path]['sha1']) for path in paths]
+    return hashlib.sha1(json.dumps([content, inactive_deployment_names]).encode('utf-8')).hexdigest()
 
-    # Get the latest file from the DB (and double check just in case)
-    if (deployment.latest_file is None or
-        not os.path.isfile(os.path.join(dir_path, deployment.latest_file))):
-        latest_file = get_latest_nc_file(dir_path)
-    else:
-        latest_file = deployment.latest_file
 
-    if latest_file is None:
-        raise IOError('No nc files found in deployment {}'.format(deployment_dir))
+def same_stat(path, entry):
+    """
+    Returns whether the size and mtime of a file match a manifest entry,
+    False if the file does not exist.
+
+    :param str path: Path to the file
+    :param dict entry: Manifest entry, with the size and mtime of the file
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return bool(entry) and entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime_ns
+
+
+def read_text(path):
+    """
+    Returns the contents of a text file
+    """
+    with open(path) as f:
+        return f.read()
+
 
-    core_variables = etree.fromstring("""
+def variable_sort_function(element):
+    """
+    Sorts by ERDDAP variable destinationName, or by
+    sourceName if the former is not available.
+    """
+    # findtext is much cheaper than evaluating an XPath for every variable
+    name = (element.findtext("destinationName") or
+            element.findtext("sourceName"))
+    # sort case insensitive
+    try:
+        return name.lower()
+    # If there's no source or destination name, or type is not a string,
+    # assume a blank string.
+    # This is probably not valid in datasets.xml, but we have to do something.
+    except AttributeError:
+        return ""
+
+
+# ERDDAP variables of every dataset, parsed once and copied into each chunk
+core_variables_template = etree.fromstring("""
     <test>
     <dataVariable>
         <sourceName>trajectory</sourceName>
@@ -344,9 +525,9 @@ def build_erddap_catalog_chunk(data_root, deployment):
         </addAttributes>
     </dataVariable>
     </test>
-    """).findall("dataVariable")
+""")
 
-    common_variables = etree.fromstring(f"""
+common_variables_template = etree.fromstring("""
     <test>
     <dataVariable>
         <sourceName>pressure</sourceName>
@@ -516,157 +697,200 @@ def build_erddap_catalog_chunk(data_root, deployment):
         </addAttributes>
     </dataVariable>
     </test>
-    """).findall("dataVariable")
-
-    required_qartod_vars = {
-            'qartod_conductivity_flat_line_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_electrical_conductivity',
-                'standard_name': 'flat_line_test_quality_flag'
-            },
-            'qartod_conductivity_gross_range_flag': {
-                'long_name': 'QARTOD Gross Range Test for sea_water_electrical_conductivity',
-                'standard_name': 'gross_range_test_quality_flag'
-            },
-            'qartod_conductivity_rate_of_change_flag': {
-                'long_name': 'QARTOD Rate of Change Test for sea_water_electrical_conductivity',
-                'standard_name': 'rate_of_change_test_quality_flag'
-            },
-            'qartod_conductivity_spike_flag': {
-                'long_name': 'QARTOD Spike Test for sea_water_electrical_conductivity',
-                'standard_name': 'spike_test_quality_flag'
-            },
-            'qartod_conductivity_primary_flag': {
-                'long_name': 'QARTOD Primary Flag for sea_water_electrical_conductivity',
-                'standard_name': 'aggregate_quality_flag'
-            },
-            'qartod_density_flat_line_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_density ',
-                'standard_name': 'flat_line_test_quality_flag'
-            },
-            'qartod_density_gross_range_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_density ',
-                'standard_name': 'gross_range_test_quality_flag'
-            },
-            'qartod_density_primary_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_density ',
-                'standard_name': 'aggregate_quality_flag'
-            },
-            'qartod_density_rate_of_change_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_density ',
-                'standard_name': 'rate_of_change_test_quality_flag'
-            },
-            'qartod_density_spike_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_density',
-                'standard_name': 'spike_test_quality_flag'
-            },
-            'qartod_pressure_flat_line_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
-                'standard_name': 'flat_line_test_quality_flag'
-            },
-            'qartod_pressure_gross_range_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
-                'standard_name': 'gross_range_test_quality_flag'
-            },
-            'qartod_pressure_primary_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
-                'standard_name': 'aggregate_quality_flag'
-            },
-            'qartod_pressure_rate_of_change_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
-                'standard_name': 'rate_of_change_test_quality_flag'
-            },
-            'qartod_pressure_spike_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
-                'standard_name': 'spike_test_quality_flag'
-            },
-            'qartod_salinity_flat_line_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
-                'standard_name': 'flat_line_test_quality_flag'
-            },
-            'qartod_salinity_gross_range_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
-                'standard_name': 'gross_range_test_quality_flag'
-            },
-            'qartod_salinity_primary_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
-                'standard_name': 'aggregate_quality_flag'
-            },
-            'qartod_salinity_rate_of_change_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
-                'standard_name': 'rate_of_change_test_quality_flag'
-            },
-            'qartod_salinity_spike_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
-                'standard_name': 'spike_test_quality_flag'
-            },
-            'qartod_temperature_flat_line_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
-                'standard_name': 'flat_line_test_quality_flag'
-            },
-            'qartod_temperature_gross_range_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
-                'standard_name': 'gross_range_test_quality_flag'
-            },
-            'qartod_temperature_primary_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
-                'standard_name':  'aggregate_quality_flag'
-            },
-            'qartod_temperature_rate_of_change_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
-                'standard_name': 'rate_of_change_test_quality_flag'
-            },
-            'qartod_temperature_spike_flag': {
-                'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
-                'standard_name': 'spike_test_quality_flag'
-            },
-            'qartod_location_test_flag': {
-                'long_name': 'QARTOD Location Test for longitude and latitude',
-                'standard_name': 'location_test_quality_flag'
-            },
-        }
+""")
+
+required_qartod_vars = {
+    'qartod_conductivity_flat_line_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_electrical_conductivity',
+        'standard_name': 'flat_line_test_quality_flag'
+    },
+    'qartod_conductivity_gross_range_flag': {
+        'long_name': 'QARTOD Gross Range Test for sea_water_electrical_conductivity',
+        'standard_name': 'gross_range_test_quality_flag'
+    },
+    'qartod_conductivity_rate_of_change_flag': {
+        'long_name': 'QARTOD Rate of Change Test for sea_water_electrical_conductivity',
+        'standard_name': 'rate_of_change_test_quality_flag'
+    },
+    'qartod_conductivity_spike_flag': {
+        'long_name': 'QARTOD Spike Test for sea_water_electrical_conductivity',
+        'standard_name': 'spike_test_quality_flag'
+    },
+    'qartod_conductivity_primary_flag': {
+        'long_name': 'QARTOD Primary Flag for sea_water_electrical_conductivity',
+        'standard_name': 'aggregate_quality_flag'
+    },
+    'qartod_density_flat_line_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_density ',
+        'standard_name': 'flat_line_test_quality_flag'
+    },
+    'qartod_density_gross_range_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_density ',
+        'standard_name': 'gross_range_test_quality_flag'
+    },
+    'qartod_density_primary_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_density ',
+        'standard_name': 'aggregate_quality_flag'
+    },
+    'qartod_density_rate_of_change_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_density ',
+        'standard_name': 'rate_of_change_test_quality_flag'
+    },
+    'qartod_density_spike_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_density',
+        'standard_name': 'spike_test_quality_flag'
+    },
+    'qartod_pressure_flat_line_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
+        'standard_name': 'flat_line_test_quality_flag'
+    },
+    'qartod_pressure_gross_range_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
+        'standard_name': 'gross_range_test_quality_flag'
+    },
+    'qartod_pressure_primary_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
+        'standard_name': 'aggregate_quality_flag'
+    },
+    'qartod_pressure_rate_of_change_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
+        'standard_name': 'rate_of_change_test_quality_flag'
+    },
+    'qartod_pressure_spike_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_pressure',
+        'standard_name': 'spike_test_quality_flag'
+    },
+    'qartod_salinity_flat_line_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
+        'standard_name': 'flat_line_test_quality_flag'
+    },
+    'qartod_salinity_gross_range_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
+        'standard_name': 'gross_range_test_quality_flag'
+    },
+    'qartod_salinity_primary_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
+        'standard_name': 'aggregate_quality_flag'
+    },
+    'qartod_salinity_rate_of_change_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
+        'standard_name': 'rate_of_change_test_quality_flag'
+    },
+    'qartod_salinity_spike_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_practical_salinity',
+        'standard_name': 'spike_test_quality_flag'
+    },
+    'qartod_temperature_flat_line_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
+        'standard_name': 'flat_line_test_quality_flag'
+    },
+    'qartod_temperature_gross_range_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
+        'standard_name': 'gross_range_test_quality_flag'
+    },
+    'qartod_temperature_primary_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
+        'standard_name':  'aggregate_quality_flag'
+    },
+    'qartod_temperature_rate_of_change_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
+        'standard_name': 'rate_of_change_test_quality_flag'
+    },
+    'qartod_temperature_spike_flag': {
+        'long_name': 'QARTOD Flat Line Test for sea_water_temperature',
+        'standard_name': 'spike_test_quality_flag'
+    },
+    'qartod_location_test_flag': {
+        'long_name': 'QARTOD Location Test for longitude and latitude',
+        'standard_name': 'location_test_quality_flag'
+    },
+}
+
+existing_varnames = {'trajectory', 'wmo_id', 'platform', 'instrument_ctd',
+                     'profile_id', 'profile_time', 'profile_lat', 'profile_lon',
+                     'time', 'depth', 'lat', 'lon',
+                     'pressure', 'temperature', 'conductivity', 'salinity', 'density',
+                     'time_uv', 'lat_uv', 'lon_uv', 'u', 'v'}
 
-    existing_varnames = {'trajectory', 'wmo_id', 'platform', 'instrument_ctd',
-                         'profile_id', 'profile_time', 'profile_lat', 'profile_lon',
-                         'time', 'depth', 'lat', 'lon',
-                         'pressure', 'temperature', 'conductivity', 'salinity', 'density',
-                         'time_uv', 'lat_uv', 'lon_uv', 'u', 'v'}
 
+def build_erddap_catalog_chunk(data_root, deployment):
+    """
+    Builds an ERDDAP dataset xml chunk.
+
+    :param str data_root: The root directory where netCDF files are read from
+    :param mongo.Deployment deployment: Mongo deployment model
+    """
+    deployment_dir = deployment.deployment_dir
+    logger.info("Building ERDDAP catalog chunk for {}".format(deployment_dir))
+
+    dir_path = os.path.join(data_root, deployment_dir)
+
+    checksum = (deployment.checksum or '').strip()
+    completed = deployment.completed
+    delayed_mode = deployment.delayed_mode
+
+    # look for a file named extra_atts.json that provides
+    # variable and/or global attributes to add and/or modify
+    # An example of extra_atts.json file is in the module docstring
+    extra_atts = {"_global_attrs": {}}
+    extra_atts_file = os.path.join(dir_path, "extra_atts.json")
+    if os.path.isfile(extra_atts_file):
+        logger.info("extra_atts.json file found in {}".format(deployment_dir))
+        try:
+            with open(extra_atts_file) as f:
+                extra_atts = json.load(f)
+        except Exception:
+            logger.exception("Error loading file: {}".format(extra_atts_file))
+
+    # Get the latest file from the DB (and double check just in case)
+    if (deployment.latest_file is None or
+        not os.path.isfile(os.path.join(dir_path, deployment.latest_file))):
+        latest_file = get_latest_nc_file(dir_path)
+    else:
+        latest_file = deployment.latest_file
+
+    if latest_file is None:
+        raise IOError('No nc files found in deployment {}'.format(deployment_dir))
+
+    # the templates are parsed once, each chunk gets its own copy of the variables
+    core_variables = deepcopy(core_variables_template).findall("dataVariable")
+    common_variables = deepcopy(common_variables_template).findall("dataVariable")
 
     nc_file = os.path.join(data_root, deployment_dir, latest_file)
 
-    with Dataset(nc_file, 'r') as ds:
+    ds = ncheader.read_header_cached(nc_file)
 
-        qartod_var_type = check_for_qartod_vars(ds)
+    qartod_var_type = check_for_qartod_vars(ds)
 
-        exclude_vars = (existing_varnames | {'latitude', 'longitude'})
+    exclude_vars = (existing_varnames | {'latitude', 'longitude'})
 
-        all_other_vars = [add_erddap_var_elem(var) for var in
-                          ds.get_variables_by_attributes(name=lambda n: n not in exclude_vars)]
+    all_other_vars = [add_erddap_var_elem(var) for var in
+                      ds.get_variables_by_attributes(name=lambda n: n not in exclude_vars)]
 
-        gts_ingest = getattr(ds, 'gts_ingest', 'true')  # Set default value to true
+    gts_ingest = getattr(ds, 'gts_ingest', 'true')  # Set default value to true
 
-        # Exclude automatic QARTOD variables if the dataset is delayed mode
-        # This will keep any user supplied QARTOD variables, they should be part of
-        # `all_other_vars` already
-        qartod_vars_snippet = (qartod_var_snippets(required_qartod_vars,
-                                                   qartod_var_type)
-                               if not deployment.delayed_mode else [])
+    # Exclude automatic QARTOD variables if the dataset is delayed mode
+    # This will keep any user supplied QARTOD variables, they should be part of
+    # `all_other_vars` already
+    qartod_vars_snippet = (qartod_var_snippets(required_qartod_vars,
+                                               qartod_var_type)
+                           if not deployment.delayed_mode else [])
 
-        vars_sorted = sorted(common_variables +
-                             qartod_vars_snippet + all_other_vars,
-                             key=variable_sort_function)
+    vars_sorted = sorted(common_variables +
+                         qartod_vars_snippet + all_other_vars,
+                         key=variable_sort_function)
 
-        variable_order = core_variables + vars_sorted
+    variable_order = core_variables + vars_sorted
 
-        # Add any of the extra variables and attributes
-        reload_template = "<reloadEveryNMinutes>{}</reloadEveryNMinutes>"
-        if completed or delayed_mode:
-            reload_settings = reload_template.format(720)
-        else:
-            reload_settings = reload_template.format(10)
+    # Add any of the extra variables and attributes
+    reload_template = "<reloadEveryNMinutes>{}</reloadEveryNMinutes>"
+    if completed or delayed_mode:
+        reload_settings = reload_template.format(720)
+    else:
+        reload_settings = reload_template.format(10)
 
-        try:
-            tree = etree.fromstring(rf"""
+    try:
+        tree = etree.fromstring(rf"""
                     <dataset type="EDDTableFromNcFiles" datasetID="{deployment.name}" active="true">
                         <!-- defaultDataQuery uses datasetID -->
                         <!--
@@ -703,30 +927,61 @@ def build_erddap_catalog_chunk(data_root, deployment):
                             <att name="gts_ingest">{gts_ingest}</att>
                         </addAttributes>
                     </dataset>
-                """)
-
-            for var in variable_order:
-                tree.append(var)
-            for identifier, mod_attrs in extra_atts.items():
-                add_extra_attributes(tree, identifier, mod_attrs)
-        except Exception:
-            logger.exception("Exception occurred while adding atts to template: {}".format(deployment_dir))
-        finally:
-            return etree.tostring(tree, encoding=str)
+            """)
+
+        for var in variable_order:
+            tree.append(var)
+        for identifier, mod_attrs in extra_atts.items():
+            add_extra_attributes(tree, identifier, mod_attrs)
+    except Exception:
+        logger.exception("Exception occurred while adding atts to template: {}".format(deployment_dir))
+    finally:
+        return etree.tostring(tree, encoding=str)
 
 
 def qartod_var_snippets(required_qartod_vars, qartod_var_type):
 
+    # copying the parsed snippets at once is much cheaper than one at a time
+    snippets = deepcopy(qartod_var_snippets_template(tuple(
+        (req_var, template['long_name'], template['standard_name'])
+        for req_var, template in required_qartod_vars.items())))
+
     var_list = []
-    for req_var, template in list(required_qartod_vars.items()):
+    for req_var, snippet in zip(required_qartod_vars, snippets):
 
         # If the required QARTOD variable isn't already defined,
         # then supply a set of default attributes.
 
         if req_var in qartod_var_type['qartod']:
             continue
-        else:
-            flag_atts = """
+
+        var_list.append(snippet)
+
+    return var_list
+
+
+@lru_cache(maxsize=None)
+def qartod_var_snippets_template(required_qartod_vars):
+    """
+    Returns an element holding the dataVariable with the default attributes
+    of each required QARTOD variable, in order. The snippets are parsed once
+    and cached, callers must copy the element before modifying it.
+
+    :param tuple required_qartod_vars: (name, long_name, standard_name) of
+                                       each required QARTOD variable
+    """
+    template = etree.Element("test")
+    for req_var, long_name, standard_name in required_qartod_vars:
+        template.append(qartod_var_snippet(req_var, long_name, standard_name))
+    return template
+
+
+def qartod_var_snippet(req_var, long_name, standard_name):
+    """
+    Returns the dataVariable element with the default attributes of a
+    required QARTOD variable.
+    """
+    flag_atts = """
                     <att name="_FillValue" type="byte">2</att>
                     <att name="dac_comment">QARTOD TESTS NOT RUN</att>
                     <att name="flag_values" type="byteList">1 2 3 4 9</att>
@@ -738,21 +993,19 @@ def qartod_var_snippets(required_qartod_vars, qartod_var_type):
                     <att name="valid_max" type="byte">9</att>
                     """
 
-        qartod_snip = f"""
+    qartod_snip = f"""
             <dataVariable>
                 <sourceName>{req_var}</sourceName>
                 <dataType>byte</dataType>
                 <addAttributes>
-                    <att name="long_name">{template['long_name']}</att>
-                    <att name="standard_name"> {template['standard_name']} </att>
+                    <att name="long_name">{long_name}</att>
+                    <att name="standard_name"> {standard_name} </att>
                     {flag_atts}
                 </addAttributes>
             </dataVariable>
             """
 
-        var_list.append(etree.fromstring(qartod_snip))
-
-    return var_list
+    return etree.fromstring(qartod_snip)
 
 
 def add_erddap_var_elem(var):
@@ -837,6 +1090,8 @@ def check_for_qartod_vars(nc):
     Checks the datafile for QARTOD variables by naming conventions.
     Returns a dict with the QARTOD variables as keys, and its attributes
     as values.
+
+    :param nc: An open netCDF4 Dataset or the NcHeader of the file
     """
     qartod_vars = {'qartod': {}}
     for var in nc.variables:
@@ -857,13 +1112,13 @@ def get_latest_nc_file(root):
     return max(list_of_files, key=os.path.getctime)
 
 
-def main(data_dir, catalog_dir, force):
+def main(data_dir, catalog_dir, force, jobs=1):
     '''
     Entrypoint for build ERDDAP catalog script.
     '''
     # ensure datasets.xml directory exists
     os.makedirs(catalog_dir, exist_ok=True)
-    build_datasets_xml(data_dir, catalog_dir, force)
+    build_datasets_xml(data_dir, catalog_dir, force, jobs)
 
 
 if __name__ == "__main__":
@@ -874,6 +1129,8 @@ if __name__ == "__main__":
     parser.add_argument('data_dir', help='The directory where netCDF files are read from')
     parser.add_argument('catalog_dir', help='The full path to where the datasets.xml will reside')
     parser.add_argument('-f', '--force', action="store_true", help="Force processing ALL deployments")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes to build the dataset chunks with')
 
     args = parser.parse_args()
 
@@ -882,4 +1139,4 @@ if __name__ == "__main__":
     force = args.force
 
     with app.app_context():
-        sys.exit(main(data_dir, catalog_dir, force))
+        sys.exit(main(data_dir, catalog_dir, force, args.jobs))
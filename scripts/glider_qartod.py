@@ -3,9 +3,11 @@
 scripts/glider_qartod.py
 '''
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from netCDF4 import Dataset
 from glider_qc import glider_qc
-from rq import Queue, Connection, Worker
+from rq import Queue, Connection, Worker, SimpleWorker
+import json
 import logging
 import os
 import time
@@ -14,6 +16,8 @@ from glider_dac.common import log_format_str
 
 APP = 'gliderdac'
 QC_KEY = APP + ':glider_qartod'
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                              'data', 'qc_config.yml')
 
 def acquire_master_lock():
     '''
@@ -53,11 +57,19 @@ def main():
     if args.clear:
         clear_master_lock()
 
-    if args.worker:
-        with Connection(glider_qc.get_redis_connection()):
+    if args.stats:
+        print(json.dumps(glider_qc.get_qc_timing_percentiles(args.stats), indent=2))
+        return
+
+    if args.queues:
+        print(json.dumps(glider_qc.get_qc_queue_stats(args.queues), indent=2))
+        return
 
-            worker = Worker(list(map(Queue, [APP])))
-            worker.work()
+    if args.worker:
+        if args.verbose:
+            setup_logging()
+        run_worker(args.config or DEFAULT_CONFIG, fork=args.fork)
+        return
 
     lock = acquire_master_lock()
 
@@ -78,13 +90,39 @@ def main():
         if args.config is None:
             raise ValueError("No configuration found, please set using -c")
 
-        process(file_paths, args.config, sync=args.sync)
+        if args.jobs > 1:
+            process_parallel(file_paths, args.config, args.jobs, chunk_size=args.chunk_size)
+        else:
+            process(file_paths, args.config, sync=args.sync, chunk_size=args.chunk_size,
+                    delayed_mode=args.delayed)
 
     finally:
         lock.release()
 
-def process(file_paths, config, sync=False):
-    queue = Queue(APP, connection=glider_qc.get_redis_connection())
+def run_worker(config, fork=False):
+    '''
+    Runs a QC worker on the real-time and delayed mode QC queues. Jobs are
+    taken from the delayed mode queue only when the real-time queue is empty.
+
+    By default the worker is long lived: the QC configuration, unit system and
+    ioos_qc modules are loaded once and every job runs in the worker process
+    instead of a forked work horse, so jobs don't pay the start up costs.
+
+    :param str config: Path to the QC configuration to preload
+    :param bool fork: Fork a work horse for every job instead
+    '''
+    if fork:
+        worker_class = Worker
+    else:
+        glider_qc.warm_up(config)
+        worker_class = SimpleWorker
+
+    with Connection(glider_qc.get_redis_connection()):
+        worker = worker_class(list(map(Queue, glider_qc.QC_QUEUES)))
+        worker.work()
+
+def process(file_paths, config, sync=False, chunk_size=None, delayed_mode=False):
+    queue = glider_qc.get_qc_queue(delayed_mode)
 
     for nc_path in file_paths:
         sync_lock()
@@ -92,23 +130,75 @@ def process(file_paths, config, sync=False):
         try:
             glider_qc.log.info("Inspecting %s", nc_path)
 
-            if not glider_qc.check_needs_qc(nc_path):
+            if not glider_qc.check_needs_qc(nc_path, config):
                 continue
 
             glider_qc.log.info("Applying QC to dataset %s", nc_path)
 
             if sync:
-                glider_qc.qc_task(nc_path, config)
+                glider_qc.qc_task(nc_path, config, chunk_size)
             else:
-                queue.enqueue(glider_qc.qc_task, nc_path, config)
+                queue.enqueue(glider_qc.qc_task, nc_path, config, chunk_size)
 
         except Exception:
             glider_qc.log.exception("Failed to check %s for QC", nc_path)
 
 
+def qc_file(nc_path, config, chunk_size=None):
+    '''
+    Applies QC to a single file if it needs it. The file is locked in redis
+    by qc_task, like the files processed by the queue workers.
+
+    Returns True if QC was applied to the file.
+
+    :param str nc_path: Path to the netCDF file
+    :param str config: Path to the QC configuration
+    :param int chunk_size: Samples per window of the chunked QC of large files
+    '''
+    sync_lock()
+    if not glider_qc.check_needs_qc(nc_path, config):
+        return False
+    try:
+        return glider_qc.qc_task(nc_path, config, chunk_size)
+    except glider_qc.ProcessError:
+        glider_qc.log.info("Skipping %s, it is locked by another process", nc_path)
+        return False
+
+def process_parallel(file_paths, config, jobs, chunk_size=None):
+    '''
+    Applies QC to the files locally across a pool of processes, without going
+    through the RQ queue. Progress and throughput are logged as files finish.
+
+    :param list file_paths: Paths to the netCDF files
+    :param str config: Path to the QC configuration
+    :param int jobs: Number of processes to run
+    :param int chunk_size: Samples per window of the chunked QC of large files
+    '''
+    total = len(file_paths)
+    qc_count = 0
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(qc_file, nc_path, config, chunk_size): nc_path
+                   for nc_path in file_paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            nc_path = futures[future]
+            try:
+                if future.result():
+                    qc_count += 1
+            except Exception:
+                glider_qc.log.exception("Failed to apply QC to %s", nc_path)
+            glider_qc.log.info("[%d/%d] %s (%.2f files/s)", done, total, nc_path,
+                               done / (time.time() - start))
+
+    elapsed = time.time() - start
+    glider_qc.log.info("Inspected %d files, applied QC to %d in %.1fs (%.2f files/s)",
+                       total, qc_count, elapsed, total / elapsed if elapsed else 0)
+
 def get_args():
     parser = ArgumentParser(description=main.__doc__)
     parser.add_argument('-w', '--worker', action='store_true', help='Launch a worker')
+    parser.add_argument('--fork', action='store_true',
+        help='Fork a new process for every job the worker runs instead of running them in-process')
 
     parser.add_argument('-r', '--recursive',
         action='store_true', help='Iterate through the directory contents recursively')
@@ -117,7 +207,19 @@ def get_args():
     parser.add_argument('-v', '--verbose', action='store_true', help='Turn on logging')
 
     parser.add_argument('--sync', action='store_true', help='Run the jobs synchronously')
+    parser.add_argument('--delayed', action='store_true',
+        help='Enqueue the jobs on the delayed mode queue, behind the real-time files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='Run the jobs locally across N processes instead of the queue, use -v to follow progress')
+    parser.add_argument('--chunk-size', type=int,
+        help='QC files with more samples than this in windows of this many samples '
+             '(default %d, set by the QC_CHUNK_SIZE environment variable)' % glider_qc.QC_CHUNK_SIZE)
     parser.add_argument('--clear', action='store_true', help='Clear all locks')
+    parser.add_argument('--stats', type=int, nargs='?', const=1000, metavar='N',
+        help='Print the percentiles of the QC stage timings of the last N files (default 1000) and exit')
+    parser.add_argument('--queues', type=int, nargs='?', const=1000, metavar='N',
+        help='Print the depth and lag of the QC queues, with the queue wait of the last N files '
+             '(default 1000), and exit')
 
     parser.add_argument('netcdf_files', nargs='*', help='NetCDF file to apply QC to')
     args = parser.parse_args()
@@ -6,7 +6,9 @@ A script to get WMO IDs and attribution from netCDF files and apply them to the
 '''
 
 from glider_dac import app, db
+from glider_util import ncheader
 from netCDF4 import Dataset
+import os
 import sys
 
 def main(args):
@@ -27,38 +29,59 @@ def update_deployment(deployment):
     '''
     Returns an updated deployment with the fields filled in where necessary.
 
+    The header of the latest netCDF file of the deployment is checked first,
+    the THREDDS DAP URL is only opened if the field is not found there.
+
     :param Deployment deployment: The deployment object
     '''
-    dap_url = deployment.dap
-    dirty = False
+    if deployment.wmo_id is None:
+        field, get_value = 'wmo_id', get_wmo
+    elif deployment.attribution is None:
+        field, get_value = 'attribution', get_acknowledgment
+    else:
+        return
+
+    value = None
+    nc_path = get_latest_nc_file(deployment)
+    if nc_path is not None:
+        try:
+            value = get_value(ncheader.read_header_cached(nc_path))
+        except Exception:
+            value = None
 
-    with Dataset(dap_url) as nc:
+    if not value:
+        with Dataset(deployment.dap) as nc:
+            value = get_value(nc)
 
-        if deployment.wmo_id is None:
-            wmo_id = get_wmo(nc)
-            if wmo_id:
-                deployment.wmo_id = wmo_id
-                dirty = True
+    if value:
+        deployment[field] = value
+        deployment.save()
 
-        elif deployment.attribution is None:
-            attribution = get_acknowledgment(nc)
-            if attribution:
-                deployment.attribution = attribution
-                dirty = True
 
-        if dirty:
-            deployment.save()
+def get_latest_nc_file(deployment):
+    '''
+    Returns the path to the latest netCDF file of the deployment, or None if
+    it has none
+
+    :param Deployment deployment: The deployment object
+    '''
+    if deployment.latest_file:
+        nc_path = os.path.join(deployment.full_path, deployment.latest_file)
+        if os.path.isfile(nc_path):
+            return nc_path
+    return deployment.get_latest_nc_file()
 
 
 def get_wmo(nc):
     '''
     Gets the best candidate for a WMO ID
 
-    :param netCDF4.Dataset nc: An open netCDF4 Dataset
+    :param nc: An open netCDF4 Dataset or the NcHeader of a file
     '''
     if getattr(nc, 'wmo_id', None):
         wmo_id = nc.wmo_id
-    elif 'wmo_id' in nc.variables:
+    elif 'wmo_id' in nc.variables and not isinstance(nc, ncheader.NcHeader):
+        # the values of the variable are not part of the header
         wmo_id = ''.join(nc.variables['wmo_id'][:].flatten())
     else:
         return None
@@ -69,7 +92,7 @@ def get_acknowledgment(nc):
     '''
     Gets the best candidate for an acknowledgment
 
-    :param netCDF4.Dataset nc: An open netCDF4 Dataset
+    :param nc: An open netCDF4 Dataset or the NcHeader of a file
     '''
     return getattr(nc, 'acknowledgment', None)
 
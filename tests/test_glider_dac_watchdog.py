@@ -0,0 +1,327 @@
+from unittest import TestCase, mock, skipIf
+import threading
+import tempfile
+import shutil
+import time
+import os
+from glider_qc import glider_qc
+import glider_dac_watchdog
+from glider_dac_watchdog import (EventCoalescer, SerializingExecutor, DeploymentCache,
+                                 HandleDeploymentDB)
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class TestEventCoalescer(TestCase):
+
+    def start_coalescer(self, **kwargs):
+        '''
+        Returns a coalescer recording its flushes and an event set on the
+        first flush
+        '''
+        self.flushes = []
+        self.flushed = threading.Event()
+
+        def flush(deployment_dir, files):
+            self.flushes.append((time.monotonic(), deployment_dir, files))
+            self.flushed.set()
+
+        coalescer = EventCoalescer(flush, **kwargs)
+        self.addCleanup(coalescer.stop)
+        return coalescer
+
+    def test_flush_when_quiet(self):
+        coalescer = self.start_coalescer(quiet_seconds=0.2, max_delay=60)
+        coalescer.add('user/upload/dep-a', 'a.nc', '/data/user/upload/dep-a/.a.nc')
+        coalescer.add('user/upload/dep-a', 'b.nc', '/data/user/upload/dep-a/b.nc')
+        coalescer.add('user/upload/dep-a', 'a.nc', '/data/user/upload/dep-a/a.nc')
+        last_event = time.monotonic()
+        assert self.flushed.wait(5)
+        flushed_at, deployment_dir, files = self.flushes[0]
+        # the events are handed over once, with the latest path of each file
+        assert flushed_at - last_event >= 0.2
+        assert deployment_dir == 'user/upload/dep-a'
+        assert files == {'a.nc': '/data/user/upload/dep-a/a.nc',
+                         'b.nc': '/data/user/upload/dep-a/b.nc'}
+        coalescer.stop()
+        assert len(self.flushes) == 1
+
+    def test_flush_after_max_delay(self):
+        coalescer = self.start_coalescer(quiet_seconds=0.1, max_delay=0.3)
+        start = time.monotonic()
+        # events keep arriving within quiet_seconds of each other
+        while not self.flushed.is_set() and time.monotonic() - start < 5:
+            coalescer.add('user/upload/dep-a', 'a.nc', '/data/user/upload/dep-a/a.nc')
+            time.sleep(0.02)
+        assert self.flushed.is_set()
+        assert 0.3 <= self.flushes[0][0] - start < 5
+
+    def test_flush_on_stop(self):
+        coalescer = self.start_coalescer(quiet_seconds=60, max_delay=60)
+        coalescer.add('user/upload/dep-a', 'a.nc', '/data/user/upload/dep-a/a.nc')
+        coalescer.add('user/upload/dep-b', 'b.nc', '/data/user/upload/dep-b/b.nc')
+        coalescer.stop()
+        assert not coalescer.thread.is_alive()
+        assert sorted(deployment_dir for _, deployment_dir, _ in self.flushes) == \
+            ['user/upload/dep-a', 'user/upload/dep-b']
+
+    def test_flush_error(self):
+        calls = []
+
+        def flush(deployment_dir, files):
+            calls.append(deployment_dir)
+            if deployment_dir == 'user/upload/dep-a':
+                raise ValueError("flush failed")
+
+        coalescer = EventCoalescer(flush, quiet_seconds=60, max_delay=60)
+        coalescer.add('user/upload/dep-a', 'a.nc', '/data/user/upload/dep-a/a.nc')
+        coalescer.add('user/upload/dep-b', 'b.nc', '/data/user/upload/dep-b/b.nc')
+        # the other deployments are still flushed
+        coalescer.stop()
+        assert sorted(calls) == ['user/upload/dep-a', 'user/upload/dep-b']
+
+
+class TestSerializingExecutor(TestCase):
+
+    def start_executor(self, **kwargs):
+        executor = SerializingExecutor(**kwargs)
+        self.addCleanup(executor.executor.shutdown)
+        return executor
+
+    def test_order_by_key(self):
+        executor = self.start_executor(max_workers=2)
+        release = threading.Event()
+        other_key_done = threading.Event()
+        handled = []
+
+        def handle(key, index):
+            if (key, index) == ('a', 0):
+                # the tasks of the other key don't wait for this one
+                assert release.wait(5)
+            handled.append((key, index))
+
+        for index in range(5):
+            executor.submit('a', handle, 'a', index)
+        executor.submit('b', lambda: other_key_done.set())
+        assert other_key_done.wait(5)
+        # the other tasks of the key wait for the running one
+        assert handled == []
+        release.set()
+        executor.shutdown()
+        assert handled == [('a', index) for index in range(5)]
+
+    def test_order_by_key_many_workers(self):
+        executor = self.start_executor(max_workers=4)
+        handled = {key: [] for key in 'abcd'}
+
+        def handle(key, index):
+            time.sleep(0.001)
+            handled[key].append(index)
+
+        for index in range(20):
+            for key in 'abcd':
+                executor.submit(key, handle, key, index)
+        executor.shutdown()
+        assert handled == {key: list(range(20)) for key in 'abcd'}
+
+    def test_task_error(self):
+        executor = self.start_executor(max_workers=1)
+        handled = []
+
+        def fail():
+            raise ValueError("task failed")
+
+        executor.submit('a', fail)
+        executor.submit('a', handled.append, 1)
+        executor.shutdown()
+        # the next task of the key still runs
+        assert handled == [1]
+        assert executor.metrics()['handled'] == 2
+
+    def test_submit_blocks_at_max_pending(self):
+        executor = self.start_executor(max_workers=1, max_pending=2)
+        release = threading.Event()
+        handled = []
+
+        def handle(index):
+            if index == 0:
+                assert release.wait(5)
+            handled.append(index)
+
+        executor.submit('a', handle, 0)
+        executor.submit('b', handle, 1)
+        submitter = threading.Thread(target=executor.submit, args=('c', handle, 2))
+        submitter.start()
+        submitter.join(0.2)
+        # no slot is free until a task is done
+        assert submitter.is_alive()
+        assert executor.metrics()['pending'] == 2
+        release.set()
+        submitter.join(5)
+        assert not submitter.is_alive()
+        executor.shutdown()
+        assert handled == [0, 1, 2]
+
+    def test_metrics(self):
+        executor = self.start_executor(max_workers=2)
+        assert executor.metrics() == {'pending': 0, 'deployments': 0, 'handled': 0}
+        for index in range(10):
+            executor.submit(index % 3, time.sleep, 0.01)
+        executor.shutdown()
+        metrics = executor.metrics()
+        assert metrics['pending'] == 0
+        assert metrics['deployments'] == 0
+        assert metrics['handled'] == 10
+        assert 0.01 <= metrics['latency_p50'] <= metrics['latency_p90'] <= \
+            metrics['latency_p99'] <= metrics['latency_max']
+
+
+class TestDeploymentCache(TestCase):
+
+    def setUp(self):
+        # deployment_dir -> _id of the deployments in the database
+        self.deployments = {'user/upload/dep-a': 1, 'user/upload/dep-b': 2,
+                            'user/upload/dep-ab': 3, 'other/upload/dep-a': 4}
+        self.find_one = mock.Mock(side_effect=self.find_deployment)
+        patcher = mock.patch.object(glider_dac_watchdog, 'db')
+        db = patcher.start()
+        self.addCleanup(patcher.stop)
+        db.Deployment.find_one = self.find_one
+        patcher = mock.patch.object(glider_dac_watchdog.time, 'monotonic', return_value=1000.0)
+        self.monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def find_deployment(self, query):
+        deployment_id = self.deployments.get(query['deployment_dir'])
+        return mock.Mock(_id=deployment_id) if deployment_id is not None else None
+
+    def test_ttl(self):
+        cache = DeploymentCache(ttl=30)
+        assert cache.get('user/upload/dep-a') == 1
+        self.monotonic.return_value += 29
+        assert cache.get('user/upload/dep-a') == 1
+        assert self.find_one.call_count == 1
+        # looked up again once expired
+        self.monotonic.return_value += 1
+        assert cache.get('user/upload/dep-a') == 1
+        assert self.find_one.call_count == 2
+        assert cache.metrics() == {'entries': 1, 'hits': 1, 'misses': 2}
+
+    def test_missing_deployment(self):
+        cache = DeploymentCache(ttl=30)
+        assert cache.get('user/upload/unknown') is None
+        assert cache.get('user/upload/unknown') is None
+        # directories without a deployment are cached as well
+        self.find_one.assert_called_once_with({'deployment_dir': 'user/upload/unknown'})
+        assert cache.metrics() == {'entries': 1, 'hits': 1, 'misses': 1}
+
+    def test_invalidate(self):
+        cache = DeploymentCache(ttl=30)
+        for deployment_dir in self.deployments:
+            cache.get(deployment_dir)
+        cache.get('user/upload')
+        cache.invalidate('user/upload/dep-a')
+        assert sorted(cache.entries) == ['other/upload/dep-a', 'user/upload',
+                                         'user/upload/dep-ab', 'user/upload/dep-b']
+        # the directories under the invalidated one are dropped as well
+        cache.invalidate('user')
+        assert sorted(cache.entries) == ['other/upload/dep-a']
+        self.find_one.reset_mock()
+        self.deployments['user/upload/dep-a'] = 5
+        assert cache.get('user/upload/dep-a') == 5
+        assert cache.get('other/upload/dep-a') == 4
+        assert self.find_one.call_count == 1
+
+    def test_invalidate_during_lookup(self):
+        cache = DeploymentCache(ttl=30)
+
+        def find_and_move(query):
+            # the deployment is moved while it is looked up
+            deployment = self.find_deployment(query)
+            self.deployments['user/upload/dep-a'] = 5
+            cache.invalidate('user/upload/dep-a')
+            return deployment
+
+        self.find_one.side_effect = find_and_move
+        assert cache.get('user/upload/dep-a') == 1
+        # the stale result is not cached
+        assert cache.entries == {}
+        self.find_one.side_effect = self.find_deployment
+        assert cache.get('user/upload/dep-a') == 5
+        assert cache.get('user/upload/dep-a') == 5
+        assert self.find_one.call_count == 2
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+class TestReconcile(TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base)
+        self.connection = fakeredis.FakeStrictRedis()
+        patcher = mock.patch.object(glider_qc, 'get_redis_connection', return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = HandleDeploymentDB(self.base, self.base, quiet_seconds=0.1)
+        self.addCleanup(self.handler.probe_executor.shutdown)
+        self.addCleanup(self.handler.event_executor.shutdown)
+        self.addCleanup(self.handler.coalescer.stop)
+        # the synthesized events are recorded instead of handled
+        self.handler.dispatch_event = mock.Mock()
+
+    def make_file(self, deployment_dir, file_name, mtime=None):
+        path = os.path.join(self.base, deployment_dir, file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def file_time(self, path):
+        return HandleDeploymentDB.file_time(os.stat(path))
+
+    def marks(self):
+        return {deployment_dir.decode('utf-8'): float(mark) for deployment_dir, mark in
+                self.connection.hgetall(glider_dac_watchdog.HIGH_WATER_MARKS_KEY).items()}
+
+    def dispatched(self):
+        return sorted(call.args[1].src_path for call in self.handler.dispatch_event.call_args_list)
+
+    def test_first_run_records_marks(self):
+        first = self.make_file('user1/upload/dep-a', 'a.nc')
+        latest = self.make_file('user1/upload/dep-a', 'b.nc', time.time() + 100)
+        other = self.make_file('user2/upload/dep-b', 'c.nc')
+        self.make_file('user2/upload/dep-b', '.hidden.nc', time.time() + 1000)
+        os.makedirs(os.path.join(self.base, 'user3/upload/empty'))
+        self.handler.reconcile()
+        # no file is handled, the times of the files are recorded instead
+        assert self.dispatched() == []
+        assert self.marks() == {'user1/upload/dep-a': self.file_time(latest),
+                                'user2/upload/dep-b': self.file_time(other)}
+        assert self.file_time(first) < self.file_time(latest)
+
+    def test_newer_files_replayed(self):
+        self.make_file('user1/upload/dep-a', 'a.nc')
+        self.make_file('user2/upload/dep-b', 'b.nc')
+        self.handler.reconcile()
+        marks = self.marks()
+        newer = self.make_file('user1/upload/dep-a', 'c.nc', marks['user1/upload/dep-a'] + 100)
+        self.make_file('user1/upload/dep-a', '.c.nc', marks['user1/upload/dep-a'] + 100)
+        self.handler.reconcile()
+        assert self.dispatched() == [newer]
+        # the marks are only moved by the handled events
+        assert self.marks() == marks
+
+    def test_directories_without_mark(self):
+        self.make_file('user1/upload/dep-a', 'a.nc')
+        self.handler.reconcile()
+        new_files = [self.make_file('user1/upload/dep-new', 'a.nc'),
+                     self.make_file('user1/upload/dep-new', 'b.nc'),
+                     self.make_file('user4/upload/dep-c', 'c.nc')]
+        self.handler.reconcile()
+        assert self.dispatched() == sorted(new_files)
+        # the files are handled as if the observer saw them created
+        handler = self.handler.dispatch_event.call_args_list[0].args[0]
+        assert handler == self.handler.file_moved_or_created
@@ -3,16 +3,31 @@
 tests/test_glider_qc.py
 '''
 
-from glider_qc.glider_qc import GliderQC
-from unittest import TestCase
+from glider_qc.glider_qc import (GliderQC, load_qc_config, run_qc, qc_cache_key,
+                                 snapshot_qc_results, apply_qc_results,
+                                 check_needs_qc, DeploymentStats, compute_qc,
+                                 write_qc_results, StageTimings, timing_percentiles,
+                                 get_unit_conversion, run_qc_chunked, mark_qc_error,
+                                 qc_task, ClassicFileWriter)
+from glider_qc import glider_qc
+from cf_units import Unit
+from unittest import TestCase, mock, skipIf
 from netCDF4 import Dataset
 from tests.resources import STATIC_FILES
+from glider_util import ncheader
 import yaml
 import tempfile
+import threading
+import shutil
+import json
 import os
 import numpy as np
 import numpy.ma as ma
 import pandas as pd
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 
 class TestGliderQC(TestCase):
@@ -138,3 +153,404 @@ class TestGliderQC(TestCase):
 
         converted, note = GliderQC.normalize_variable(values, units, standard_name)
         np.testing.assert_almost_equal(np.array([0, 18.3333, 37.777778]), converted, 2)
+
+    def test_normalize_variable_cached(self):
+        values = np.array([1.5, np.nan, -2.0, 31.25])
+        for units, standard_name in (('K', 'sea_water_temperature'),
+                                     ('mS cm-1', 'sea_water_electrical_conductivity'),
+                                     ('bar', 'sea_water_pressure'),
+                                     ('deg_F', 'sea_water_temperature')):
+            target_unit = GliderQC.STANDARD_UNITS[standard_name]
+            expected = Unit(units).convert(values, target_unit)
+            converted, note = GliderQC.normalize_variable(values, units, standard_name)
+            np.testing.assert_array_equal(expected, converted)
+            inplace = values.copy()
+            converted, note = GliderQC.normalize_variable(inplace, units, standard_name, inplace=True)
+            np.testing.assert_array_equal(expected, converted)
+        assert get_unit_conversion('K', 'deg_C') == (1.0, -273.15)
+        # Identity conversions return the values as they are
+        converted, note = GliderQC.normalize_variable(values, 'Celsius', 'sea_water_temperature')
+        assert converted is values
+
+    def test_masked_to_nan(self):
+        values = ma.masked_array([1, 2, -999, 4], mask=[False, False, True, False], dtype=np.int16)
+        converted = GliderQC.masked_to_nan(values)
+        assert converted.dtype == np.float64
+        assert not isinstance(converted, ma.MaskedArray)
+        np.testing.assert_equal(np.array([1.0, 2.0, np.nan, 4.0]), converted)
+
+        ncfile = Dataset(STATIC_FILES['murphy'], 'r')
+        self.addCleanup(ncfile.close)
+        temperature = ncfile.variables['temperature'][:]
+        expected = np.array([x if x != '--' else np.nan for x in temperature])
+        np.testing.assert_equal(expected, GliderQC.masked_to_nan(temperature))
+
+    def test_axes_cache(self):
+        ncfile = Dataset(STATIC_FILES['murphy'], 'r')
+        self.addCleanup(ncfile.close)
+
+        qc = GliderQC(ncfile, 'data/qc_config.yml')
+        axes = qc.axes
+        assert axes is qc.axes
+        assert axes['time'].dtype == np.dtype('datetime64[s]')
+        assert axes['lat'].dtype == np.float64
+        assert axes['lon'].dtype == np.float64
+        np.testing.assert_equal(ncfile.variables['time'][:].astype('datetime64[s]'), axes['time'])
+        assert len(axes['lat']) == len(ncfile.variables['lat'])
+
+    def test_apply_qc_batch(self):
+        ncfile = Dataset(STATIC_FILES['murphy'], 'r')
+        self.addCleanup(ncfile.close)
+
+        qc = GliderQC(ncfile, 'data/qc_config.yml')
+        with open('data/qc_config.yml') as yaml_content:
+            qc_config = yaml.safe_load(yaml_content)
+
+        data = {"time": qc.axes['time']}
+        for var_name in ('temperature', 'salinity'):
+            ncvar = ncfile.variables[var_name]
+            data[var_name], note = qc.normalize_variable(qc.masked_to_nan(ncvar[:]),
+                                                         ncvar.units, ncvar.standard_name)
+        streams = {var_name: qc_config['contexts'][0]['streams'][var_name]
+                   for var_name in ('temperature', 'salinity')}
+        df = pd.DataFrame(data)
+
+        results = qc.apply_qc_batch(df, {'contexts': [{'streams': streams}]})
+        assert set(results) == {'temperature', 'salinity'}
+
+        for var_name, var_spec in streams.items():
+            expected = qc.apply_qc(df[['time', var_name]], var_name,
+                                   {'contexts': [{'streams': {var_name: var_spec}}]})
+            assert sorted(results[var_name].columns) == sorted(expected.columns)
+            for column in expected.columns:
+                np.testing.assert_equal(np.array(expected[column].values),
+                                        np.array(results[var_name][column].values))
+
+    def test_thresholds(self):
+        qc = GliderQC(None)
+        values = np.array([1.0, 2.0, np.nan, 3.0, 10.0, 2.5, 1.5, 2.0])
+        times = ma.masked_array((np.arange(8) * 10).astype('datetime64[s]'))
+
+        # 10.0 is outside of one standard deviation and is not used
+        threshold, note = qc.get_rate_of_change_threshold(values, times)
+        np.testing.assert_almost_equal(0.1, threshold)
+
+        suspect_threshold, fail_threshold, note = qc.get_spike_thresholds(values)
+        np.testing.assert_almost_equal(np.nanstd(values), suspect_threshold)
+        np.testing.assert_almost_equal(2 * np.nanstd(values), fail_threshold)
+
+        assert qc.get_spike_thresholds(np.array([1.0, np.nan, np.nan]))[0] is None
+        assert qc.get_rate_of_change_threshold(np.array([1.0, np.nan]), times[:2])[0] is None
+
+    def test_deployment_stats(self):
+        times = (np.arange(8) * 10).astype('datetime64[s]')
+        first = np.array([1.0, 2.0, np.nan, 3.0, 10.0, 2.5, 1.5, 2.0])
+        second = np.array([4.0, np.nan, 5.0])
+        stats = DeploymentStats.merge_statistics(
+            DeploymentStats.file_statistics(first, times),
+            DeploymentStats.file_statistics(second, times))
+        both = np.concatenate([first, second])
+        assert stats['files'] == 2
+        assert stats['n'] == 9
+        np.testing.assert_almost_equal(np.nanmean(both), stats['mean'])
+        suspect_threshold, fail_threshold = DeploymentStats.spike_thresholds(stats)
+        np.testing.assert_almost_equal(np.nanstd(both), suspect_threshold)
+        np.testing.assert_almost_equal(0.1, stats['roc'])
+
+        # Too little data in the file, the deployment thresholds are used
+        qc = GliderQC(None)
+        varspec = {'spike_test': {}, 'rate_of_change_test': {}}
+        configset, note = qc.update_config(varspec, 'temp', times[:3], second, None, stats)
+        assert varspec['spike_test']['suspect_threshold'] == suspect_threshold
+        assert varspec['rate_of_change_test']['threshold'] == stats['roc']
+        # Only this file contributed, the tests are dropped
+        varspec = {'spike_test': {}, 'rate_of_change_test': {}}
+        qc.update_config(varspec, 'temp', times[:3], second, None,
+                         DeploymentStats.file_statistics(second[1:-1], times))
+        assert varspec == {}
+
+    def test_load_qc_config(self):
+        fd, path = tempfile.mkstemp(suffix='.yml')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with open('data/qc_config.yml') as f:
+            content = f.read()
+        with open(path, 'w') as f:
+            f.write(content)
+
+        config = load_qc_config(path)
+        # callers get their own copy to modify
+        del config['contexts'][0]['streams']['temperature']['qartod']['spike_test']
+        assert 'spike_test' in load_qc_config(path)['contexts'][0]['streams']['temperature']['qartod']
+
+        # the file is read again once it is modified
+        with open(path, 'w') as f:
+            f.write(content.replace('temperature:', 'temp:'))
+        os.utime(path, (0, os.path.getmtime(path) + 10))
+        assert 'temp' in load_qc_config(path)['contexts'][0]['streams']
+
+    def copy_to_deployment(self, ncpath):
+        deployment_dir = os.path.join(tempfile.mkdtemp(), 'Murphy-20150801T000000')
+        self.addCleanup(shutil.rmtree, os.path.dirname(deployment_dir))
+        os.mkdir(deployment_dir)
+        path = os.path.join(deployment_dir, os.path.basename(ncpath))
+        shutil.copy(ncpath, path)
+        return path
+
+    def test_qc_results_snapshot(self):
+        qc_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+        copy_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+
+        with Dataset(qc_path, 'r+') as qc_nc, Dataset(copy_path, 'r+') as copy_nc:
+            cache_key = qc_cache_key(qc_nc, qc_path, 'data/qc_config.yml')
+            assert cache_key == qc_cache_key(copy_nc, copy_path, 'data/qc_config.yml')
+
+            run_qc('data/qc_config.yml', qc_nc, qc_path)
+            # results are stored as JSON
+            results = json.loads(json.dumps(snapshot_qc_results(qc_nc)))
+            apply_qc_results(copy_nc, results)
+
+        with Dataset(qc_path, 'r') as qc_nc, Dataset(copy_path, 'r') as copy_nc:
+            assert qc_nc.dac_qc_comment == copy_nc.dac_qc_comment
+            assert 'qartod_temperature_primary_flag' in copy_nc.variables
+            assert sorted(qc_nc.variables) == sorted(copy_nc.variables)
+            for name, ncvar in qc_nc.variables.items():
+                copy_var = copy_nc.variables[name]
+                assert ncvar.dtype == copy_var.dtype
+                assert sorted(ncvar.ncattrs()) == sorted(copy_var.ncattrs())
+                for attr in ncvar.ncattrs():
+                    np.testing.assert_equal(ncvar.getncattr(attr), copy_var.getncattr(attr))
+                np.testing.assert_equal(ncvar[:], copy_var[:])
+
+        with Dataset(qc_path, 'r') as qc_nc:
+            # QC results are not part of the key, the data and config are
+            assert cache_key == qc_cache_key(qc_nc, qc_path, 'data/qc_config.yml')
+            fd, config = tempfile.mkstemp(suffix='.yml')
+            os.close(fd)
+            self.addCleanup(os.remove, config)
+            with open('data/qc_config.yml') as f, open(config, 'w') as out:
+                out.write(f.read().replace('threshold: 0.1', 'threshold: 0.2'))
+            assert cache_key != qc_cache_key(qc_nc, qc_path, config)
+
+    def test_location_flags(self):
+        qc = GliderQC(None)
+        center_lat, center_lon = 27.06, -88.99
+        # one mile north, three miles east, missing and across the antimeridian
+        lat = np.array([center_lat + 1 / 69.172, center_lat, np.nan, 0.0])
+        lon = np.array([center_lon, center_lon + 3 / (69.172 * np.cos(np.radians(center_lat))), center_lon, 179.99])
+        flags = GliderQC.location_flags(lat, lon, [center_lat] * 3 + [0.0], [center_lon] * 3 + [-179.99])
+        np.testing.assert_equal(np.array([1, 4, 9, 1], dtype=np.int8), flags)
+
+        poly = qc.watch_circle(center_lat, center_lon, 2.0, num_points=72)
+        for i in range(2):
+            assert qc.is_point_outside_polygon(lat[i], lon[i], poly) == (flags[i] == 4)
+        assert GliderQC.location_flags(center_lat, center_lon, center_lat, center_lon) == 1
+
+    def test_stage_timings(self):
+        qc_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+        timings = StageTimings()
+        with Dataset(qc_path, 'r') as nc:
+            compute_qc('data/qc_config.yml', nc, qc_path, timings=timings)
+        for stage in ('read', 'check_time', 'check_location', 'normalize_variable',
+                      'update_config', 'apply_qc'):
+            assert stage in timings.stages
+        assert timings.stages['normalize_variable']['calls'] == 5
+        assert timings.stages['normalize_variable']['size'] == 5 * 8
+
+        file_timings = [{'read': {'seconds': float(i)}, 'apply_qc': {'seconds': 1.0}} for i in range(101)]
+        summary = timing_percentiles(file_timings, percentiles=(50, 90))
+        assert summary['read'] == {'count': 101, 'p50': 50.0, 'p90': 90.0}
+        assert summary['total']['p50'] == 51.0
+
+    def test_write_qc_results(self):
+        in_place_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+        rebuilt_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+
+        with Dataset(in_place_path, 'r+') as nc:
+            run_qc('data/qc_config.yml', nc, in_place_path)
+        with Dataset(rebuilt_path, 'r') as nc:
+            results = compute_qc('data/qc_config.yml', nc, rebuilt_path)
+        os.chmod(rebuilt_path, 0o640)
+        os.setxattr(rebuilt_path, 'user.test', b'kept')
+        write_qc_results(rebuilt_path, results)
+        # The file is replaced with its permissions and xattrs, and no
+        # temporary file is left behind
+        assert os.stat(rebuilt_path).st_mode & 0o777 == 0o640
+        assert os.getxattr(rebuilt_path, 'user.test') == b'kept'
+        assert os.listdir(os.path.dirname(rebuilt_path)) == [os.path.basename(rebuilt_path)]
+
+        with Dataset(in_place_path, 'r') as in_place, Dataset(rebuilt_path, 'r') as rebuilt:
+            assert in_place.data_model == rebuilt.data_model
+            assert in_place.ncattrs() == rebuilt.ncattrs()
+            assert in_place.dac_qc_comment == rebuilt.dac_qc_comment
+            assert rebuilt.dimensions['time'].isunlimited()
+            assert list(in_place.variables) == list(rebuilt.variables)
+            for name, ncvar in in_place.variables.items():
+                rebuilt_var = rebuilt.variables[name]
+                assert ncvar.dtype == rebuilt_var.dtype
+                assert ncvar.ncattrs() == rebuilt_var.ncattrs()
+                for attr in ncvar.ncattrs():
+                    np.testing.assert_equal(ncvar.getncattr(attr), rebuilt_var.getncattr(attr))
+                np.testing.assert_equal(ncvar[:], rebuilt_var[:])
+
+    def test_write_qc_results_other_owner(self):
+        nc_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+        with Dataset(nc_path, 'r') as nc:
+            results = compute_qc('data/qc_config.yml', nc, nc_path)
+        inode = os.stat(nc_path).st_ino
+        # A file uploaded by another user is overwritten in place, keeping
+        # its inode and ownership
+        with mock.patch('os.chown', side_effect=PermissionError):
+            write_qc_results(nc_path, results)
+        assert os.stat(nc_path).st_ino == inode
+        assert os.listdir(os.path.dirname(nc_path)) == [os.path.basename(nc_path)]
+        with Dataset(nc_path, 'r') as nc:
+            assert nc.dac_qc_comment == results['dac_qc_comment']
+            for name, spec in results['variables'].items():
+                np.testing.assert_equal(nc.variables[name][:], spec['data'])
+
+    def test_classic_file_writer(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        src_path = os.path.join(tmpdir, 'src.nc')
+        dst_path = os.path.join(tmpdir, 'dst.nc')
+        records = 50
+        values = {
+            'time': np.arange(records, dtype='f8'),
+            'flag': np.arange(records, dtype='i1'),
+            'name': np.array([list(b'abc')] * records, dtype='u1').view('S1'),
+        }
+        time_flag = {'datatype': 'i1', 'dimensions': ['time'], 'fill_value': None,
+                     'attributes': {'long_name': 'written'}}
+        profile_flag = {'datatype': 'i1', 'dimensions': [], 'fill_value': None,
+                        'attributes': {}, 'data': np.int8(4)}
+        for data_model in ('NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_64BIT_DATA'):
+            # A single record variable has unpadded records
+            for names, flags in ((['time', 'flag', 'name'], {'qartod_time_flag': time_flag}), (['flag'], {})):
+                results = {'variables': dict(flags, qartod_profile_flag=profile_flag),
+                           'dac_qc_comment': 'comment'}
+                with Dataset(src_path, 'w', format=data_model) as src:
+                    src.createDimension('time', None)
+                    src.createDimension('strlen', 3)
+                    src.createVariable('profile', 'f8', ())[:] = 1.5
+                    for name in names:
+                        dims = ('time', 'strlen') if name == 'name' else ('time',)
+                        src.createVariable(name, values[name].dtype, dims)[:] = values[name]
+                # Blocks of a few records
+                with mock.patch.object(ClassicFileWriter, 'BLOCK_BYTES', 64), \
+                        Dataset(src_path, 'r') as src, ClassicFileWriter(src, dst_path, results) as dst:
+                    dst.write_records(0, records, {name: np.full(records, 3, dtype='i1') for name in flags})
+                with Dataset(dst_path, 'r') as nc:
+                    assert nc.data_model == data_model
+                    assert nc.dac_qc_comment == 'comment'
+                    assert len(nc.dimensions['time']) == records
+                    assert nc.variables['profile'][:] == 1.5
+                    assert nc.variables['qartod_profile_flag'][:] == 4
+                    for name in flags:
+                        assert nc.variables[name].long_name == 'written'
+                        np.testing.assert_equal(nc.variables[name][:], 3)
+                    for name in names:
+                        nc.variables[name].set_auto_chartostring(False)
+                        np.testing.assert_equal(nc.variables[name][:], values[name])
+
+    def test_run_qc_chunked(self):
+        qc_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+        chunked_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+
+        with Dataset(qc_path, 'r+') as nc:
+            run_qc('data/qc_config.yml', nc, qc_path)
+        run_qc_chunked('data/qc_config.yml', chunked_path, chunk_size=3)
+
+        with Dataset(qc_path, 'r') as qc_nc, Dataset(chunked_path, 'r') as chunked_nc:
+            assert qc_nc.dac_qc_comment == chunked_nc.dac_qc_comment
+            assert list(qc_nc.variables) == list(chunked_nc.variables)
+            for name, ncvar in qc_nc.variables.items():
+                chunked_var = chunked_nc.variables[name]
+                assert ncvar.ncattrs() == chunked_var.ncattrs()
+                np.testing.assert_equal(ncvar[:], chunked_var[:])
+                if 'qartod_config' in ncvar.ncattrs():
+                    # the thresholds only differ by rounding
+                    config = json.loads(ncvar.qartod_config)
+                    chunked_config = json.loads(chunked_var.qartod_config)
+                    if 'threshold' in config:
+                        np.testing.assert_allclose(config['threshold'], chunked_config['threshold'])
+                    if 'fail_threshold' in config:
+                        np.testing.assert_allclose(config['fail_threshold'], chunked_config['fail_threshold'])
+
+    def test_read_header(self):
+        header = ncheader.read_header(STATIC_FILES['murphy'])
+        with Dataset(STATIC_FILES['murphy'], 'r') as nc:
+            assert header.data_model == nc.data_model
+            assert header.dimensions == {name: len(dim) for name, dim in nc.dimensions.items()}
+            assert header.ncattrs() == nc.ncattrs()
+            assert header.title == nc.title
+            assert list(header.variables) == list(nc.variables)
+            for name, ncvar in nc.variables.items():
+                var_header = header.variables[name]
+                assert var_header.dtype == ncvar.dtype
+                assert var_header.dimensions == ncvar.dimensions
+                assert var_header.ncattrs() == ncvar.ncattrs()
+                for attr in ncvar.ncattrs():
+                    np.testing.assert_equal(var_header.getncattr(attr), ncvar.getncattr(attr))
+                    assert type(var_header.getncattr(attr)) == type(ncvar.getncattr(attr))
+            matches = header.get_variables_by_attributes(standard_name='sea_water_temperature')
+            assert [v.name for v in matches] == ['temperature']
+
+        # A partially written file
+        path = self.copy_ncfile(STATIC_FILES['murphy'])
+        with open(STATIC_FILES['murphy'], 'rb') as f, open(path, 'wb') as out:
+            out.write(f.read(2000))
+        with self.assertRaises(ValueError):
+            ncheader.read_header(path)
+
+    def test_read_header_cached(self):
+        path = self.copy_ncfile(STATIC_FILES['murphy'])
+        header = ncheader.read_header_cached(path)
+        assert ncheader.read_header_cached(path) is header
+        # A modified file is read again
+        with Dataset(path, 'r+') as nc:
+            nc.title = 'Modified'
+        modified = ncheader.read_header_cached(path)
+        assert modified is not header
+        assert modified.title == 'Modified'
+
+    def test_check_needs_qc(self):
+        qc_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+        assert check_needs_qc(qc_path)
+        with Dataset(qc_path, 'r+') as nc:
+            run_qc('data/qc_config.yml', nc, qc_path)
+        assert not check_needs_qc(qc_path)
+
+    @skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_qc_task_cached(self):
+        qc_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+        connection = fakeredis.FakeStrictRedis()
+        # redis locks are Lua scripts, which fakeredis only runs with lupa
+        connection.lock = lambda *args, **kwargs: threading.Lock()
+        with mock.patch.object(glider_qc, 'get_redis_connection', return_value=connection), \
+                mock.patch.object(glider_qc, 'compute_qc', wraps=glider_qc.compute_qc) as compute:
+            assert qc_task(qc_path, 'data/qc_config.yml')
+            with Dataset(qc_path, 'r') as nc:
+                first = snapshot_qc_results(nc)
+            # QC the same file again
+            os.removexattr(qc_path, 'user.qc_run')
+            assert qc_task(qc_path, 'data/qc_config.yml')
+            assert compute.call_count == 1
+            with Dataset(qc_path, 'r') as nc:
+                assert json.dumps(snapshot_qc_results(nc), sort_keys=True, default=str) == \
+                    json.dumps(first, sort_keys=True, default=str)
+
+    def test_check_needs_qc_error(self):
+        qc_path = self.copy_to_deployment(STATIC_FILES['murphy'])
+        config = os.path.join(os.path.dirname(qc_path), 'qc_config.yml')
+        shutil.copy('data/qc_config.yml', config)
+        mark_qc_error(qc_path, config)
+        assert os.getxattr(qc_path, 'user.qc_run') == b'error'
+        assert not check_needs_qc(qc_path, config)
+        assert not check_needs_qc(qc_path)
+        # The failure is retried once the configuration changes
+        with open(config, 'a') as f:
+            f.write('\n# changed\n')
+        assert check_needs_qc(qc_path, config)
+        with self.assertRaises(OSError):
+            os.getxattr(qc_path, 'user.qc_run')
@@ -1,12 +1,21 @@
 from netCDF4 import Dataset
-from unittest import TestCase
+from unittest import TestCase, mock, skipIf
 from pathlib import Path
+import errno
 import os
+import shutil
+import tempfile
 from tests.resources import STATIC_FILES
 from bson import ObjectId
 from datetime import datetime
-from scripts.build_erddap_catalog import build_erddap_catalog_chunk
+from scripts import build_erddap_catalog
+from scripts.build_erddap_catalog import (build_erddap_catalog_chunk, build_datasets_xml, build_chunks,
+                                          ChunkDeployment)
 from lxml import etree
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 
 class DummyVar:
@@ -107,6 +116,111 @@ class TestGliderXml(TestCase):
         # ERDDAP not to load a dataset
         assert len(variable_names) == len(set(variable_names))
 
+    def test_build_chunks(self):
+        """
+        Check that the chunks built in worker processes match the chunks
+        built in process and the expected chunk of the Murphy deployment.
+        """
+        with open(os.path.join(self.directory, "data", "Murphy-20150809T135508Z_dataset.xml")) as f:
+            expected = f.read()
+        deployment = ChunkDeployment.from_deployment(
+            DotDict(self.deployment, name="Murphy-20150809T135508Z"))
+        # relative, as the expected chunk has the directory of the files
+        data_root = os.path.relpath(self.directory)
+        for jobs in (1, 2):
+            chunks = [chunk_result() for _, chunk_result in
+                      build_chunks(data_root, [deployment, deployment], jobs)]
+            assert chunks == [expected, expected]
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+class TestBuildDatasetsXml(TestCase):
+    def setUp(self):
+        STATIC_FILES["murphy"]
+        self.data_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_root)
+        self.catalog_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.catalog_root)
+        shutil.copytree(os.path.join(os.path.dirname(__file__), "data", "Murphy-20150809T135508Z"),
+                        os.path.join(self.data_root, "data", "Murphy-20150809T135508Z"))
+        self.deployment = DotDict(
+            {
+                "name": "Murphy-20150809T135508Z",
+                "deployment_dir": "data/Murphy-20150809T135508Z",
+                "checksum": "22222222222222222222222222222222",
+                "completed": True,
+                "delayed_mode": False,
+                "latest_file": "Murphy-20150809T135508Z_rt.nc",
+                "updated": datetime(2015, 8, 9),
+            }
+        )
+        self.chunk_path = os.path.join(self.data_root, self.deployment.deployment_dir, "dataset.xml")
+        self.ds_path = os.path.join(self.catalog_root, "datasets.xml")
+        db = mock.Mock()
+        db.Deployment.find.return_value = [self.deployment]
+        for patcher in (mock.patch.object(build_erddap_catalog, "db", db),
+                        mock.patch.object(build_erddap_catalog, "_redis", fakeredis.FakeStrictRedis()),
+                        mock.patch.object(build_erddap_catalog, "inactive_datasets", return_value=set())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def build(self):
+        build_datasets_xml(self.data_root, self.catalog_root, False)
+        with open(self.ds_path) as f:
+            return os.stat(self.ds_path), f.read()
+
+    def test_unchanged_catalog_not_rewritten(self):
+        first_stat, first = self.build()
+        assert '<dataset type="EDDTableFromNcFiles" datasetID="Murphy-20150809T135508Z"' in first
+        # a chunk touched without changes is hashed again
+        os.utime(self.chunk_path, (0, 0))
+        with mock.patch.object(build_erddap_catalog, "write_atomic",
+                               wraps=build_erddap_catalog.write_atomic) as write_atomic:
+            second_stat, second = self.build()
+        assert second == first
+        assert (second_stat.st_ino, second_stat.st_mtime_ns) == (first_stat.st_ino, first_stat.st_mtime_ns)
+        assert self.ds_path not in [call.args[0] for call in write_atomic.call_args_list]
+        assert sorted(os.listdir(self.catalog_root)) == ["datasets.manifest.json", "datasets.xml"]
+
+    def test_changed_chunk_rewrites_catalog(self):
+        _, first = self.build()
+        with open(self.chunk_path) as f:
+            chunk = f.read()
+        with open(self.chunk_path, "w") as f:
+            f.write(chunk.replace("<recursive>false</recursive>", "<recursive>true</recursive>"))
+        _, second = self.build()
+        assert second == first.replace("<recursive>false</recursive>", "<recursive>true</recursive>")
+        assert second != first
+
+    def test_edited_catalog_rewritten(self):
+        _, first = self.build()
+        with open(self.ds_path, "a") as f:
+            f.write("<!-- edited by hand -->")
+        _, second = self.build()
+        assert second == first
+
+    def test_replace_busy_writes_in_place(self):
+        first_stat, first = self.build()
+        with open(self.ds_path, "w") as f:
+            f.write("<erddapDatasets></erddapDatasets>")
+        replace = os.replace
+
+        def replace_busy(src, dst):
+            # datasets.xml is bind mounted on its own
+            if dst == self.ds_path:
+                raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+            replace(src, dst)
+
+        with mock.patch.object(build_erddap_catalog.os, "replace", side_effect=replace_busy):
+            second_stat, second = self.build()
+        assert second == first
+        assert second_stat.st_ino == first_stat.st_ino
+        # the temporary file is removed
+        assert sorted(os.listdir(self.catalog_root)) == ["datasets.manifest.json", "datasets.xml"]
+        # and the rewritten file is not assembled again
+        third_stat, third = self.build()
+        assert (third_stat.st_ino, third_stat.st_mtime_ns) == (second_stat.st_ino, second_stat.st_mtime_ns)
+
 
 def test_colon_in_variable_name_is_replaced():
     from scripts.build_erddap_catalog import add_erddap_var_elem